@@ -12,10 +12,12 @@ from functools import wraps
 from flask import url_for, make_response
 from flask_babel import lazy_gettext as _
 from io import BytesIO
+from util.compression import GZIP_WBITS
 from util.flask_util import problem
 from util.problem_detail import ProblemDetail
 import traceback
 import logging
+import zlib
 from entrypoint import EntryPoint
 from opds import (
     AcquisitionFeed,
@@ -124,6 +126,28 @@ def returns_problem_detail(f):
     return decorated
 
 
+def gzip_stream(chunks, level=6):
+    """Compress a streamed response body, one chunk at a time.
+
+    :param chunks: An iterable of strings, such as a generator that
+        writes an OPDS feed.
+    :yield: The gzip-compressed body, in pieces.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode("utf8")
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
 def compressible(f):
     """Decorate a function to make it transparently handle whatever
     compression the client has announced it supports.
@@ -162,16 +186,25 @@ def compressible(f):
             # fail. This is pure copy-and-paste magic.
             response.direct_passthrough = False
 
-            buffer = BytesIO()
-            gzipped = gzip.GzipFile(mode='wb', fileobj=buffer)
-            gzipped.write(response.data)
-            gzipped.close()
-            response.data = buffer.getvalue()
+            if response.is_streamed:
+                # Reading response.data would run the generator to
+                # completion and hold the whole document in memory.
+                # Compress each chunk as it's generated instead. The
+                # compressed size isn't known in advance, so there's
+                # no Content-Length.
+                response.response = gzip_stream(response.response)
+                response.headers.pop('Content-Length', None)
+            else:
+                buffer = BytesIO()
+                gzipped = gzip.GzipFile(mode='wb', fileobj=buffer)
+                gzipped.write(response.data)
+                gzipped.close()
+                response.data = buffer.getvalue()
+                response.headers['Content-Length'] = len(response.data)
 
             response.headers['Content-Encoding'] = 'gzip'
             # TODO: This is bad if Vary is already set.
             response.headers['Vary'] = 'Accept-Encoding'
-            response.headers['Content-Length'] = len(response.data)
 
             return response
 
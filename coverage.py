@@ -1,6 +1,7 @@
 from nose.tools import set_trace
 import datetime
 import logging
+import math
 import traceback
 
 from sqlalchemy.orm.session import Session
@@ -154,8 +155,28 @@ class BaseCoverageProvider(object):
     # doing this.
     DEFAULT_BATCH_SIZE = 100
 
+    # If this is True, items are found in ascending order of this
+    # column, and each batch starts immediately after the last item
+    # of the previous batch, instead of being found with a numeric
+    # offset into the whole list. The position is kept in the
+    # Timestamp's counter, so a run that stops partway through picks
+    # up where it left off. You may set this in your subclass, or pass
+    # `keyset_pagination` into the constructor.
+    KEYSET_PAGINATION = False
+    KEYSET_COLUMN = None
+
+    # If this is set to a timedelta, every batch is claimed before
+    # it's processed, by locking the items that aren't locked by
+    # anyone else and giving them 'in progress' coverage records that
+    # expire after this much time. Any number of processes, on any
+    # number of hosts, can then run the same CoverageProvider without
+    # covering the same item twice. If a process dies, its claims
+    # expire and the items are picked up by someone else. Claiming
+    # uses keyset pagination.
+    LEASE_DURATION = None
+
     def __init__(self, _db, batch_size=None, cutoff_time=None,
-        registered_only=False,
+        registered_only=False, keyset_pagination=None, lease_duration=None,
     ):
         """Constructor.
 
@@ -169,6 +190,11 @@ class BaseCoverageProvider(object):
         CoverageProvider will only cover items that already have been
         "preregistered" with a CoverageRecord with a registered or failing
         status. This option is only used on the Metadata Wrangler.
+
+        :param keyset_pagination: Optional. Overrides
+        KEYSET_PAGINATION.
+
+        :param lease_duration: Optional. Overrides LEASE_DURATION.
         """
         self._db = _db
         if not self.__class__.SERVICE_NAME:
@@ -186,6 +212,17 @@ class BaseCoverageProvider(object):
         self.cutoff_time = cutoff_time
         self.registered_only = registered_only
         self.collection_id = None
+        if lease_duration is None:
+            lease_duration = self.LEASE_DURATION
+        self.lease_duration = lease_duration
+        if keyset_pagination is None:
+            keyset_pagination = self.KEYSET_PAGINATION or bool(lease_duration)
+        if keyset_pagination and self.KEYSET_COLUMN is None:
+            raise ValueError(
+                "%s must define KEYSET_COLUMN to use keyset pagination." %
+                self.__class__.__name__
+            )
+        self.keyset_pagination = keyset_pagination
 
     @property
     def log(self):
@@ -233,6 +270,12 @@ class BaseCoverageProvider(object):
         # as we grant coverage to items.
         progress = CoverageProviderProgress(start=start_time)
 
+        # If the last run stopped partway through, the first pass
+        # picks up where it left off.
+        resume_after = None
+        if self.keyset_pagination and timestamp:
+            resume_after = timestamp.counter
+
         for covered_statuses in covered_status_lists:
             # We may have completed our work for the previous value of
             # covered_statuses, but there's more work to do. Unset the
@@ -243,6 +286,9 @@ class BaseCoverageProvider(object):
             # at the start of the database table.
             original_finish = progress.finish = None
             progress.offset = 0
+            if self.keyset_pagination:
+                progress.counter = resume_after
+                resume_after = None
 
             # Call run_once() until we get an exception or
             # progress.finish is set.
@@ -330,6 +376,11 @@ class BaseCoverageProvider(object):
         count_as_covered_message = ' (counting %s as covered)' % (', '.join(count_as_covered))
 
         qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
+        if self.keyset_pagination:
+            return self._run_once_keyset(
+                progress, qu, count_as_covered_message
+            )
+
         self.log.info("%d items need coverage%s", qu.count(),
                       count_as_covered_message)
         batch = qu.limit(self.batch_size).offset(progress.offset)
@@ -369,6 +420,161 @@ class BaseCoverageProvider(object):
 
         return progress
 
+    def _run_once_keyset(self, progress, qu, count_as_covered_message):
+        """Process the batch of items that comes after the last item
+        processed, in order of KEYSET_COLUMN.
+
+        Every item in a batch is moved past, whatever the outcome, so
+        no offset is needed and nothing needs to be counted.
+
+        :param qu: A query for the items that need coverage.
+        """
+        column = self.KEYSET_COLUMN
+        last_id = progress.counter
+        if last_id is TimestampData.CLEAR_VALUE:
+            last_id = None
+        if last_id is not None:
+            qu = qu.filter(column > last_id)
+        self.log.info(
+            "Looking for items after %s that need coverage%s",
+            last_id, count_as_covered_message
+        )
+        qu = qu.order_by(column)
+        if self.lease_duration:
+            batch = self.claim(qu)
+        else:
+            batch = qu.limit(self.batch_size).all()
+
+        if not batch:
+            # The batch is empty. We're done, and the next run should
+            # start from the beginning.
+            progress.finish = datetime.datetime.utcnow()
+            progress.counter = TimestampData.CLEAR_VALUE
+            return progress
+
+        (successes, transient_failures, persistent_failures), results = (
+            self.process_batch_and_handle_results(batch)
+        )
+        progress.successes += successes
+        progress.transient_failures += transient_failures
+        progress.persistent_failures += persistent_failures
+        progress.counter = max(item.id for item in batch)
+        return progress
+
+    def claim(self, qu):
+        """Claim a batch of the items found by a query, so that no other
+        process will work on them until the claim expires.
+
+        Items that another process has locked are skipped, rather
+        than waited for.
+
+        :param qu: A query for the items that need coverage, in the
+            order they should be claimed.
+        :return: A list of the items claimed.
+        """
+        column = self.KEYSET_COLUMN
+        locked = self.lock_items(qu.limit(self.batch_size))
+        items = []
+        if locked:
+            # The locks are on the items, but the claims are coverage
+            # records. Another process may have claimed some of these
+            # items and released its locks after our query started
+            # but before we locked them. A new statement sees every
+            # claim committed so far, so ask again which items are
+            # still unclaimed, and claim only those.
+            claimable = set(
+                id for [id] in qu.with_entities(column).filter(
+                    column.in_([item.id for item in locked])
+                )
+            )
+            items = [item for item in locked if item.id in claimable]
+        expires = datetime.datetime.utcnow() + self.lease_duration
+        self.add_claims_for(items, expires)
+
+        # Committing releases the locks. From now on, the 'in
+        # progress' coverage records keep other processes away.
+        self._db.commit()
+        return items
+
+    def lock_items(self, qu):
+        """Lock the items found by a query, skipping any that another
+        process has already locked.
+
+        :return: A list of the items locked.
+        """
+        return qu.with_for_update(
+            skip_locked=True, of=self.KEYSET_COLUMN
+        ).all()
+
+    def add_claims_for(self, items, expires):
+        """Give each item an 'in progress' coverage record that
+        expires at the given time.
+
+        Implemented in IdentifierCoverageProvider and WorkCoverageProvider.
+        """
+        raise NotImplementedError()
+
+    def id_ranges(self, count, count_as_covered=None):
+        """Divide the items that need coverage into ranges of
+        KEYSET_COLUMN values, so that each range can be covered
+        separately.
+
+        :param count: The number of ranges to create. Fewer ranges
+            will be created if there aren't enough distinct ids to go
+            around.
+
+        :return: A list of (start_after, end) 2-tuples. An item is in
+            a range if its id is greater than `start_after` and no
+            greater than `end`.
+        """
+        column = self.KEYSET_COLUMN
+        qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
+        low, high = qu.with_entities(func.min(column), func.max(column)).one()
+        if low is None:
+            return []
+        size = max(1, int(math.ceil((high - low + 1) / float(count))))
+        ranges = []
+        start_after = low - 1
+        while start_after < high:
+            end = min(start_after + size, high)
+            ranges.append((start_after, end))
+            start_after = end
+        return ranges
+
+    def run_on_id_range(self, start_after, end, count_as_covered=None,
+                        progress=None, stop=None):
+        """Cover every item in a range of KEYSET_COLUMN values that
+        needs coverage.
+
+        :param start_after: Only items with an id greater than this
+            will be covered.
+        :param end: Only items with an id no greater than this will
+            be covered.
+        :param progress: A CoverageProviderProgress to update.
+        :param stop: An optional threading or multiprocessing Event.
+            If it's set, no new batches will be started.
+
+        :return: A CoverageProviderProgress.
+        """
+        if not progress:
+            progress = CoverageProviderProgress(
+                start=datetime.datetime.utcnow()
+            )
+        count_as_covered = (
+            count_as_covered or BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
+        )
+        message = " (range %s-%s)" % (start_after, end)
+        progress.counter = start_after
+        while not progress.is_complete:
+            if stop is not None and stop.is_set():
+                self.log.info("Stopping before %s%s", progress.counter, message)
+                break
+            qu = self.items_that_need_coverage(
+                count_as_covered=count_as_covered
+            ).filter(self.KEYSET_COLUMN <= end)
+            self._run_once_keyset(progress, qu, message)
+        return progress
+
     def process_batch_and_handle_results(self, batch):
         """:return: A 2-tuple (counts, records).
 
@@ -490,6 +696,11 @@ class BaseCoverageProvider(object):
             # been attempted. Try to get covered.
             return True
 
+        if coverage_record.status==BaseCoverageRecord.IN_PROGRESS:
+            # Some other process has claimed this item. Do the work
+            # only if that claim has expired.
+            return coverage_record.timestamp < datetime.datetime.utcnow()
+
         if self.cutoff_time is None:
             # An easy decision -- without a cutoff_time, once we
             # create a coverage record we never update it.
@@ -590,6 +801,8 @@ class IdentifierCoverageProvider(BaseCoverageProvider):
     # Collections the Identifier belongs to.
     COVERAGE_COUNTS_FOR_EVERY_COLLECTION = True
 
+    KEYSET_COLUMN = Identifier.id
+
     def __init__(self, _db, collection=None, input_identifiers=None,
                  replacement_policy=None, **kwargs
     ):
@@ -997,6 +1210,13 @@ class IdentifierCoverageProvider(BaseCoverageProvider):
         """Turn a CoverageFailure into a CoverageRecord object."""
         return failure.to_coverage_record(operation=self.operation)
 
+    def add_claims_for(self, identifiers, expires):
+        CoverageRecord.bulk_add(
+            identifiers, self.data_source, operation=self.operation,
+            timestamp=expires, status=CoverageRecord.IN_PROGRESS,
+            collection=self.collection_or_not, force=True
+        )
+
     def failure_for_ignored_item(self, item):
         """Create a CoverageFailure recording the CoverageProvider's
         failure to even try to process an item.
@@ -1328,6 +1548,53 @@ class CollectionCoverageProviderJob(DatabaseJob):
         provider.finalize_timestampdata(self.progress)
 
 
+class CoverageProviderRangeJob(object):
+    """Cover the items in one range of ids, possibly in another process.
+
+    Everything is stored as plain values, so that the job can be
+    pickled and sent to a worker process that has its own database
+    session.
+    """
+
+    def __init__(self, provider_class, collection_id, start_after, end,
+                 count_as_covered=None, **provider_kwargs):
+        self.provider_class = provider_class
+        self.collection_id = collection_id
+        self.start_after = start_after
+        self.end = end
+        self.count_as_covered = count_as_covered
+        self.provider_kwargs = provider_kwargs
+
+    def provider(self, _db):
+        if self.collection_id is None:
+            return self.provider_class(_db, **self.provider_kwargs)
+        collection = get_one(_db, Collection, id=self.collection_id)
+        return self.provider_class(collection, **self.provider_kwargs)
+
+    def run(self, _db, stop=None):
+        """Cover the range and return a CoverageProviderProgress.
+
+        Exceptions are not raised; they're recorded in the progress
+        object, so that one broken range doesn't stop the others.
+        """
+        progress = CoverageProviderProgress(start=datetime.datetime.utcnow())
+        try:
+            provider = self.provider(_db)
+            provider.run_on_id_range(
+                self.start_after, self.end, self.count_as_covered,
+                progress=progress, stop=stop
+            )
+            _db.commit()
+        except Exception, e:
+            logging.error(
+                "Error covering %s-%s with %s", self.start_after, self.end,
+                self.provider_class.__name__, exc_info=e
+            )
+            _db.rollback()
+            progress.exception = traceback.format_exc()
+        return progress
+
+
 class CatalogCoverageProvider(CollectionCoverageProvider):
     """Most CollectionCoverageProviders provide coverage to Identifiers
     that are licensed through a given Collection.
@@ -1374,6 +1641,8 @@ class WorkCoverageProvider(BaseCoverageProvider):
 
     """Perform coverage operations on Works rather than Identifiers."""
 
+    KEYSET_COLUMN = Work.id
+
     @classmethod
     def register(cls, work, force=False):
         """Registers a work for future coverage.
@@ -1461,6 +1730,12 @@ class WorkCoverageProvider(BaseCoverageProvider):
         """
         return WorkCoverageRecord.add_for(work, operation=self.operation)
 
+    def add_claims_for(self, works, expires):
+        WorkCoverageRecord.bulk_add(
+            works, operation=self.operation, timestamp=expires,
+            status=WorkCoverageRecord.IN_PROGRESS
+        )
+
     def record_failure_as_coverage_record(self, failure):
         """Turn a CoverageFailure into a WorkCoverageRecord object."""
         return failure.to_work_coverage_record(operation=self.operation)
@@ -1,10 +1,24 @@
-from collections import defaultdict
+from collections import (
+    Counter,
+    defaultdict,
+    namedtuple,
+)
+import bisect
 import contextlib
+import copy
 import datetime
+import hashlib
 from nose.tools import set_trace
 import json
+from multiprocessing.pool import ThreadPool
+from Queue import (
+    Full,
+    Queue,
+)
+import threading
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk as elasticsearch_bulk
+from elasticsearch.helpers import scan as elasticsearch_scan
 from elasticsearch.exceptions import (
     RequestError,
     ElasticsearchException,
@@ -15,6 +29,10 @@ from elasticsearch_dsl import (
     Search,
     SF,
 )
+from elasticsearch_dsl.response import (
+    Hit,
+    Response,
+)
 from elasticsearch_dsl.query import (
     Bool,
     DisMax,
@@ -59,7 +77,10 @@ from model import (
     Work,
     WorkCoverageRecord,
 )
-from lane import Pagination
+from lane import (
+    Lane,
+    Pagination,
+)
 from monitor import WorkSweepMonitor
 from coverage import (
     CoverageFailure,
@@ -70,6 +91,7 @@ from selftest import (
     HasSelfTests,
     SelfTestResult,
 )
+from util.cache import LRUCache
 from util.personal_names import display_name_to_sort_name
 from util.problem_detail import ProblemDetail
 from util.stopwords import ENGLISH_STOPWORDS
@@ -77,6 +99,7 @@ from util.stopwords import ENGLISH_STOPWORDS
 import os
 import logging
 import re
+import tempfile
 import time
 
 @contextlib.contextmanager
@@ -91,6 +114,266 @@ def mock_search_index(mock=None):
         ExternalSearchIndex.MOCK_IMPLEMENTATION = None
 
 
+class FileSearchResultStore(object):
+    """Keeps cached search results in files in a local directory, so
+    that they can be shared by every process on a server.
+
+    Each entry is stored as a JSON document in its own file. An entry
+    expires `ttl` seconds after its file was last written. Expired
+    files are removed when they're found, and every `prune_interval`
+    writes the whole directory is swept for them.
+    """
+
+    log = logging.getLogger("Search result store")
+
+    # By default, sweep the directory for expired entries once every
+    # this many writes.
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, directory, ttl=None, clock=time.time,
+                 prune_interval=None):
+        """Constructor.
+
+        :param directory: Store entries in this directory. It will be
+            created if it doesn't exist.
+        :param ttl: An entry will be treated as missing once it is
+            this many seconds old.
+        :param clock: A function that returns the current time as a
+            number of seconds. Only overridden in tests.
+        :param prune_interval: Remove expired entries after this many
+            calls to set(). Defaults to PRUNE_INTERVAL.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.clock = clock
+        self.prune_interval = prune_interval or self.PRUNE_INTERVAL
+        self.writes = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                # Another process may have created it in the meantime.
+                if not os.path.isdir(directory):
+                    raise e
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Look up a cached entry.
+
+        :return: The cached value, or None if there is no unexpired entry.
+        """
+        path = self._path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                self._remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            # The entry doesn't exist, or it went away or was only
+            # partially written while we were reading it.
+            return None
+
+    def set(self, key, value):
+        """Store a JSON-serializable value under the given key."""
+        # Write to a temporary file and then rename it, so that other
+        # processes never see a partially written entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.rename(temp_path, self._path(key))
+        except (IOError, OSError), e:
+            self.log.warn("Could not cache search results: %s", e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.writes += 1
+        if self.ttl is not None and self.writes % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove every expired entry from the store, along with any
+        temporary files left behind by writers that died.
+
+        :return: The number of files removed.
+        """
+        removed = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(('.json', '.tmp')):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                modified = os.path.getmtime(path)
+            except OSError:
+                continue
+            if self._expired(modified) and self._remove(path):
+                removed += 1
+        if removed:
+            self.log.info(
+                "Removed %d expired search results from %s",
+                removed, self.directory
+            )
+        return removed
+
+    def clear(self):
+        """Remove every entry from the store."""
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            self._remove(os.path.join(self.directory, filename))
+
+    def _expired(self, modified):
+        """Has an entry last written at the given time expired?"""
+        return self.ttl is not None and self.clock() - modified >= self.ttl
+
+    def _remove(self, path):
+        """Remove a file, unless another process got to it first.
+
+        :return: True if the file was removed by this call.
+        """
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class SearchResultCache(object):
+    """Keeps the raw results of recent Elasticsearch queries, so that
+    a query that's repeated shortly afterwards doesn't need to be sent
+    to Elasticsearch again.
+
+    Results are kept in an in-process LRU cache, and optionally in a
+    store shared with other processes, such as a
+    FileSearchResultStore.
+    """
+
+    def __init__(self, max_entries, ttl, shared=None):
+        """Constructor.
+
+        :param max_entries: Keep at most this many result sets in memory.
+        :param ttl: Keep a result set in memory for at most this many
+            seconds.
+        :param shared: An object with get(), set() and clear() methods
+            (such as a FileSearchResultStore) which is consulted when a
+            result set isn't found in memory.
+        """
+        self.local = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.shared = shared
+
+    def get(self, key):
+        """Look up a cached result set.
+
+        :return: The raw Elasticsearch response, or None.
+        """
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """Cache a raw Elasticsearch response."""
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def clear(self):
+        """Remove every result set from the cache."""
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+
+class SearchMetrics(object):
+    """Running totals and latency histograms describing the searches
+    run by this process.
+
+    The time taken by each search is broken down into phases:
+
+    * build: creating the search request in Python.
+    * transport: waiting for the response, minus the time the search
+      index says it spent on the search. This is mostly network and
+      queueing time.
+    * took: the time the search index says it spent on the search.
+    * hydrate: turning search results into Works, mostly by querying
+      the database.
+    """
+
+    PHASES = ['build', 'transport', 'took', 'hydrate']
+
+    # The upper bounds, in seconds, of the histogram buckets. There's
+    # an extra bucket for anything slower than the last one.
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start all the counters and histograms over from zero."""
+        with self._lock:
+            self.counters = Counter()
+            self.seconds = Counter()
+            self.histograms = dict(
+                (phase, [0] * (len(self.BUCKETS) + 1))
+                for phase in self.PHASES
+            )
+
+    def observe(self, phase, seconds):
+        """Record the time taken by one phase of a search."""
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            self.histograms[phase][bucket] += 1
+            self.seconds[phase] += seconds
+
+    def increment(self, name, amount=1):
+        """Add to one of the counters."""
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        """Export the current state of the metrics.
+
+        :return: A dictionary with 'counters' and 'histograms'. Each
+            histogram has a 'count', a 'sum' in seconds, and a list of
+            cumulative (upper bound, count) 'buckets', in the style of
+            Prometheus.
+        """
+        with self._lock:
+            histograms = dict()
+            for phase, counts in self.histograms.items():
+                buckets = []
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ['+Inf'], counts):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                histograms[phase] = dict(
+                    count=cumulative, sum=self.seconds[phase],
+                    buckets=buckets
+                )
+            return dict(counters=dict(self.counters), histograms=histograms)
+
+    @property
+    def summary(self):
+        """Summarize the metrics in a single line, for logging."""
+        snapshot = self.snapshot()
+        phases = []
+        for phase in self.PHASES:
+            histogram = snapshot['histograms'][phase]
+            mean = histogram['sum'] / max(histogram['count'], 1)
+            phases.append("%s=%.3fs" % (phase, mean))
+        counters = ", ".join(
+            "%s=%d" % (name, value)
+            for name, value in sorted(snapshot['counters'].items())
+        )
+        return "mean %s; %s" % (" ".join(phases), counters)
+
+
 class ExternalSearchIndex(HasSelfTests):
 
     NAME = ExternalIntegration.ELASTICSEARCH
@@ -112,6 +395,80 @@ class ExternalSearchIndex(HasSelfTests):
     CURRENT_ALIAS_SUFFIX = 'current'
     VERSION_RE = re.compile('-v([0-9]+)$')
 
+    # These fields are retrieved when a Filter is in search-only mode,
+    # so that HitBackedWork objects can be built from the results.
+    SEARCH_ONLY_FIELDS = [
+        'opds_entry', 'last_update_time', 'title', 'medium', 'licensepools'
+    ]
+
+    # In a pipelined bulk update, search documents are generated for
+    # this many works at a time. Each chunk is uploaded in the
+    # background while the next one is generated.
+    BULK_UPDATE_CHUNK_SIZE = 100
+
+    # In a pipelined bulk update, this many bulk requests may be in
+    # flight at once...
+    BULK_UPLOAD_THREADS = 4
+
+    # ...and no single bulk request will be much larger than this
+    # many bytes.
+    BULK_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+
+    # In a pipelined bulk update, a document that fails for one of
+    # these reasons is retried up to BULK_UPLOAD_MAX_RETRIES times,
+    # waiting BULK_UPLOAD_INITIAL_BACKOFF seconds before the first
+    # retry and twice as long before each one after that. 'N/A' is
+    # the status given when the server couldn't be reached at all.
+    TRANSIENT_BULK_ERROR_STATUSES = set([429, 502, 503, 504, 'N/A'])
+    BULK_UPLOAD_MAX_RETRIES = 3
+    BULK_UPLOAD_INITIAL_BACKOFF = 2
+
+    # While an index is being rebuilt from scratch, nobody searches
+    # it, so it doesn't need to be refreshed and there's no need to
+    # keep replicas up to date. These settings make loading documents
+    # into it much faster. See start_rebuild().
+    REBUILD_INDEX_SETTINGS = dict(refresh_interval="-1", number_of_replicas=0)
+
+    # Once a rebuild is finished, the index is merged down to this
+    # many segments. Merging a large index can take a long time.
+    REBUILD_MAX_NUM_SEGMENTS = 1
+    REBUILD_FORCEMERGE_TIMEOUT = 60 * 60
+
+    # While a rebuild is in progress, this keeps running totals of
+    # the works indexed.
+    rebuild_progress = None
+
+    # When scanning through every work that matches a Filter, this
+    # many results are retrieved at a time, and the scroll context
+    # that keeps track of the scan is kept alive this long between
+    # requests.
+    SCAN_BATCH_SIZE = 500
+    SCAN_SCROLL_TIMEOUT = "5m"
+
+    # When counting the works that match a number of Filters, the
+    # counts are requested this many at a time.
+    COUNT_WORKS_CHUNK_SIZE = 100
+
+    # An optional cache of recent search results. It's disabled by
+    # default; call configure_result_cache() to enable it.
+    result_cache = None
+
+    # Defaults for the search result cache. Search results go out of
+    # date whenever a work is reindexed, so they're not kept for long.
+    RESULT_CACHE_MAX_ENTRIES = 1000
+    RESULT_CACHE_TTL = 30
+
+    # Timings and counts for every search run by this process. See
+    # SearchMetrics.
+    metrics = SearchMetrics()
+
+    # A search that takes longer than this many seconds, from building
+    # the request to receiving the response, is logged to
+    # slow_query_log. It's disabled by default; call
+    # configure_slow_query_log() to enable it.
+    slow_query_threshold = None
+    slow_query_log = logging.getLogger("Slow search queries")
+
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("URL"), "required": True, "format": "url" },
         { "key": WORKS_INDEX_PREFIX_KEY, "label": _("Index prefix"),
@@ -137,6 +494,128 @@ class ExternalSearchIndex(HasSelfTests):
         """
         cls.__client = None
 
+    @classmethod
+    def configure_result_cache(cls, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                               ttl=RESULT_CACHE_TTL, shared_directory=None):
+        """Enable (or disable) the cache of recent search results.
+
+        The cache saves a trip to Elasticsearch when the same query is
+        run again shortly afterwards, as happens when popular lanes
+        are generated or a page of search results is reloaded.
+
+        :param max_entries: The maximum number of result sets to keep
+            in memory. If this is zero or None, the cache is disabled.
+        :param ttl: The maximum number of seconds a result set will
+            be kept.
+        :param shared_directory: If this is provided, result sets are
+            also stored in files in this directory, where other
+            processes can find them.
+        """
+        if not max_entries:
+            cls.result_cache = None
+            return
+        shared = None
+        if shared_directory:
+            shared = FileSearchResultStore(shared_directory, ttl=ttl)
+        cls.result_cache = SearchResultCache(max_entries, ttl, shared=shared)
+
+    @classmethod
+    def invalidate_result_cache(cls):
+        """Remove every result set from the search result cache."""
+        if cls.result_cache is not None:
+            cls.result_cache.clear()
+
+    @classmethod
+    def configure_slow_query_log(cls, threshold):
+        """Enable (or disable) the log of slow searches.
+
+        :param threshold: Log every search that takes longer than this
+            many seconds. If this is None, nothing is logged.
+        """
+        cls.slow_query_threshold = threshold
+
+    @classmethod
+    def record_search(cls, query_string, filter, timings, body=None,
+                      response=None):
+        """Add the timings of a single search to the metrics, and log
+        it if it was slow.
+
+        :param timings: A dictionary mapping some of the phases in
+            SearchMetrics.PHASES to the number of seconds each took.
+        :param body: The request sent to the search index, or a
+            function that returns it. A function is only called if the
+            search needs to be logged.
+        :param response: The response from the search index, either
+            raw or as an elasticsearch_dsl Response.
+        """
+        metrics = cls.metrics
+        metrics.increment('queries')
+        for phase, seconds in timings.items():
+            metrics.observe(phase, seconds)
+        if response:
+            hits = _hit_value(response, 'hits') or {}
+            metrics.increment('hits', _hit_value(hits, 'total', 0))
+            shards = _hit_value(response, '_shards') or {}
+            metrics.increment('shards', _hit_value(shards, 'total', 0))
+            metrics.increment(
+                'shard_failures', _hit_value(shards, 'failed', 0)
+            )
+            if _hit_value(response, 'timed_out'):
+                metrics.increment('timed_out')
+
+        threshold = cls.slow_query_threshold
+        total = sum(timings.values())
+        if threshold is None or total <= threshold:
+            return
+        metrics.increment('slow_queries')
+        if callable(body):
+            body = body()
+        if filter is not None and body is None:
+            # Describe the Filter the way it would be sent to
+            # Elasticsearch.
+            base_filter, nested_filters = filter.build()
+            body = dict(
+                filter=base_filter and base_filter.to_dict(),
+                nested_filters=dict(
+                    (path, [x.to_dict() for x in subfilters])
+                    for path, subfilters in nested_filters.items()
+                )
+            )
+        cls.slow_query_log.warn(
+            "Slow search (%.3fsec: %s) for %s: %s", total,
+            " ".join(
+                "%s=%.3fs" % (phase, timings[phase])
+                for phase in SearchMetrics.PHASES if phase in timings
+            ),
+            json.dumps(cls._normalize_query_string(query_string)),
+            json.dumps(body, sort_keys=True, default=unicode)
+        )
+
+    @classmethod
+    def record_hydration(cls, seconds, works):
+        """Add the time taken to turn search results into Works to the
+        metrics, and log it if it was slow.
+
+        :param works: The number of Works loaded from the database.
+        """
+        cls.metrics.observe('hydrate', seconds)
+        cls.metrics.increment('hydrated_works', works)
+        threshold = cls.slow_query_threshold
+        if threshold is not None and seconds > threshold:
+            cls.slow_query_log.warn(
+                "Slow hydration of search results (%.3fsec) for %d works",
+                seconds, works
+            )
+
+    @classmethod
+    def _normalize_query_string(cls, query_string):
+        """Normalize a query string, so that slow searches for the same
+        thing can be grouped together.
+        """
+        if not query_string:
+            return query_string
+        return " ".join(query_string.lower().split())
+
     @classmethod
     def search_integration(cls, _db):
         """Look up the ExternalIntegration for ElasticSearch."""
@@ -178,9 +657,21 @@ class ExternalSearchIndex(HasSelfTests):
 
     @classmethod
     def load(cls, _db, *args, **kwargs):
-        """Load a generic implementation."""
+        """Load a generic implementation.
+
+        If no Elasticsearch integration is configured but a local
+        search integration is, a LocalSearchIndex is loaded instead.
+        """
         if cls.MOCK_IMPLEMENTATION:
             return cls.MOCK_IMPLEMENTATION
+        if not args and not kwargs and not cls.search_integration(_db):
+            local = ExternalIntegration.lookup(
+                _db, ExternalIntegration.LOCAL_SEARCH,
+                goal=ExternalIntegration.SEARCH_GOAL
+            )
+            if local:
+                from local_search import LocalSearchIndex
+                return LocalSearchIndex.for_integration(_db)
         return cls(_db, *args, **kwargs)
 
     def __init__(self, _db, url=None, works_index=None, test_search_term=None,
@@ -379,6 +870,9 @@ class ExternalSearchIndex(HasSelfTests):
         self.works_index = self.__client.works_index = new_index
         alias_name = self.works_alias_name(_db)
 
+        # Any cached search results came from the old index.
+        self.invalidate_result_cache()
+
         exists = self.indices.exists_alias(name=alias_name)
         if not exists:
             # The alias doesn't already exist. Set it.
@@ -407,6 +901,129 @@ class ExternalSearchIndex(HasSelfTests):
 
         self.works_alias = self.__client.works_alias = alias_name
 
+    def start_rebuild(self, _db, new_index=None):
+        """Create a new, empty index to be filled with every work in
+        the system, and direct document uploads to it.
+
+        The index is created with REBUILD_INDEX_SETTINGS, which make it
+        fast to load but unsuitable for searching. Searches continue
+        to go through the current alias until finish_rebuild() is
+        called.
+
+        :param new_index: The name of the index to create. By default,
+            the index for the current version of the mapping is
+            created.
+        :return: A dictionary of the index settings that should be
+            restored once the rebuild is finished -- whatever they are
+            on the index the alias currently points to.
+        :raise ValueError: If the alias already points to `new_index`.
+            Rebuilding it in place would destroy the index searches
+            are using; do a regular rebuild instead.
+        """
+        new_index = new_index or self.works_index_name(_db)
+        alias_name = self.works_alias_name(_db)
+        if self.indices.exists_alias(index=new_index, name=alias_name):
+            raise ValueError(
+                "Index '%s' is in use by alias '%s' and can't be rebuilt "
+                "alongside itself." % (new_index, alias_name)
+            )
+
+        # Find out what the settings should be when we're done.
+        restore_settings = self._settings_to_restore(_db)
+
+        self.setup_index(new_index=new_index, **self.REBUILD_INDEX_SETTINGS)
+        self.works_index = self.__client.works_index = new_index
+        self.rebuild_progress = Counter(started=time.time())
+        return restore_settings
+
+    def _settings_to_restore(self, _db):
+        """Find the values to give REBUILD_INDEX_SETTINGS once a rebuild
+        is finished.
+
+        :return: A dictionary. A value of None resets a setting to the
+            Elasticsearch default.
+        """
+        restore_settings = dict(
+            (name, None) for name in self.REBUILD_INDEX_SETTINGS
+        )
+        alias_name = self.works_alias_name(_db)
+        if not self.indices.exists_alias(name=alias_name):
+            return restore_settings
+        names = ['index.' + name for name in self.REBUILD_INDEX_SETTINGS]
+        response = self.indices.get_settings(
+            index=alias_name, name=names, flat_settings=True
+        )
+        for index_settings in response.values():
+            current = index_settings.get('settings', {})
+            for name in self.REBUILD_INDEX_SETTINGS:
+                value = current.get('index.' + name)
+                if value is not None:
+                    restore_settings[name] = value
+            break
+        return restore_settings
+
+    def finish_rebuild(self, _db, restore_settings):
+        """Make an index filled by a rebuild ready for searching, and
+        point the alias at it.
+
+        :param restore_settings: The dictionary returned by
+            start_rebuild().
+        :return: The running totals kept during the rebuild.
+        """
+        index = self.works_index
+        self.log.info(
+            "Restoring settings on index %s: %r", index, restore_settings
+        )
+        self.indices.put_settings(
+            index=index, body=dict(index=restore_settings)
+        )
+        self.indices.refresh(index=index)
+
+        self.log.info(
+            "Merging index %s down to %d segment(s).", index,
+            self.REBUILD_MAX_NUM_SEGMENTS
+        )
+        a = time.time()
+        self.indices.forcemerge(
+            index=index, max_num_segments=self.REBUILD_MAX_NUM_SEGMENTS,
+            request_timeout=self.REBUILD_FORCEMERGE_TIMEOUT
+        )
+        self.log.info("Merge completed in %.1fsec", time.time()-a)
+
+        self.transfer_current_alias(_db, index)
+        progress = self.rebuild_progress
+        if progress:
+            self.log.info(
+                "Rebuilt index %s: %s", index,
+                self._rebuild_progress_summary(progress)
+            )
+        self.rebuild_progress = None
+        return progress
+
+    def _record_rebuild_progress(self, report):
+        """If a rebuild is in progress, add a BulkIndexReport to its
+        running totals and log them.
+        """
+        progress = self.rebuild_progress
+        if progress is None:
+            return
+        progress['indexed'] += len(report.successes)
+        progress['failed'] += len(report.failures)
+        progress['bytes_sent'] += report.bytes_sent
+        self.log.info(
+            "Rebuilding index %s: %s", self.works_index,
+            self._rebuild_progress_summary(progress)
+        )
+
+    @classmethod
+    def _rebuild_progress_summary(cls, progress):
+        elapsed = max(time.time() - progress['started'], 0.001)
+        return "%d works indexed, %d failed in %.1fsec (%.1f works/sec, %.2f MB/sec)" % (
+            progress['indexed'], progress['failed'], elapsed,
+            progress['indexed'] / elapsed,
+            progress['bytes_sent'] / elapsed / 1024 / 1024
+        )
+
     def base_index_name(self, index_or_alias):
         """Removes version or current suffix from base index name"""
 
@@ -440,6 +1057,8 @@ class ExternalSearchIndex(HasSelfTests):
             fields = ["work_id"]
             if filter:
                 fields += filter.script_fields.keys()
+                if filter.search_only:
+                    fields += self.SEARCH_ONLY_FIELDS
 
         # Change the Search object so it only retrieves the fields
         # we're asking for.
@@ -478,12 +1097,14 @@ class ExternalSearchIndex(HasSelfTests):
         [result] = self.query_works_multi([query_data], debug)
         return result
 
-    def query_works_multi(self, queries, debug=False):
+    def query_works_multi(self, queries, debug=False, timeout=None):
         """Run several queries simultaneously and return the results
         as a big list.
 
         :param queries: A list of (query string, Filter, Pagination) 3-tuples,
             each representing an Elasticsearch query to be run.
+        :param timeout: Give up on the Elasticsearch request if it
+            hasn't finished after this many seconds.
 
         :yield: A sequence of lists, one per item in `queries`,
             each containing the search results from that
@@ -498,12 +1119,19 @@ class ExternalSearchIndex(HasSelfTests):
             for q in queries:
                 yield []
 
-        # Create a MultiSearch.
-        multi = MultiSearch(using=self.__client)
-
-        # Give it a Search object for every query definition passed in
-        # as part of `queries`.
+        # Debugging output needs information that isn't cached.
+        cache = None
+        if not debug:
+            cache = self.result_cache
+
+        # Create a Search object for every query definition passed in
+        # as part of `queries`, and see whether its results are
+        # already cached.
+        paginations = []
+        resultset = []
+        uncached = []
         for (query_string, filter, pagination) in queries:
+            build_started = time.time()
             search = self.create_search_doc(
                 query_string, filter=filter, pagination=pagination, debug=debug
             )
@@ -515,12 +1143,59 @@ class ExternalSearchIndex(HasSelfTests):
                     score_mode="sum"
                 )
                 search = search.query(function_score)
-            multi = multi.add(search)
+            paginations.append(pagination)
+
+            cache_key = None
+            if cache is not None:
+                cache_key = self._result_cache_key(search)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    resultset.append(Response(search, cached))
+                    self.metrics.increment('cached')
+                    continue
+            resultset.append(None)
+            build_time = time.time() - build_started
+            uncached.append(
+                (len(resultset)-1, search, cache_key, query_string, filter,
+                 build_time)
+            )
 
         a = time.time()
-        # NOTE: This is the code that actually executes the ElasticSearch
-        # request.
-        resultset = [x for x in multi.execute()]
+        if uncached:
+            # Put every query whose results weren't cached into a
+            # MultiSearch.
+            multi = MultiSearch(using=self.__client)
+            for index, search, cache_key, q, f, build_time in uncached:
+                multi = multi.add(search)
+            if timeout is not None:
+                multi = multi.params(request_timeout=timeout)
+
+            # NOTE: This is the code that actually executes the
+            # ElasticSearch request.
+            responses = multi.execute()
+            elapsed = time.time() - a
+            for (index, search, cache_key, q, f, build_time), results in zip(
+                uncached, responses
+            ):
+                if cache_key is not None:
+                    cache.set(cache_key, results.to_dict())
+                resultset[index] = results
+
+                # Every query in the MultiSearch waited for the whole
+                # request, so the time not accounted for by 'took'
+                # was spent in transport.
+                took = _hit_value(results, 'took', 0) / 1000.0
+                timings = dict(
+                    build=build_time, took=took,
+                    transport=max(elapsed - took, 0)
+                )
+
+                # The request is only turned back into a dictionary
+                # if this turns out to be a slow search that needs to
+                # be logged.
+                self.record_search(
+                    q, f, timings, body=search.to_dict, response=results
+                )
 
         if debug:
             b = time.time()
@@ -536,7 +1211,7 @@ class ExternalSearchIndex(HasSelfTests):
                         result.meta.explanation['value'] or 0, result.meta['shard']
                     )
 
-        for i, results in enumerate(resultset):
+        for pagination, results in zip(paginations, resultset):
             # Tell the Pagination object about the page that was just
             # 'loaded' so that Pagination.next_page will work.
             #
@@ -545,6 +1220,22 @@ class ExternalSearchIndex(HasSelfTests):
             pagination.page_loaded(results)
             yield results
 
+    def _result_cache_key(self, search):
+        """Calculate the key under which the results of a search
+        are cached.
+
+        :param search: A Search object, ready to be sent to
+            Elasticsearch.
+        :return: A hash of the index being searched and the complete
+            request body, which covers the query string, the Filter,
+            and the Pagination. The index is identified by its own
+            name as well as the alias, since the alias keeps its name
+            when transfer_current_alias() moves it to another index.
+        """
+        data = [self.works_alias, self.works_index, search.to_dict()]
+        canonical = json.dumps(data, sort_keys=True, default=unicode)
+        return hashlib.sha1(canonical).hexdigest()
+
     def count_works(self, filter):
         """Instead of retrieving works that match `filter`, count the total."""
         if filter is not None and filter.match_nothing is True:
@@ -556,88 +1247,478 @@ class ExternalSearchIndex(HasSelfTests):
         )
         return qu.count()
 
-    def bulk_update(self, works, retry_on_batch_failure=True):
-        """Upload a batch of works to the search index at once."""
+    def scan_works(self, filter, fields=None, slices=1, batch_size=None):
+        """Iterate over every work that matches a Filter.
+
+        Rather than running the query again for every page of
+        results, this uses the scroll API, so each slice of the scan
+        sees the index as it was when that slice started, and the
+        cost of the scan grows linearly with the number of results.
+
+        Results come back in index order, not the Filter's sort
+        order: sorting a scroll makes Elasticsearch keep every
+        matching document's sort values for the life of the scroll,
+        and no caller needs the order.
+
+        :param filter: A Filter object.
+        :param fields: Retrieve only these fields from the search
+            documents. By default, only the work ID (and any script
+            fields requested by the Filter) are retrieved.
+        :param slices: Split the scan into this many slices, which
+            are retrieved in parallel.
+        :param batch_size: Retrieve this many results per request
+            (per slice). Defaults to SCAN_BATCH_SIZE.
+
+        :yield: A sequence of Hit objects.
+        """
+        if filter is not None and filter.match_nothing is True:
+            # We already know that the filter should match nothing.
+            return
+        batch_size = batch_size or self.SCAN_BATCH_SIZE
+        search = self.create_search_doc(
+            query_string=None, filter=filter, pagination=None, debug=False
+        )
+        if fields:
+            search = search.source(fields)
+        body = search.to_dict()
+        body.pop('from', None)
+        body.pop('size', None)
+
+        if slices <= 1:
+            hits = self._scan(body, batch_size)
+        else:
+            bodies = [
+                dict(body, slice=dict(id=i, max=slices))
+                for i in range(slices)
+            ]
+            hits = self._scan_in_parallel(bodies, batch_size)
+        for hit in hits:
+            yield Hit(hit)
+
+    def _scan(self, body, batch_size):
+        """Run a single scroll through the search index.
+
+        :return: An iterator over raw Elasticsearch results.
+        """
+        return elasticsearch_scan(
+            self.__client, query=body, index=self.works_alias,
+            scroll=self.SCAN_SCROLL_TIMEOUT, size=batch_size
+        )
+
+    def _scan_in_parallel(self, bodies, batch_size):
+        """Run several scrolls through the search index at once, one
+        thread per scroll.
+
+        :yield: A sequence of raw Elasticsearch results, in the order
+            they come in.
+        """
+        results = Queue(maxsize=len(bodies) * batch_size)
+        stop = threading.Event()
+        finished = object()
+
+        def put(item):
+            # Wait for room in the queue, unless the caller has
+            # stopped listening.
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def scan(body):
+            try:
+                for hit in self._scan(body, batch_size):
+                    if not put(hit):
+                        break
+            except Exception, e:
+                put(e)
+            finally:
+                put(finished)
+
+        threads = [
+            threading.Thread(target=scan, args=(body,)) for body in bodies
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        running = len(threads)
+        try:
+            while running:
+                item = results.get()
+                if item is finished:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # If the caller stopped early, or one of the scrolls
+            # failed, tell the other threads to stop.
+            stop.set()
+
+    def count_works_multi(self, filters):
+        """Count the works that match each of a number of Filters.
+
+        Rather than sending one request per Filter, the counts are
+        requested COUNT_WORKS_CHUNK_SIZE at a time, as searches that
+        don't return any documents.
+
+        :param filters: A list of Filter objects.
+        :return: A list of counts, one per Filter.
+        """
+        counts = [0] * len(filters)
+        searches = []
+        for i, filter in enumerate(filters):
+            if filter is not None and filter.match_nothing is True:
+                # We already know that the filter should match nothing.
+                continue
+            search = self.create_search_doc(
+                query_string=None, filter=filter, pagination=None,
+                debug=False
+            )
+            searches.append((i, search.extra(size=0)))
+
+        chunk_size = self.COUNT_WORKS_CHUNK_SIZE
+        for start in range(0, len(searches), chunk_size):
+            chunk = searches[start:start+chunk_size]
+            multi = MultiSearch(using=self.__client)
+            for i, search in chunk:
+                multi = multi.add(search)
+            for (i, search), results in zip(chunk, multi.execute()):
+                counts[i] = results.hits.total
+        return counts
+
+    def bulk_update(self, works, retry_on_batch_failure=True,
+                    pipelined=False):
+        """Upload a batch of works to the search index at once.
+
+        :param retry_on_batch_failure: If every document in the batch
+            fails, try the whole batch one more time.
+        :param pipelined: If this is True, search documents are
+            generated and uploaded in chunks, and uploading one chunk
+            overlaps with generating the next. Rather than retrying the
+            whole batch, documents that fail for transient reasons are
+            retried one by one. See _upload_documents.
+
+        :return: A BulkIndexReport, which can be unpacked into a 2-tuple
+            (successes, failures).
+        """
 
         if not works:
             # There's nothing to do. Don't bother making any requests
             # to the search index.
-            return [], []
+            return BulkIndexReport([], [])
 
         time1 = time.time()
-        needs_add = []
-        successes = []
+        if pipelined:
+            docs, success_count, errors, bytes_sent, generate_time = (
+                self._bulk_update_pipelined(works)
+            )
+            time2 = time1 + generate_time
+        else:
+            # Add/update any works that need adding/updating.
+            docs = self._search_documents(works)
+            time2 = time.time()
+
+            success_count, errors = self.bulk(
+                docs,
+                raise_on_error=False,
+                raise_on_exception=False,
+            )
+            bytes_sent = sum(len(json.dumps(doc)) for doc in docs)
+
+            # If the entire update failed, try it one more time before
+            # giving up on the batch.
+            if len(errors) == len(docs):
+                if retry_on_batch_failure:
+                    self.log.info("Elasticsearch bulk update timed out, trying again.")
+                    return self.bulk_update(works, retry_on_batch_failure=False)
+                else:
+                    docs = []
+        time3 = time.time()
+
+        # Match up the documents and errors with the works they came
+        # from.
+        works_by_id = dict()
         for work in works:
-            needs_add.append(work)
+            works_by_id.setdefault(work.id, work)
+        doc_ids = set(self._document_id(d['_id']) for d in docs)
 
-        # Add/update any works that need adding/updating.
-        docs = Work.to_search_documents(needs_add)
+        report = BulkIndexReport(
+            [], [], documents=len(docs), bytes_sent=bytes_sent,
+            timings=dict(generate=time2-time1, upload=time3-time2)
+        )
+        error_ids = set()
+        error_failures = []
+        for error in errors:
+            error_id = self._bulk_error_id(error)
+            error_ids.add(error_id)
+            report.error_counts[self._bulk_error_type(error)] += 1
+
+            error_message = error.get('error', None)
+            if not error_message:
+                error_message = self._bulk_error_info(error).get('error', None)
+            error_failures.append((works_by_id.get(error_id), error_message))
 
+        for work in works:
+            if work.id in error_ids:
+                continue
+            if work.id in doc_ids:
+                report.successes.append(work)
+            else:
+                # We weren't able to create a search document for
+                # this work, maybe because it doesn't have a
+                # presentation edition yet.
+                report.failures.append((work, "Work not indexed"))
+                report.missing += 1
+        report.failures.extend(error_failures)
+
+        report.timings['reconcile'] = time.time() - time3
+        self.log.info(report.summary)
+        self._record_rebuild_progress(report)
+        return report
+
+    def _search_documents(self, works):
+        """Generate search documents for the given works, ready to be
+        passed into bulk().
+        """
+        docs = Work.to_search_documents(works)
         for doc in docs:
             doc["_index"] = self.works_index
             doc["_type"] = self.work_document_type
-        time2 = time.time()
+        return docs
 
-        success_count, errors = self.bulk(
-            docs,
-            raise_on_error=False,
-            raise_on_exception=False,
-        )
+    def _bulk_update_pipelined(self, works):
+        """Generate search documents in chunks, uploading each chunk
+        in a background thread while the next one is generated.
 
-        # If the entire update failed, try it one more time before
-        # giving up on the batch.
-        if len(errors) == len(docs):
-            if retry_on_batch_failure:
-                self.log.info("Elasticsearch bulk update timed out, trying again.")
-                return self.bulk_update(needs_add, retry_on_batch_failure=False)
-            else:
-                docs = []
+        :return: A 5-tuple (documents, success count, errors, bytes
+            sent, seconds spent generating documents).
+        """
+        pool = self._bulk_upload_thread_pool()
+        try:
+            docs = []
+            uploads = []
+            generate_time = 0
+            chunk_size = self.BULK_UPDATE_CHUNK_SIZE
+            for i in range(0, len(works), chunk_size):
+                # Documents are generated in this thread, since that
+                # requires the database.
+                a = time.time()
+                chunk_docs = self._search_documents(works[i:i+chunk_size])
+                generate_time += time.time() - a
+                docs.extend(chunk_docs)
+                uploads.append(
+                    pool.apply_async(self._upload_documents, (chunk_docs,))
+                )
 
-        time3 = time.time()
-        self.log.info("Created %i search documents in %.2f seconds" % (len(docs), time2 - time1))
-        self.log.info("Uploaded %i search documents in  %.2f seconds" % (len(docs), time3 - time2))
+            success_count = 0
+            errors = []
+            bytes_sent = 0
+            for upload in uploads:
+                upload_success_count, upload_errors, upload_bytes = upload.get()
+                success_count += upload_success_count
+                errors.extend(upload_errors)
+                bytes_sent += upload_bytes
+        finally:
+            # The pool's threads are only needed for the duration of
+            # this update.
+            pool.close()
+            pool.join()
+        return docs, success_count, errors, bytes_sent, generate_time
+
+    def _bulk_upload_thread_pool(self):
+        """Create the pool of threads that upload the documents for
+        one pipelined bulk update.
+        """
+        return ThreadPool(self.BULK_UPLOAD_THREADS)
 
-        doc_ids = [d['_id'] for d in docs]
+    def _upload_documents(self, docs):
+        """Upload search documents in bulk requests of limited size.
 
-        # We weren't able to create search documents for these works, maybe
-        # because they don't have presentation editions yet.
-        def get_error_id(error):
-            return error.get('data', {}).get('_id', None) or error.get('index', {}).get('_id', None)
-        error_ids = [get_error_id(error) for error in errors]
+        Documents that fail for transient reasons are retried, with
+        exponential backoff.
 
-        missing_works = [
-            work for work in works
-            if work.id not in doc_ids and work.id not in error_ids
-            and work not in successes
-        ]
+        :return: A 3-tuple (success count, errors, bytes sent). The
+            first two are in the format returned by bulk().
+        """
+        success_count = 0
+        bytes_sent = 0
+        permanent_errors = []
+        backoff = self.BULK_UPLOAD_INITIAL_BACKOFF
+        for attempt in range(self.BULK_UPLOAD_MAX_RETRIES + 1):
+            errors = []
+            for request, request_size in self._bulk_requests(docs):
+                request_success_count, request_errors = self.bulk(
+                    request,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                )
+                success_count += request_success_count
+                bytes_sent += request_size
+                errors.extend(request_errors)
 
-        successes.extend(
-            [work for work in works
-             if work.id in doc_ids and work.id not in error_ids]
-        )
+            retry_ids = set(
+                self._bulk_error_id(error) for error in errors
+                if self._is_transient_bulk_error(error)
+            )
+            if not retry_ids or attempt == self.BULK_UPLOAD_MAX_RETRIES:
+                return success_count, permanent_errors + errors, bytes_sent
 
-        failures = []
-        for missing in missing_works:
-            failures.append((work, "Work not indexed"))
+            permanent_errors.extend(
+                error for error in errors
+                if self._bulk_error_id(error) not in retry_ids
+            )
+            docs = [
+                doc for doc in docs
+                if self._document_id(doc['_id']) in retry_ids
+            ]
+            self.log.info(
+                "Retrying %d search documents in %d seconds.",
+                len(docs), backoff
+            )
+            time.sleep(backoff)
+            backoff *= 2
 
+    def _bulk_requests(self, docs):
+        """Split a list of search documents into bulk requests of no
+        more than about BULK_UPLOAD_MAX_BYTES each.
+
+        :yield: A sequence of (documents, size in bytes) 2-tuples.
+        """
+        request = []
+        request_size = 0
+        for doc in docs:
+            doc_size = len(json.dumps(doc))
+            if request and request_size + doc_size > self.BULK_UPLOAD_MAX_BYTES:
+                yield request, request_size
+                request = []
+                request_size = 0
+            request.append(doc)
+            request_size += doc_size
+        if request:
+            yield request, request_size
+
+    def update_availability(self, works):
+        """Update only the availability information -- the
+        'licensepools' section and 'last_update_time' -- in these
+        Works' search documents.
+
+        This is much cheaper than bulk_update, both for the database
+        and for the search index.
+
+        :return: A BulkIndexReport, as with bulk_update. A Work whose
+            search document isn't in the index yet is registered for a
+            full reindex and counted as a success.
+        """
+        if not works:
+            return BulkIndexReport([], [])
+
+        time1 = time.time()
+        actions = []
+        for doc in Work.to_availability_search_documents(works):
+            actions.append(
+                dict(
+                    _op_type="update", _index=self.works_index,
+                    _type=self.work_document_type, _id=doc['_id'],
+                    doc=dict(
+                        licensepools=doc['licensepools'],
+                        last_update_time=doc['last_update_time'],
+                    )
+                )
+            )
+        time2 = time.time()
+        success_count, errors, bytes_sent = self._upload_documents(actions)
+        time3 = time.time()
+
+        report = BulkIndexReport(
+            [], [], documents=len(actions), bytes_sent=bytes_sent,
+            timings=dict(generate=time2-time1, upload=time3-time2)
+        )
+        works_by_id = dict((work.id, work) for work in works)
+        failed_ids = set()
         for error in errors:
+            error_id = self._bulk_error_id(error)
+            work = works_by_id.get(error_id)
+            info = self._bulk_error_info(error)
+            report.error_counts[self._bulk_error_type(error)] += 1
+            if work and info.get('status') == 404:
+                # There's nothing to update. The whole document
+                # needs to be created.
+                work.external_index_needs_updating()
+                continue
+            failed_ids.add(error_id)
+            report.failures.append(
+                (work, info.get('error', error.get('error')))
+            )
 
-            error_id = get_error_id(error)
-            work = None
-            works_with_error = [work for work in works if work.id == error_id]
-            if works_with_error:
-                work = works_with_error[0]
+        # A Work with no search document to update -- maybe because
+        # it doesn't have a presentation edition yet -- doesn't count
+        # as a failure. The full reindex will take care of it.
+        report.successes.extend(
+            work for work in works if work.id not in failed_ids
+        )
+        self.log.info("Availability update: %s", report.summary)
+        return report
 
-            exception = error.get('exception', None)
-            error_message = error.get('error', None)
-            if not error_message:
-                error_message = error.get('index', {}).get('error', None)
+    @classmethod
+    def _bulk_error_info(cls, error):
+        """Find the details of an error in a bulk request, which are
+        keyed by the type of operation that failed.
+        """
+        for op_type in ('index', 'update', 'create', 'delete'):
+            if op_type in error:
+                return error[op_type]
+        return {}
 
-            failures.append((work, error_message))
+    @classmethod
+    def _bulk_error_id(cls, error):
+        """Find the ID of the document that caused an error in a bulk
+        update.
 
-        self.log.info("Successfully indexed %i documents, failed to index %i." % (success_count, len(failures)))
+        :return: A work ID, if the document ID is one.
+        """
+        error_id = error.get('data', {}).get('_id', None)
+        if error_id is None:
+            error_id = cls._bulk_error_info(error).get('_id', None)
+        return cls._document_id(error_id)
 
-        return successes, failures
+    @classmethod
+    def _document_id(cls, value):
+        """Normalize the ID of a search document.
+
+        Elasticsearch echoes document IDs back as strings, but search
+        documents are created with work IDs, which are integers.
+        """
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+    @classmethod
+    def _bulk_error_type(cls, error):
+        """Classify an error from a bulk update, for reporting
+        purposes.
+        """
+        info = cls._bulk_error_info(error)
+        detail = info.get('error', None)
+        if isinstance(detail, dict) and detail.get('type'):
+            return detail['type']
+        exception = error.get('exception', None) or info.get('exception', None)
+        if exception and not isinstance(exception, basestring):
+            exception = exception.__class__.__name__
+        return exception or str(info.get('status', 'unknown'))
+
+    @classmethod
+    def _is_transient_bulk_error(cls, error):
+        """Is this error from a bulk update likely to go away if the
+        document is sent again?
+        """
+        status = cls._bulk_error_info(error).get('status', None)
+        return status in cls.TRANSIENT_BULK_ERROR_STATUSES
 
     def remove_work(self, work):
         """Remove the search document for `work` from the search index.
@@ -927,7 +2008,7 @@ class CurrentMapping(Mapping):
     * contributors -- these Contributors worked on the Work
     """
 
-    VERSION_NAME = "v4"
+    VERSION_NAME = "v5"
 
     # Use regular expressions to normalized values in sortable fields.
     # These regexes are applied in order; that way "H. G. Wells"
@@ -1121,11 +2202,17 @@ class CurrentMapping(Mapping):
         licensepool_fields = {
             'integer': ['collection_id', 'data_source_id'],
             'long': ['availability_time'],
-            'boolean': ['available', 'open_access', 'suppressed', 'licensed'],
-            'keyword': ['medium'],
+            'boolean': [
+                'available', 'open_access', 'suppressed', 'superceded',
+                'licensed', 'open_access_link'
+            ],
+            'keyword': ['medium', 'identifier_type', 'identifier'],
         }
         licensepools.add_properties(licensepool_fields)
 
+        # The cached OPDS entry is only ever retrieved, never searched.
+        self.add_property('opds_entry', 'text', index=False)
+
         identifiers = self.subdocument("identifiers")
         identifier_fields = {
             'keyword': ['identifier', 'type']
@@ -2124,6 +3211,53 @@ class Filter(SearchBase):
         Contributor.DIRECTOR_ROLE, Contributor.ACTOR_ROLE
     ]
 
+    # Optional in-process caches that save the work of creating
+    # Filters for Lanes and turning Filters into Elasticsearch DSL.
+    # They're disabled by default; call configure_cache() to enable
+    # them.
+    worklist_cache = None
+    build_cache = None
+
+    # Defaults for the in-process caches.
+    CACHE_MAX_ENTRIES = 1000
+    CACHE_TTL = 300
+
+    @classmethod
+    def configure_cache(cls, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        """Enable (or disable) the in-process caches used when
+        building Filters.
+
+        One cache keeps the restrictions a Lane places on its works
+        (including those inherited from its parents), so that they're
+        not recalculated from the database on every request. Entries
+        are keyed on the time the site configuration last changed, so
+        changing a Lane, Library or Collection makes them obsolete.
+        Since some restrictions (such as the set of CustomLists from a
+        given DataSource) can change without the site configuration
+        changing, an entry is kept for at most `ttl` seconds.
+
+        The other cache keeps the Elasticsearch DSL generated by
+        build(). It's keyed on everything build() looks at, so it
+        never goes stale.
+
+        :param max_entries: The maximum number of entries to keep in
+            each cache. If this is zero or None, the caches are
+            disabled.
+        :param ttl: The maximum number of seconds a Lane's restrictions
+            will be kept.
+        """
+        if not max_entries:
+            cls.worklist_cache = cls.build_cache = None
+            return
+        cls.worklist_cache = LRUCache(max_entries=max_entries, ttl=ttl)
+        cls.build_cache = LRUCache(max_entries=max_entries)
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Forget the restrictions cached for every Lane."""
+        if cls.worklist_cache is not None:
+            cls.worklist_cache.clear()
+
     @classmethod
     def from_worklist(cls, _db, worklist, facets):
         """Create a Filter that finds only works that belong in the given
@@ -2132,6 +3266,32 @@ class Filter(SearchBase):
         :param worklist: A WorkList
         :param facets: A SearchFacets object.
         """
+        cache = cls.worklist_cache
+        key = None
+        arguments = None
+        if cache is not None and isinstance(worklist, Lane) and worklist.id:
+            key = (
+                worklist.id, Configuration._site_configuration_last_update()
+            )
+            arguments = cache.get(key)
+        if arguments is None:
+            arguments = cls._worklist_arguments(_db, worklist)
+            if key is not None:
+                cache.set(key, arguments)
+
+        # The Filter might be modified once it's created, so it can't
+        # share any lists with the cached arguments.
+        arguments = copy.deepcopy(arguments)
+        return cls(facets=facets, **arguments)
+
+    @classmethod
+    def _worklist_arguments(cls, _db, worklist):
+        """Find the restrictions the given WorkList places on its works.
+
+        :return: A dictionary of keyword arguments to the Filter
+            constructor. Database objects are replaced by their IDs so
+            the dictionary can be cached.
+        """
         library = worklist.get_library(_db)
         # For most configuration settings there is a single value --
         # either defined on the WorkList or defined by its parent.
@@ -2164,12 +3324,27 @@ class Filter(SearchBase):
             allow_holds = True
         else:
             allow_holds = library.allow_holds
-        return cls(
-            collections, media, languages, fiction, audiences,
-            target_age, genre_id_restrictions, customlist_id_restrictions,
-            facets,
-            excluded_audiobook_data_sources=excluded_audiobook_data_sources,
-            allow_holds=allow_holds, license_datasource=license_datasource_id
+        if isinstance(collections, Library):
+            collections = collections.collections
+        if target_age and not isinstance(target_age, (int, tuple)):
+            target_age = numericrange_to_tuple(target_age)
+
+        filter_ids = cls._filter_ids
+        return dict(
+            collections=filter_ids(collections), media=media,
+            languages=languages, fiction=fiction, audiences=audiences,
+            target_age=target_age,
+            genre_restriction_sets=[
+                filter_ids(x) for x in genre_id_restrictions
+            ],
+            customlist_restriction_sets=[
+                filter_ids(x) for x in customlist_id_restrictions
+            ],
+            excluded_audiobook_data_sources=filter_ids(
+                excluded_audiobook_data_sources
+            ),
+            allow_holds=allow_holds,
+            license_datasource=filter_ids(license_datasource_id)
         )
 
     def __init__(self, collections=None, media=None, languages=None,
@@ -2249,6 +3424,10 @@ class Filter(SearchBase):
         :param match_nothing: If this is set to True, the search will
         not even be performed -- we know for some other reason that an
         empty set of search results should be returned.
+
+        :param search_only: If this is set to True, the search results
+        will include enough information to build OPDS feeds without
+        going to the database. See HitBackedWork.
         """
 
         if isinstance(collections, Library):
@@ -2306,6 +3485,8 @@ class Filter(SearchBase):
 
         self.match_nothing = kwargs.pop('match_nothing', False)
 
+        self.search_only = kwargs.pop('search_only', False)
+
         license_datasources = kwargs.pop('license_datasource', None)
         self.license_datasources = self._filter_ids(license_datasources)
 
@@ -2394,7 +3575,65 @@ class Filter(SearchBase):
         :param _chain_filters: Mock function to use instead of
             Filter._chain_filters
         """
+        cache = self.build_cache
+        key = None
+        if cache is not None and not _chain_filters:
+            key = self._build_cache_key()
+        if key is not None:
+            built = cache.get(key)
+            if built is None:
+                built = self._build()
+                cache.set(key, built)
+            f, nested_filters = built
+
+            # The caller may add to the nested filters, so they can't
+            # be shared with the cache.
+            copied = defaultdict(list)
+            for path, filters in nested_filters.items():
+                copied[path] = list(filters)
+            return f, copied
+        return self._build(_chain_filters)
+
+    def _build_cache_key(self):
+        """Find a key that identifies the DSL build() would generate
+        for this Filter.
+
+        :return: A hashable object, or None if the DSL for this Filter
+            shouldn't be cached.
+        """
+        if self.author is not None or self.identifiers:
+            # These restrictions are used in one-off searches, and
+            # there's no point in caching them.
+            return None
 
+        def hashable(value):
+            if isinstance(value, (list, tuple)):
+                return tuple(hashable(x) for x in value)
+            if isinstance(value, (set, frozenset)):
+                return frozenset(hashable(x) for x in value)
+            return value
+
+        filter_ids = self._filter_ids
+        return (
+            self.__class__, self.match_nothing,
+            hashable(filter_ids(self.collection_ids)),
+            hashable(filter_ids(self.license_datasources)),
+            hashable(self.media), hashable(self.languages), self.fiction,
+            self.series, hashable(self._audiences), self.target_age,
+            hashable(
+                [filter_ids(x) for x in self.genre_restriction_sets]
+            ),
+            hashable(
+                [filter_ids(x) for x in self.customlist_restriction_sets]
+            ),
+            self.availability, self.subcollection,
+            self.minimum_featured_quality,
+            hashable(self.excluded_audiobook_data_sources),
+            self.allow_holds, self.updated_after,
+        )
+
+    def _build(self, _chain_filters=None):
+        """Method that does the work of build()."""
         # Since a Filter object can be modified after it's created, we
         # need to scrub all the inputs, whether or not they were
         # scrubbed in the constructor.
@@ -3109,6 +4348,187 @@ class WorkSearchResult(object):
         return getattr(self._work, k)
 
 
+class BulkIndexReport(object):
+    """The outcome of a bulk update to the search index.
+
+    This can be unpacked into a 2-tuple (successes, failures), which is
+    what ExternalSearchIndex.bulk_update used to return.
+    """
+
+    def __init__(self, successes, failures, documents=0, bytes_sent=0,
+                 timings=None):
+        """Constructor.
+
+        :param successes: A list of Works that were indexed.
+        :param failures: A list of (Work, error message) 2-tuples.
+        :param documents: The number of search documents generated.
+        :param bytes_sent: The size of those documents, as sent to the
+            search index.
+        :param timings: A dictionary mapping the name of each phase of
+            the update to the number of seconds it took.
+        """
+        self.successes = successes
+        self.failures = failures
+        self.documents = documents
+        self.bytes_sent = bytes_sent
+        self.timings = timings or {}
+
+        # The number of works for which no search document could be
+        # generated.
+        self.missing = 0
+
+        # The number of errors of each type sent back by the search
+        # index.
+        self.error_counts = Counter()
+
+    def __iter__(self):
+        return iter((self.successes, self.failures))
+
+    @property
+    def summary(self):
+        """Summarize the report in a single line, for logging."""
+        timings = " ".join(
+            "%s=%.2fs" % (phase, seconds)
+            for phase, seconds in sorted(self.timings.items())
+        )
+        message = "%d indexed, %d failed (%d missing), %d documents, %d bytes sent; %s" % (
+            len(self.successes), len(self.failures), self.missing,
+            self.documents, self.bytes_sent, timings
+        )
+        if self.error_counts:
+            message += "; errors: " + ", ".join(
+                "%s=%d" % (error_type, count)
+                for error_type, count in self.error_counts.most_common()
+            )
+        return message
+
+
+def _hit_value(hit, key, default=None):
+    """Look up a value in a search result (or a subdocument of one),
+    which may be missing.
+    """
+    try:
+        return hit[key]
+    except KeyError:
+        return default
+
+
+def _hit_time(hit, key):
+    """Convert a timestamp stored in a search document to a datetime."""
+    value = _hit_value(hit, key)
+    if value is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(value)
+
+
+class HitBackedWork(object):
+    """A lightweight stand-in for a Work, built entirely from a search
+    result.
+
+    This has just enough information to put the Work in an OPDS feed
+    using its cached OPDS entry, so a feed can be built without
+    loading any Works from the database. It only works with an
+    Annotator that uses the simple OPDS entry and doesn't need
+    anything from the database beyond what's here.
+    """
+
+    # A stand-in for the Work's presentation Edition.
+    Edition = namedtuple('Edition', ['title', 'medium', 'primary_identifier'])
+
+    @classmethod
+    def from_hit(cls, _db, hit, collection_ids=None):
+        """Build a HitBackedWork from a search result, if possible.
+
+        :param collection_ids: Ignore LicensePools that aren't in one of
+            these Collections.
+        :return: A HitBackedWork, or None if the search result doesn't
+            include a cached OPDS entry.
+        """
+        if not _hit_value(hit, 'opds_entry'):
+            return None
+        return cls(_db, hit, collection_ids)
+
+    def __init__(self, _db, hit, collection_ids=None):
+        self._hit = hit
+        self.id = self.work_id = hit['work_id']
+        self.simple_opds_entry = hit['opds_entry']
+        self.verbose_opds_entry = None
+        self.last_update_time = _hit_time(hit, 'last_update_time')
+
+        self.license_pools = []
+        for pool in _hit_value(hit, 'licensepools') or []:
+            if (collection_ids is not None
+                and pool['collection_id'] not in collection_ids):
+                continue
+            self.license_pools.append(HitBackedLicensePool(_db, self, pool))
+
+        identifier = None
+        if self.license_pools:
+            identifier = self.license_pools[0].identifier
+        self.presentation_edition = self.Edition(
+            title=_hit_value(hit, 'title'), medium=_hit_value(hit, 'medium'),
+            primary_identifier=identifier
+        )
+
+    def active_license_pool(self):
+        """Choose a LicensePool the same way Work.active_license_pool
+        does.
+
+        Suppressed LicensePools are also skipped, since a Work can't be
+        found in a search through a suppressed LicensePool.
+        """
+        active_license_pool = None
+        edition = self.presentation_edition
+        for pool in self.license_pools:
+            if pool.superceded or pool.suppressed:
+                continue
+            if pool.open_access:
+                if pool.open_access_link:
+                    active_license_pool = pool
+                    # We have an unlimited source for this book.
+                    # There's no need to keep looking.
+                    break
+            elif edition.title and pool.licensed:
+                active_license_pool = pool
+        return active_license_pool
+
+    def __repr__(self):
+        return "<HitBackedWork #%s>" % self.id
+
+
+class HitBackedLicensePool(object):
+    """A lightweight stand-in for a LicensePool, built from the
+    'licensepools' section of a search result.
+    """
+
+    def __init__(self, _db, work, pool):
+        self.work = work
+        self.id = pool['licensepool_id']
+        self.collection_id = pool['collection_id']
+        self.open_access = pool['open_access']
+        self.suppressed = _hit_value(pool, 'suppressed', False)
+        self.superceded = _hit_value(pool, 'superceded', False)
+        self.licensed = _hit_value(pool, 'licensed', False)
+
+        # Whether LicensePool.best_open_access_link had been found
+        # when the search document was created.
+        self.open_access_link = _hit_value(pool, 'open_access_link', False)
+        self.available = _hit_value(pool, 'available', False)
+        self.availability_time = _hit_time(pool, 'availability_time')
+        self.data_source = DataSource.by_id(_db, pool['data_source_id'])
+
+        # This Identifier is never added to the database session; it's
+        # only used to generate a URN.
+        self.identifier = Identifier(
+            type=_hit_value(pool, 'identifier_type'),
+            identifier=_hit_value(pool, 'identifier'),
+        )
+
+    @property
+    def presentation_edition(self):
+        return self.work.presentation_edition
+
+
 class MockExternalSearchIndex(ExternalSearchIndex):
 
     work_document_type = 'work-type'
@@ -3120,6 +4540,7 @@ class MockExternalSearchIndex(ExternalSearchIndex):
         self.works_alias = "works-current"
         self.log = logging.getLogger("Mock external search index")
         self.queries = []
+        self.scans = []
         self.search = self.docs.keys()
         self.test_search_term = "a search term"
 
@@ -3183,7 +4604,7 @@ class MockExternalSearchIndex(ExternalSearchIndex):
             pagination.page_loaded(results)
         return results
 
-    def query_works_multi(self, queries, debug=False):
+    def query_works_multi(self, queries, debug=False, timeout=None):
         # Implement query_works_multi by calling query_works several
         # times. This is the opposite of what happens in the
         # non-mocked ExternalSearchIndex, because it's easier to mock
@@ -3194,10 +4615,32 @@ class MockExternalSearchIndex(ExternalSearchIndex):
     def count_works(self, filter):
         return len(self.docs)
 
+    def count_works_multi(self, filters):
+        return [self.count_works(filter) for filter in filters]
+
+    def scan_works(self, filter, fields=None, slices=1, batch_size=None):
+        self.scans.append((filter, fields, slices, batch_size))
+        for result in self.query_works(None, filter, None):
+            yield result
+
     def bulk(self, docs, **kwargs):
+        errors = []
         for doc in docs:
+            if doc.get('_op_type') == 'update':
+                key = self._key(doc['_index'], doc['_type'], doc['_id'])
+                if key not in self.docs:
+                    # Elasticsearch sends the ID back as a string.
+                    errors.append(
+                        dict(update=dict(
+                            _id=unicode(doc['_id']), status=404,
+                            error="document_missing_exception"
+                        ))
+                    )
+                    continue
+                self.docs[key] = dict(self.docs[key], **doc['doc'])
+                continue
             self.index(doc['_index'], doc['_type'], doc['_id'], doc)
-        return len(docs), []
+        return len(docs) - len(errors), errors
 
 class MockMeta(dict):
     """Mock the .meta object associated with an Elasticsearch search
@@ -3245,14 +4688,56 @@ class SearchIndexCoverageProvider(WorkPresentationProvider):
         search_index_client = kwargs.pop('search_index_client', None)
         super(SearchIndexCoverageProvider, self).__init__(*args, **kwargs)
         self.search_index_client = (
-            search_index_client or ExternalSearchIndex(self._db)
+            search_index_client or ExternalSearchIndex.load(self._db)
         )
 
     def process_batch(self, works):
         """
         :return: a mixed list of Works and CoverageFailure objects.
         """
-        successes, failures = self.search_index_client.bulk_update(works)
+        report = self.search_index_client.bulk_update(works, pipelined=True)
+        successes, failures = report
+
+        records = list(successes)
+        for (work, error) in failures:
+            if not isinstance(error, basestring):
+                error = repr(error)
+            records.append(CoverageFailure(work, error))
+
+        return records
+
+
+class SearchIndexAvailabilityCoverageProvider(WorkPresentationProvider):
+    """Keep the availability information in the search index up to
+    date for Works whose LicensePools have changed availability.
+
+    This only processes Works that have been registered through
+    Work.external_index_availability_needs_updating.
+    """
+
+    SERVICE_NAME = 'Search index availability coverage provider'
+
+    DEFAULT_BATCH_SIZE = 1000
+
+    OPERATION = WorkCoverageRecord.UPDATE_SEARCH_INDEX_AVAILABILITY_OPERATION
+
+    def __init__(self, *args, **kwargs):
+        search_index_client = kwargs.pop('search_index_client', None)
+        kwargs.setdefault('registered_only', True)
+        super(SearchIndexAvailabilityCoverageProvider, self).__init__(
+            *args, **kwargs
+        )
+        self.search_index_client = (
+            search_index_client or ExternalSearchIndex.load(self._db)
+        )
+
+    def process_batch(self, works):
+        """
+        :return: a mixed list of Works and CoverageFailure objects.
+        """
+        successes, failures = self.search_index_client.update_availability(
+            works
+        )
 
         records = list(successes)
         for (work, error) in failures:
@@ -3,6 +3,9 @@ from collections import defaultdict
 from nose.tools import set_trace
 import datetime
 import logging
+from multiprocessing import TimeoutError as ThreadPoolTimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 import time
 import urllib
 
@@ -1243,6 +1246,18 @@ class WorkList(object):
     # By default, a WorkList does not draw from CustomLists
     uses_customlists = False
 
+    # When building a grouped feed, the search requests for different
+    # lanes are sent at the same time, using a shared pool of this
+    # many threads. If this is zero, they're sent one at a time.
+    GROUPS_THREAD_POOL_SIZE = 8
+
+    # When building a grouped feed, give up on the search results for
+    # a lane if they haven't arrived after this many seconds. The feed
+    # will be built without that lane's works.
+    GROUPS_LANE_TIMEOUT = 10
+
+    _groups_thread_pool = None
+
     def max_cache_age(self, type):
         """Determine how long a feed for this WorkList should be cached
         internally.
@@ -1651,7 +1666,7 @@ class WorkList(object):
             yield work, worklist
 
     def works(self, _db, facets=None, pagination=None, search_engine=None,
-              debug=False, **kwargs):
+              debug=False, search_only=False, **kwargs):
 
         """Use a search engine to obtain Work or Work-like objects that belong
         in this WorkList.
@@ -1665,6 +1680,9 @@ class WorkList(object):
         :param pagination: A Pagination object indicating which part of
            the WorkList the caller is looking at, and/or a limit on the
            number of works to fetch.
+        :param search_only: If this is True, then wherever possible
+           the works will be HitBackedWork objects built from the
+           search results, rather than Works loaded from the database.
         :param kwargs: Different implementations may fetch the
            list of works from different sources and may need different
            keyword arguments.
@@ -1678,11 +1696,48 @@ class WorkList(object):
         )
         search_engine = search_engine or ExternalSearchIndex.load(_db)
         filter = self.filter(_db, facets)
+        extra_kwargs = dict()
+        if search_only:
+            filter.search_only = True
+            extra_kwargs['search_only'] = True
         hits = search_engine.query_works(
             query_string=None, filter=filter, pagination=pagination,
             debug=debug
         )
-        return self.works_for_hits(_db, hits, facets=facets)
+        return self.works_for_hits(_db, hits, facets=facets, **extra_kwargs)
+
+    def iter_all_works(self, _db, facets=None, search_engine=None,
+                       batch_size=500, slices=1):
+        """Iterate over every Work in this WorkList.
+
+        Unlike paging through works() with a Pagination, this makes a
+        single pass through the search index, so it's suitable for
+        exporting the contents of a large WorkList.
+
+        :param facets: A Facets object which may put additional
+           constraints on WorkList membership.
+        :param batch_size: Search results are retrieved, and Works
+           loaded from the database, this many at a time.
+        :param slices: Scan the search index in this many parallel
+           slices.
+        :yield: A sequence of Work objects, in no particular order.
+        """
+        from external_search import ExternalSearchIndex
+        search_engine = search_engine or ExternalSearchIndex.load(_db)
+        filter = self.filter(_db, facets)
+        hits = search_engine.scan_works(
+            filter, slices=slices, batch_size=batch_size
+        )
+        batch = []
+        for hit in hits:
+            batch.append(hit)
+            if len(batch) >= batch_size:
+                for work in self.works_for_hits(_db, batch, facets=facets):
+                    yield work
+                batch = []
+        if batch:
+            for work in self.works_for_hits(_db, batch, facets=facets):
+                yield work
 
     def filter(self, _db, facets):
         """Helper method to instantiate a Filter object for this WorkList.
@@ -1707,7 +1762,7 @@ class WorkList(object):
         """
         return filter
 
-    def works_for_hits(self, _db, hits, facets=None):
+    def works_for_hits(self, _db, hits, facets=None, search_only=False):
         """Convert a list of search results into Work objects.
 
         This works by calling works_for_resultsets() on a list
@@ -1715,27 +1770,49 @@ class WorkList(object):
 
         :param _db: A database connection
         :param hits: A list of Hit objects from ElasticSearch.
+        :param search_only: See works_for_resultsets().
         :return: A list of Work or (if the search results include
             script fields), WorkSearchResult objects.
         """
 
-        [results] = self.works_for_resultsets(_db, [hits], facets=facets)
+        [results] = self.works_for_resultsets(
+            _db, [hits], facets=facets, search_only=search_only
+        )
         return results
 
-    def works_for_resultsets(self, _db, resultsets, facets=None):
+    def works_for_resultsets(self, _db, resultsets, facets=None,
+                             search_only=False):
         """Convert a list of lists of Hit objects into a list
         of lists of Work objects.
+
+        :param search_only: If this is True, a Hit that contains a
+            cached OPDS entry is turned into a HitBackedWork instead of
+            being looked up in the database.
         """
         from external_search import (
+            ExternalSearchIndex,
             Filter,
+            HitBackedWork,
             WorkSearchResult,
         )
 
+        hit_backed = dict()
+        if search_only:
+            collection_ids = self.collection_ids
+            if collection_ids is not None:
+                collection_ids = set(collection_ids)
+            for resultset in resultsets:
+                for result in resultset:
+                    work = HitBackedWork.from_hit(_db, result, collection_ids)
+                    if work is not None:
+                        hit_backed[work.id] = work
+
         has_script_fields = None
         work_ids = set()
         for resultset in resultsets:
             for result in resultset:
-                work_ids.add(result.work_id)
+                if result.work_id not in hit_backed:
+                    work_ids.add(result.work_id)
                 if has_script_fields is None:
                     # We don't know whether any script fields were
                     # included, and now we're in a position to find
@@ -1759,17 +1836,24 @@ class WorkList(object):
         # If facets were passed in, then they are used to further
         # filter the list.
         #
-        # TODO: There's a lot of room for improvement here, but
-        # performance isn't a big concern -- it's just ugly.
-        wl = SpecificWorkList(work_ids)
-        wl.initialize(self.get_library(_db))
-        qu = wl.works_from_database(_db, facets=facets)
+        # The query eagerly loads everything needed to build OPDS
+        # entries for these Works, so the number of queries doesn't
+        # depend on the number of Works.
         a = time.time()
-        all_works = qu.all()
+        all_works = []
+        if work_ids:
+            wl = SpecificWorkList(work_ids)
+            wl.initialize(self.get_library(_db))
+            qu = wl.works_from_database(_db, facets=facets)
+            all_works = qu.all()
+            LicensePool.preload_open_access_links(
+                _db,
+                [pool for work in all_works for pool in work.license_pools]
+            )
 
         # Create a list of lists with the same membership as the original
         # `resultsets`, but with Hit objects replaced with Work objects.
-        work_by_id = dict()
+        work_by_id = dict(hit_backed)
         for w in all_works:
             work_by_id[w.id] = w
 
@@ -1790,6 +1874,7 @@ class WorkList(object):
         logging.info(
             u"Obtained %sxWork in %.2fsec", len(all_works), b-a
         )
+        ExternalSearchIndex.record_hydration(b-a, len(all_works))
         return work_lists
 
     @property
@@ -1873,14 +1958,83 @@ class WorkList(object):
             parent_lane = None
 
         queryable_lane_set = set(queryable_lanes)
-        works_and_lanes = list(
-            self._featured_works_with_lanes(
-                _db, queryable_lanes, facets=facets,
-                pagination=pagination, search_engine=search_engine,
-                debug=debug
-            )
+
+        # A Lane that isn't queryable along with the others still gets
+        # its featured works from the search engine, through a
+        # separate query of its own. Any other WorkList is asked for
+        # its featured works once the search requests have been sent.
+        separate_lanes = []
+        for lane in relevant_lanes:
+            if (lane not in queryable_lane_set and isinstance(lane, Lane)
+                and lane.include_self_in_grouped_feed):
+                separate_lanes.append(lane)
+        separate_lane_set = set(separate_lanes)
+
+        works_and_lanes = self._featured_works_with_lanes(
+            _db, queryable_lanes, facets=facets,
+            pagination=pagination, search_engine=search_engine,
+            debug=debug, separate_lanes=separate_lanes
         )
 
+        # While the search engine is busy, find featured works for
+        # the lanes that can't be handled through a search query.
+        by_worklist = dict()
+        for lane in relevant_lanes:
+            if (lane not in queryable_lane_set
+                and not isinstance(lane, Lane)):
+                # We didn't try to use the main query to find results
+                # for this lane because we knew the results, if there
+                # were any, wouldn't be representative. This is most
+                # likely because this 'lane' is a WorkList and not a
+                # Lane at all. Do a whole separate query and plug it
+                # in at this point.
+                by_worklist[lane] = list(
+                    lane.groups(
+                        _db, include_sublanes=False, facets=facets,
+                    )
+                )
+
+        # Now gather the search results. Works in the queryable lanes
+        # are deduplicated against each other; each separately
+        # queried lane is deduplicated on its own, just as it would
+        # be if its groups() method had been called.
+        shared = []
+        separate = defaultdict(list)
+        for work, lane in works_and_lanes:
+            if lane in separate_lane_set:
+                separate[lane].append((work, lane))
+            else:
+                shared.append((work, lane))
+        by_lane = self._distribute_featured_works(shared, target_size)
+        for lane in separate_lanes:
+            by_lane.update(
+                self._distribute_featured_works(
+                    separate[lane],
+                    lane.get_library(_db).featured_lane_size
+                )
+            )
+
+        for lane in relevant_lanes:
+            if lane in queryable_lane_set or lane in separate_lane_set:
+                # We found results for this lane through a search
+                # query. Yield those results.
+                for work in by_lane.get(lane, []):
+                    yield (work, lane)
+            else:
+                for x in by_worklist.get(lane, []):
+                    yield x
+
+    @classmethod
+    def _distribute_featured_works(cls, works_and_lanes, target_size):
+        """Fill each lane with up to `target_size` featured works,
+        avoiding the use of the same work in more than one lane as
+        much as possible.
+
+        :param works_and_lanes: A sequence of (Work, Lane) 2-tuples, with
+            all the works for a given lane grouped together, in order
+            of preference.
+        :return: A dictionary mapping each Lane to a list of Works.
+        """
         def _done_with_lane(lane):
             """Called when we're done with a Lane, either because
             the lane changes or we've reached the end of the list.
@@ -1923,31 +2077,23 @@ class WorkList(object):
                 used_works_this_lane.add(work.id)
 
         # Close out the last lane encountered.
-        _done_with_lane(working_lane)
-        for lane in relevant_lanes:
-            if lane in queryable_lane_set:
-                # We found results for this lane through the main query.
-                # Yield those results.
-                for work in by_lane.get(lane, []):
-                    yield (work, lane)
-            else:
-                # We didn't try to use the main query to find results
-                # for this lane because we knew the results, if there
-                # were any, wouldn't be representative. This is most
-                # likely because this 'lane' is a WorkList and not a
-                # Lane at all. Do a whole separate query and plug it
-                # in at this point.
-                for x in lane.groups(
-                    _db, include_sublanes=False, facets=facets,
-                ):
-                    yield x
+        if working_lane:
+            _done_with_lane(working_lane)
+        return by_lane
 
     def _featured_works_with_lanes(
-        self, _db, lanes, facets, pagination, search_engine, debug=False
+        self, _db, lanes, facets, pagination, search_engine, debug=False,
+        separate_lanes=None
     ):
         """Find a sequence of works that can be used to
         populate this lane's grouped acquisition feed.
 
+        The search requests are sent as soon as this method is
+        called, on the thread pool returned by
+        groups_thread_pool(). Works aren't loaded from the database
+        until the return value is iterated over, so the caller can
+        do other work in the meantime.
+
         :param lanes: Classify Work objects
             as belonging to one of these WorkLists (presumably sublanes
             of `self`).
@@ -1960,12 +2106,15 @@ class WorkList(object):
            asking for the featured works in a given WorkList.
         :param debug: A debug argument passed into `search_engine` when
            running the search.
+        :param separate_lanes: Find featured works for each of these
+           Lanes as well, using a separate search request for each one.
 
-        :yield: A sequence of (Work, Lane) 2-tuples.
+        :return: An iterator over (Work, Lane) 2-tuples.
         """
-        if not lanes:
+        separate_lanes = separate_lanes or []
+        if not lanes and not separate_lanes:
             # We can't run this query at all.
-            return
+            return iter([])
 
         # Ask the search engine for works from every lane we're given.
 
@@ -1978,20 +2127,111 @@ class WorkList(object):
         # The simplest change would probably be to return a dictionary
         # mapping WorkList to Works and let the caller figure out the
         # ordering. In fact, we could start doing that now.
-        queries = []
-        for lane in lanes:
-            overview_facets = lane.overview_facets(_db, facets)
-            from external_search import Filter
-            filter = Filter.from_worklist(_db, lane, overview_facets)
-            queries.append((None, filter, pagination))
-        resultsets = list(search_engine.query_works_multi(queries))
+        requests = []
+        if lanes:
+            requests.append((lanes, pagination))
+        for lane in separate_lanes:
+            requests.append(([lane], Pagination(size=pagination.size)))
+
+        # The Filters are built here, since that may require access
+        # to the database. Only the search requests themselves are
+        # run in other threads.
+        from external_search import Filter
+        pool = self.groups_thread_pool()
+        searches = []
+        for request_lanes, request_pagination in requests:
+            queries = []
+            for lane in request_lanes:
+                overview_facets = lane.overview_facets(_db, facets)
+                filter = Filter.from_worklist(_db, lane, overview_facets)
+                queries.append((None, filter, request_pagination))
+            if pool:
+                search = pool.apply_async(
+                    _run_search_queries,
+                    (search_engine, queries, self.GROUPS_LANE_TIMEOUT)
+                )
+            else:
+                search = _run_search_queries(search_engine, queries)
+            searches.append((request_lanes, search))
+
+        return self._featured_works_from_searches(
+            _db, searches, facets, in_threads=(pool is not None)
+        )
+
+    def _featured_works_from_searches(self, _db, searches, facets,
+                                      in_threads=True):
+        """Wait for the search requests sent by _featured_works_with_lanes
+        and turn the results into Works.
+
+        A request that hasn't finished within GROUPS_LANE_TIMEOUT
+        seconds is abandoned, and its lanes get no works. The search
+        request itself is given the same timeout, so an abandoned
+        request doesn't tie up a thread in the pool.
+
+        :param searches: A list of (lanes, search) 2-tuples. If
+            `in_threads` is True, `search` is an AsyncResult that will provide a
+            list of search results for each lane; otherwise it's the
+            list of search results.
+        :yield: A sequence of (Work, Lane) 2-tuples.
+        """
+        deadline = time.time() + self.GROUPS_LANE_TIMEOUT
+        all_lanes = []
+        resultsets = []
+        for lanes, search in searches:
+            if in_threads:
+                try:
+                    search = search.get(max(0, deadline - time.time()))
+                except (ThreadPoolTimeoutError,
+                        elasticsearch.exceptions.ConnectionTimeout):
+                    logging.warn(
+                        "Timed out waiting for featured works in %s; leaving them out.",
+                        ", ".join(repr(lane.display_name) for lane in lanes)
+                    )
+                    search = [[] for lane in lanes]
+            all_lanes.extend(lanes)
+            resultsets.extend(search)
+
+        # All of the Works are loaded from the database at once.
         works = self.works_for_resultsets(_db, resultsets, facets=facets)
 
-        for i, lane in enumerate(lanes):
+        for i, lane in enumerate(all_lanes):
             results = works[i]
             for work in results:
                 yield work, lane
 
+    @classmethod
+    def groups_thread_pool(cls):
+        """The pool of threads used to send search requests for
+        grouped feeds.
+
+        The pool is shared by all WorkLists and created the first time
+        it's needed, so it's never inherited by a forked process.
+
+        :return: A ThreadPool, or None if search requests should be
+            sent one at a time.
+        """
+        if cls.GROUPS_THREAD_POOL_SIZE <= 0:
+            return None
+        with _groups_thread_pool_lock:
+            if WorkList._groups_thread_pool is None:
+                WorkList._groups_thread_pool = ThreadPool(
+                    cls.GROUPS_THREAD_POOL_SIZE
+                )
+        return WorkList._groups_thread_pool
+
+
+def _run_search_queries(search_engine, queries, timeout=None):
+    """Run a multi-query against the search engine.
+
+    This is run in a separate thread, so it must not touch the database.
+
+    :param timeout: Give up on the search request after this many seconds.
+    :return: A list of lists of search results, one per query.
+    """
+    return list(search_engine.query_works_multi(queries, timeout=timeout))
+
+_groups_thread_pool_lock = Lock()
+
 
 class DatabaseBackedWorkList(WorkList):
     """A WorkList that can get its works from the database in addition to
@@ -2104,6 +2344,9 @@ class DatabaseBackedWorkList(WorkList):
 
             joinedload(license_pool_name, "identifier"),
 
+            # This is needed to choose the active LicensePool for a Work.
+            joinedload(license_pool_name, "presentation_edition"),
+
             # These speed up the process of generating the open-access link
             # for open-access works.
             joinedload(license_pool_name, "delivery_mechanisms", "resource"),
@@ -2687,22 +2930,41 @@ class Lane(Base, DatabaseBackedWorkList):
 
     def update_size(self, _db, search_engine=None):
         """Update the stored estimate of the number of Works in this Lane."""
-        library = self.get_library(_db)
+        self.update_sizes(_db, [self], search_engine)
+
+    @classmethod
+    def update_sizes(cls, _db, lanes, search_engine=None):
+        """Update the stored estimate of the number of Works in each of
+        the given Lanes.
+
+        Every count needed (one per Lane per entry point) is sent to
+        the search index at once, rather than one at a time.
+        """
         from external_search import ExternalSearchIndex
         search_engine = search_engine or ExternalSearchIndex.load(_db)
 
         # Do the estimate for every known entry point.
-        by_entrypoint = dict()
-        for entrypoint in EntryPoint.ENTRY_POINTS:
-            facets = DatabaseBackedFacets(
-                library, FacetConstants.COLLECTION_FULL,
-                FacetConstants.AVAILABLE_ALL,
-                order=FacetConstants.ORDER_WORK_ID, entrypoint=entrypoint
-            )
-            filter = self.filter(_db, facets)
-            by_entrypoint[entrypoint.URI] = search_engine.count_works(filter)
-        self.size_by_entrypoint = by_entrypoint
-        self.size = by_entrypoint[EverythingEntryPoint.URI]
+        keys = []
+        filters = []
+        for lane in lanes:
+            library = lane.get_library(_db)
+            for entrypoint in EntryPoint.ENTRY_POINTS:
+                facets = DatabaseBackedFacets(
+                    library, FacetConstants.COLLECTION_FULL,
+                    FacetConstants.AVAILABLE_ALL,
+                    order=FacetConstants.ORDER_WORK_ID, entrypoint=entrypoint
+                )
+                keys.append((lane, entrypoint.URI))
+                filters.append(lane.filter(_db, facets))
+        counts = search_engine.count_works_multi(filters)
+
+        by_lane = defaultdict(dict)
+        for (lane, entrypoint_uri), count in zip(keys, counts):
+            by_lane[lane][entrypoint_uri] = count
+        for lane in lanes:
+            by_entrypoint = by_lane[lane]
+            lane.size_by_entrypoint = by_entrypoint
+            lane.size = by_entrypoint[EverythingEntryPoint.URI]
 
     @property
     def genre_ids(self):
@@ -2979,3 +3241,30 @@ def configuration_relevant_lifecycle_event(mapper, connection, target):
 def configuration_relevant_update(mapper, connection, target):
     if directly_modified(target):
         site_configuration_has_changed(target)
+
+
+@event.listens_for(Lane, 'after_update')
+@event.listens_for(Lane, 'after_delete')
+def lane_feeds_out_of_date(mapper, connection, target):
+    # Feeds for this lane that are cached in memory may no longer be
+    # accurate.
+    CachedFeed.invalidate_local_cache(lane_id=target.id)
+
+
+@event.listens_for(LaneGenre, 'after_insert')
+@event.listens_for(LaneGenre, 'after_delete')
+@event.listens_for(LaneGenre, 'after_update')
+def lanegenre_feeds_out_of_date(mapper, connection, target):
+    CachedFeed.invalidate_local_cache(lane_id=target.lane_id)
+
+
+@event.listens_for(Lane, 'after_update')
+@event.listens_for(Lane, 'after_delete')
+@event.listens_for(LaneGenre, 'after_insert')
+@event.listens_for(LaneGenre, 'after_delete')
+@event.listens_for(LaneGenre, 'after_update')
+def lane_filters_out_of_date(mapper, connection, target):
+    # Restrictions cached for this lane, or inherited from it by its
+    # sublanes, may no longer be accurate.
+    from external_search import Filter
+    Filter.invalidate_cache()
@@ -0,0 +1,1106 @@
+"""A search index kept in an SQLite database on local disk.
+
+This implements the same interface as ExternalSearchIndex, so small
+deployments can do without an Elasticsearch cluster. It's also a
+deterministic, network-free engine for benchmarking the Filter
+semantics used by lanes.
+
+Full-text matching is done by SQLite's FTS5 extension. The fields a
+Filter can restrict or sort on are stored in indexed columns and in
+side tables (one row per LicensePool, genre, list, identifier and
+contributor), so filtering, sorting and pagination all happen in SQL.
+The search documents themselves, the same documents that are sent to
+Elasticsearch, are only parsed for the page of results being returned.
+"""
+from collections import Counter
+import datetime
+import json
+import logging
+from nose.tools import set_trace
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from elasticsearch_dsl.response import Hit
+from flask_babel import lazy_gettext as _
+
+from classifier import Classifier
+from config import CannotLoadConfiguration
+from external_search import (
+    CurrentMapping,
+    ExternalSearchIndex,
+    Filter,
+    SortKeyPagination,
+)
+from facets import FacetConstants
+from model import (
+    Edition,
+    ExternalIntegration,
+)
+from util.stopwords import ENGLISH_STOPWORDS
+
+
+class LocalSearchIndex(ExternalSearchIndex):
+    """A search index stored in an SQLite database."""
+
+    NAME = ExternalIntegration.LOCAL_SEARCH
+
+    DATABASE_PATH_KEY = u'database_path'
+
+    SETTINGS = [
+        { "key": DATABASE_PATH_KEY, "label": _("Database file"),
+          "required": True,
+          "description": _("The search index will be stored in an SQLite database at this path. It will be created if it doesn't exist.")
+        },
+        { "key": ExternalSearchIndex.TEST_SEARCH_TERM_KEY,
+          "label": _("Test search term"),
+          "default": ExternalSearchIndex.DEFAULT_TEST_SEARCH_TERM,
+          "description": _("Self tests will use this value as the search term.")
+        }
+    ]
+
+    # Bump this whenever the tables change. An index with an older
+    # schema is emptied and recreated, and must be rebuilt.
+    SCHEMA_VERSION = 2
+
+    # The columns of the full-text index, and the weight given to a
+    # match in each column when ranking results.
+    TEXT_COLUMNS = [
+        ('title', 10.0),
+        ('subtitle', 3.0),
+        ('series', 5.0),
+        ('author', 8.0),
+        ('publisher', 1.0),
+        ('summary', 1.0),
+        ('subjects', 2.0),
+    ]
+
+    # Fields of the search document that are stored in columns of the
+    # 'works' table so they can be sorted on.
+    SORT_COLUMNS = [
+        'sort_title', 'sort_author', 'series_position', 'last_update_time'
+    ]
+
+    TABLES = [
+        "CREATE TABLE works ("
+        "work_id INTEGER PRIMARY KEY, presentation_ready INTEGER, "
+        "medium TEXT, language TEXT, fiction TEXT, audience TEXT, "
+        "series TEXT, series_position INTEGER, sort_title TEXT, "
+        "sort_author TEXT, quality REAL, target_age_lower REAL, "
+        "target_age_upper REAL, last_update_time REAL, indexed_at REAL, "
+        "document TEXT NOT NULL)",
+        "CREATE INDEX works_sort_title ON works (sort_title)",
+        "CREATE INDEX works_sort_author ON works (sort_author)",
+        "CREATE INDEX works_last_update_time ON works (last_update_time)",
+        "CREATE INDEX works_indexed_at ON works (indexed_at)",
+
+        "CREATE TABLE pools ("
+        "work_id INTEGER NOT NULL, collection_id INTEGER, "
+        "data_source_id INTEGER, medium TEXT, open_access INTEGER, "
+        "available INTEGER, licensed INTEGER, suppressed INTEGER, "
+        "availability_time REAL)",
+        "CREATE INDEX pools_work ON pools (work_id)",
+        "CREATE INDEX pools_collection ON pools (collection_id, work_id)",
+
+        "CREATE TABLE genres (work_id INTEGER NOT NULL, genre_id INTEGER)",
+        "CREATE INDEX genres_work ON genres (work_id)",
+        "CREATE INDEX genres_genre ON genres (genre_id, work_id)",
+
+        "CREATE TABLE lists ("
+        "work_id INTEGER NOT NULL, list_id INTEGER, featured INTEGER, "
+        "first_appearance REAL)",
+        "CREATE INDEX lists_work ON lists (work_id)",
+        "CREATE INDEX lists_list ON lists (list_id, work_id)",
+
+        "CREATE TABLE identifiers ("
+        "work_id INTEGER NOT NULL, type TEXT, identifier TEXT)",
+        "CREATE INDEX identifiers_work ON identifiers (work_id)",
+        "CREATE INDEX identifiers_identifier ON identifiers (identifier, type)",
+
+        "CREATE TABLE contributors ("
+        "work_id INTEGER NOT NULL, role TEXT, sort_name TEXT, "
+        "display_name TEXT, viaf TEXT, lc TEXT)",
+        "CREATE INDEX contributors_work ON contributors (work_id)",
+        "CREATE INDEX contributors_sort_name ON contributors (sort_name)",
+        "CREATE INDEX contributors_display_name ON contributors (display_name)",
+    ]
+
+    # The tables with one row per subdocument of a search document.
+    SIDE_TABLES = ['pools', 'genres', 'lists', 'identifiers', 'contributors']
+
+    WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+    # One LocalSearchIndex per database file, shared by everything in
+    # this process that calls ExternalSearchIndex.load().
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def search_integration(cls, _db):
+        """Look up the ExternalIntegration for the local search index."""
+        return ExternalIntegration.lookup(
+            _db, ExternalIntegration.LOCAL_SEARCH,
+            goal=ExternalIntegration.SEARCH_GOAL
+        )
+
+    @classmethod
+    def _configuration(cls, _db):
+        """Find the database path and test search term configured for
+        the local search integration.
+        """
+        if not _db:
+            raise CannotLoadConfiguration(
+                "Cannot load local search configuration without a database."
+            )
+        integration = cls.search_integration(_db)
+        if not integration:
+            raise CannotLoadConfiguration(
+                "No local search integration configured."
+            )
+        return (
+            integration.setting(cls.DATABASE_PATH_KEY).value,
+            integration.setting(cls.TEST_SEARCH_TERM_KEY).value
+        )
+
+    @classmethod
+    def for_integration(cls, _db):
+        """Find the LocalSearchIndex for the configured database file,
+        opening it if this process hasn't done so already.
+        """
+        path, test_search_term = cls._configuration(_db)
+        with cls._instances_lock:
+            index = cls._instances.get(path)
+            if index is None:
+                index = cls(_db, path=path, test_search_term=test_search_term)
+                cls._instances[path] = index
+        index.test_search_term = (
+            test_search_term or cls.DEFAULT_TEST_SEARCH_TERM
+        )
+        return index
+
+    def __init__(self, _db, path=None, test_search_term=None):
+        """Constructor.
+
+        ExternalSearchIndex.__init__ isn't called, since all it does is
+        connect to Elasticsearch; the attributes it sets that are
+        meaningful here are set directly.
+
+        Each call opens a new connection and makes sure the tables
+        exist. Use for_integration() to share one instance.
+
+        :param path: The path to the SQLite database. By default, this
+            is taken from the local search integration. ":memory:"
+            creates a temporary index, for use in tests.
+        """
+        self.log = logging.getLogger("Local search index")
+        if not path:
+            path, test_search_term = self._configuration(_db)
+        if not path:
+            raise CannotLoadConfiguration(
+                "No database file configured for the local search index."
+            )
+        self.test_search_term = (
+            test_search_term or self.DEFAULT_TEST_SEARCH_TERM
+        )
+        self.path = path
+        self.works_index = self.works_alias = path
+        self.mapping = CurrentMapping()
+        self.search = None
+        self.indices = None
+
+        # A connection may be used by the threads of a pipelined bulk
+        # update or a web server, but only one at a time.
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False
+        )
+        self._connection.create_function(
+            "seeded_random", 2, self._seeded_random
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._create_tables()
+
+    def _create_tables(self, drop=False):
+        with self._lock:
+            [version] = self._connection.execute(
+                "PRAGMA user_version"
+            ).fetchone()
+            if version == self.SCHEMA_VERSION and not drop:
+                return
+            for table in ['works', 'works_text'] + self.SIDE_TABLES:
+                self._connection.execute("DROP TABLE IF EXISTS %s" % table)
+            for statement in self.TABLES:
+                self._connection.execute(statement)
+            try:
+                self._connection.execute(
+                    "CREATE VIRTUAL TABLE works_text "
+                    "USING fts5(%s, tokenize='porter unicode61 remove_diacritics 1')"
+                    % ", ".join(name for name, weight in self.TEXT_COLUMNS)
+                )
+            except sqlite3.OperationalError, e:
+                raise CannotLoadConfiguration(
+                    "This version of SQLite can't be used for the local search index: %s" % e
+                )
+            self._connection.execute(
+                "PRAGMA user_version=%d" % self.SCHEMA_VERSION
+            )
+            self._connection.commit()
+
+    def setup_index(self, new_index=None, **index_settings):
+        """Remove every document from the index."""
+        self._create_tables(drop=True)
+
+    def transfer_current_alias(self, _db, new_index):
+        """There are no aliases; searches always go to the same database."""
+        pass
+
+    def start_rebuild(self, _db, new_index=None):
+        """Start reindexing every work.
+
+        Documents keep being written to the same database, and
+        searches keep working while the rebuild goes on.
+
+        :return: None; there are no index settings to restore.
+        """
+        self.rebuild_progress = Counter(started=time.time())
+        return None
+
+    def finish_rebuild(self, _db, restore_settings):
+        """Remove the documents that weren't reindexed during the
+        rebuild, and merge the full-text index.
+
+        :return: The running totals kept during the rebuild.
+        """
+        progress = self.rebuild_progress
+        with self._lock:
+            if progress:
+                stale = [
+                    work_id for [work_id] in self._connection.execute(
+                        "SELECT work_id FROM works WHERE indexed_at < ?",
+                        (progress['started'],)
+                    )
+                ]
+                self._delete(stale)
+                self.log.info("Removed %d stale documents.", len(stale))
+            self._connection.execute(
+                "INSERT INTO works_text(works_text) VALUES('optimize')"
+            )
+            self._connection.commit()
+        if progress:
+            self.log.info(
+                "Rebuilt index %s: %s", self.path,
+                self._rebuild_progress_summary(progress)
+            )
+        self.rebuild_progress = None
+        return progress
+
+    # Storing documents.
+
+    def bulk(self, docs, **kwargs):
+        """Store search documents, in the same way as the Elasticsearch
+        bulk helper.
+
+        :param docs: A list of search documents, or of partial updates
+            to existing documents (with _op_type="update").
+        :return: A 2-tuple (success count, errors).
+        """
+        success_count = 0
+        errors = []
+        now = time.time()
+        with self._lock:
+            for doc in docs:
+                work_id = int(doc['_id'])
+                if doc.get('_op_type') == 'update':
+                    existing = self._document(work_id)
+                    if existing is None:
+                        errors.append(
+                            dict(update=dict(
+                                _id=unicode(work_id), status=404,
+                                error="document_missing_exception"
+                            ))
+                        )
+                        continue
+                    existing.update(doc['doc'])
+                    doc = existing
+                self._store(work_id, doc, now)
+                success_count += 1
+            self._connection.commit()
+        return success_count, errors
+
+    def _store(self, work_id, doc, indexed_at):
+        doc = dict(
+            (k, v) for k, v in doc.items()
+            if k not in ('_op_type', '_index', '_type')
+        )
+        scrub = Filter._scrub
+        target_age = doc.get('target_age') or {}
+        self._delete([work_id])
+        self._connection.execute(
+            "INSERT INTO works VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (work_id, bool(doc.get('presentation_ready')),
+             scrub(doc.get('medium')), scrub(doc.get('language')),
+             scrub(doc.get('fiction')), scrub(doc.get('audience')),
+             self._lower(doc.get('series')), doc.get('series_position'),
+             self._sortable('sort_title', doc.get('sort_title')),
+             self._sortable('sort_author', doc.get('sort_author')),
+             doc.get('quality'), target_age.get('lower'),
+             target_age.get('upper'), doc.get('last_update_time'),
+             indexed_at, json.dumps(doc))
+        )
+        for table, rows in self._side_table_rows(work_id, doc):
+            if rows:
+                self._connection.executemany(
+                    "INSERT INTO %s VALUES (%s)" % (
+                        table, ", ".join("?" for x in rows[0])
+                    ), rows
+                )
+        text = self._text_columns(doc)
+        self._connection.execute(
+            "INSERT INTO works_text(rowid, %s) VALUES (?, %s)" % (
+                ", ".join(name for name, weight in self.TEXT_COLUMNS),
+                ", ".join("?" for x in self.TEXT_COLUMNS)
+            ),
+            [work_id] + [text[name] for name, weight in self.TEXT_COLUMNS]
+        )
+
+    @classmethod
+    def _side_table_rows(cls, work_id, doc):
+        """Find the rows that represent a search document's
+        subdocuments in the side tables.
+
+        :return: A list of (table name, list of rows) 2-tuples.
+        """
+        pools = [
+            (work_id, x.get('collection_id'), x.get('data_source_id'),
+             x.get('medium'), bool(x.get('open_access')),
+             bool(x.get('available')), bool(x.get('licensed')),
+             bool(x.get('suppressed')), x.get('availability_time'))
+            for x in doc.get('licensepools') or []
+        ]
+        genres = [
+            (work_id, x.get('term')) for x in doc.get('genres') or []
+        ]
+        lists = [
+            (work_id, x.get('list_id'), bool(x.get('featured')),
+             x.get('first_appearance'))
+            for x in doc.get('customlists') or []
+        ]
+        identifiers = [
+            (work_id, x.get('type'), x.get('identifier'))
+            for x in doc.get('identifiers') or []
+        ]
+        # Names are matched case-insensitively, as in Elasticsearch.
+        contributors = [
+            (work_id, x.get('role'), cls._lower(x.get('sort_name')),
+             cls._lower(x.get('display_name')), x.get('viaf'), x.get('lc'))
+            for x in doc.get('contributors') or []
+        ]
+        return [
+            ('pools', pools), ('genres', genres), ('lists', lists),
+            ('identifiers', identifiers), ('contributors', contributors),
+        ]
+
+    @classmethod
+    def _text_columns(cls, doc):
+        """Find the searchable text in a search document."""
+        def join(*values):
+            return u" ".join(x for x in values if x)
+
+        authors = [doc.get('author')]
+        for contributor in doc.get('contributors') or []:
+            authors.append(contributor.get('display_name'))
+            authors.append(contributor.get('sort_name'))
+        subjects = [
+            x.get('term') for x in doc.get('classifications') or []
+        ]
+        subjects.extend(x.get('name') for x in doc.get('genres') or [])
+        return dict(
+            title=join(doc.get('title')),
+            subtitle=join(doc.get('subtitle')),
+            series=join(doc.get('series')),
+            author=join(*authors),
+            publisher=join(doc.get('publisher'), doc.get('imprint')),
+            summary=join(doc.get('summary')),
+            subjects=join(*subjects),
+        )
+
+    @classmethod
+    def _lower(cls, value):
+        if not value:
+            return value
+        return value.lower()
+
+    def _document(self, work_id):
+        row = self._connection.execute(
+            "SELECT document FROM works WHERE work_id=?", (work_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _documents(self, work_ids):
+        """Load and parse the search documents for some works.
+
+        :return: A dictionary mapping work ID to search document.
+        """
+        documents = dict()
+        with self._lock:
+            for work_id, document in self._connection.execute(
+                "SELECT work_id, document FROM works WHERE work_id IN (%s)"
+                % ", ".join("?" for x in work_ids), list(work_ids)
+            ):
+                documents[work_id] = json.loads(document)
+        return documents
+
+    def _delete(self, work_ids):
+        for work_id in work_ids:
+            for table in ['works'] + self.SIDE_TABLES:
+                self._connection.execute(
+                    "DELETE FROM %s WHERE work_id=?" % table, (work_id,)
+                )
+            self._connection.execute(
+                "DELETE FROM works_text WHERE rowid=?", (work_id,)
+            )
+
+    def exists(self, index, doc_type, id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM works WHERE work_id=?", (int(id),)
+            ).fetchone()
+            return row is not None
+
+    def delete(self, index, doc_type, id):
+        with self._lock:
+            self._delete([int(id)])
+            self._connection.commit()
+
+    # Searching.
+
+    def query_works_multi(self, queries, debug=False, timeout=None):
+        """Run several queries and yield a list of results for each.
+
+        :param queries: A list of (query string, Filter, Pagination)
+            3-tuples.
+        :param timeout: Ignored; SQLite queries can't be interrupted.
+        """
+        for (query_string, filter, pagination) in queries:
+            a = time.time()
+            if filter is not None and filter.match_nothing is True:
+                results = []
+            else:
+                results = self._search(
+                    query_string, filter, pagination, debug=debug
+                )
+            took = time.time() - a
+            self.record_search(query_string, filter, dict(took=took))
+            if debug:
+                self.log.debug(
+                    "Local query %r completed in %.3fsec", query_string, took
+                )
+            if pagination:
+                pagination.page_loaded(results)
+            yield results
+
+    def count_works(self, filter):
+        """Count the works that match `filter`."""
+        if filter is not None and filter.match_nothing is True:
+            return 0
+        source, args = self._source(None, filter)
+        with self._lock:
+            [count] = self._connection.execute(
+                "SELECT COUNT(*) %s" % source, args
+            ).fetchone()
+        return count
+
+    def count_works_multi(self, filters):
+        return [self.count_works(filter) for filter in filters]
+
+    def scan_works(self, filter, fields=None, slices=1, batch_size=None):
+        """Iterate over every work that matches a Filter, in the
+        Filter's sort order.
+
+        The matching works are found in one query, and their search
+        documents are loaded `batch_size` at a time. `slices` has no
+        effect.
+        """
+        if filter is not None and filter.match_nothing is True:
+            return
+        rows = self._sorted_rows(None, filter, None)
+        batch_size = batch_size or self.SCAN_BATCH_SIZE
+        for i in range(0, len(rows), batch_size):
+            for hit in self._hits(rows[i:i+batch_size], filter, fields):
+                yield hit
+
+    def _search(self, query_string, filter, pagination, fields=None,
+                debug=False):
+        """Find one page of the works matching a query, in order.
+
+        :return: A list of Hit objects.
+        """
+        if debug:
+            fields = ['*']
+        rows = self._sorted_rows(query_string, filter, pagination)
+        return self._hits(rows, filter, fields)
+
+    def _hits(self, rows, filter, fields):
+        """Turn rows found by _sorted_rows() into the kind of Hit
+        objects Elasticsearch would have sent.
+
+        Only the search documents needed for the requested fields
+        are loaded.
+        """
+        if not fields:
+            fields = ['work_id']
+            if filter and filter.search_only:
+                fields = fields + self.SEARCH_ONLY_FIELDS
+        documents = dict()
+        if [x for x in fields if x != 'work_id'] and rows:
+            documents = self._documents([row[0] for row in rows])
+
+        hits = []
+        for row in rows:
+            work_id, score, sort_values, last_update = row
+            doc = documents.get(work_id, dict(work_id=work_id))
+            if '*' in fields:
+                source = doc
+            else:
+                source = dict((k, doc[k]) for k in fields if k in doc)
+            hit = dict(
+                _id=unicode(work_id), _score=score, sort=sort_values,
+                _source=source
+            )
+            if last_update is not None:
+                hit['fields'] = dict(last_update=[last_update])
+            hits.append(Hit(hit))
+        return hits
+
+    def _sorted_rows(self, query_string, filter, pagination):
+        """Find the works that match a query string and a Filter, and
+        sort and paginate them, without loading any search documents.
+
+        :return: A list of 4-tuples (work ID, relevance score, list of
+            sort values, 'last update' script value or None).
+        """
+        source, args = self._source(query_string, filter)
+
+        score, score_args = self._score_expression(query_string, filter)
+        sort_fields = self._sort_fields(filter)
+        columns = ["works.work_id AS work_id", "%s AS score" % score]
+        column_args = list(score_args)
+        for i, (key, descending) in enumerate(sort_fields):
+            if key == '_score':
+                expression, expression_args = score, score_args
+            else:
+                expression, expression_args = self._sort_expression(
+                    key, filter
+                )
+            columns.append("%s AS s%d" % (expression, i))
+            column_args.extend(expression_args)
+        want_last_update = bool(
+            filter and 'last_update' in filter.script_fields
+        )
+        if want_last_update:
+            expression, expression_args = self._last_update_expression(filter)
+            columns.append("%s AS last_update" % expression)
+            column_args.extend(expression_args)
+        args = column_args + args
+
+        # The inner query calculates the sort values. The outer query
+        # uses them to sort and paginate. LIMIT -1 stops SQLite from
+        # merging the two queries, which would move bm25() into a
+        # WHERE clause, where it can't be used.
+        sql = "SELECT * FROM (SELECT %s %s LIMIT -1)" % (
+            ", ".join(columns), source
+        )
+
+        where = []
+        if (isinstance(pagination, SortKeyPagination)
+            and pagination.last_item_on_previous_page):
+            # Start after the last item on the previous page, just as
+            # Elasticsearch's search_after does.
+            after, after_args = self._search_after(
+                sort_fields, pagination.last_item_on_previous_page
+            )
+            where.append(after)
+            args.extend(after_args)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+
+        order_by = []
+        for i, (key, descending) in enumerate(sort_fields):
+            # As in Elasticsearch, missing values go last whatever the
+            # sort order.
+            order_by.append("(s%d IS NULL)" % i)
+            order_by.append("s%d %s" % (i, descending and "DESC" or "ASC"))
+        sql += " ORDER BY " + ", ".join(order_by)
+
+        if pagination:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend([pagination.size, pagination.offset])
+
+        with self._lock:
+            rows = self._connection.execute(sql, args).fetchall()
+
+        sort_count = len(sort_fields)
+        results = []
+        for row in rows:
+            work_id, score = row[0], row[1]
+            sort_values = list(row[2:2+sort_count])
+            last_update = None
+            if want_last_update:
+                last_update = row[2+sort_count]
+            results.append((work_id, score, sort_values, last_update))
+        return results
+
+    @classmethod
+    def _search_after(cls, sort_fields, after):
+        """Create a WHERE clause that finds rows that sort after the
+        given sort values.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        alternatives = []
+        args = []
+        for i, (key, descending) in enumerate(sort_fields):
+            clauses = []
+            clause_args = []
+            # Every earlier sort value is the same...
+            for j in range(i):
+                if after[j] is None:
+                    clauses.append("s%d IS NULL" % j)
+                else:
+                    clauses.append("s%d = ?" % j)
+                    clause_args.append(after[j])
+            # ...and this one comes later. Nothing comes after a
+            # missing value, since those go last.
+            if after[i] is None:
+                continue
+            clauses.append("(s%d %s ? OR s%d IS NULL)" % (
+                i, descending and "<" or ">", i
+            ))
+            clause_args.append(after[i])
+            alternatives.append("(%s)" % " AND ".join(clauses))
+            args.extend(clause_args)
+        if not alternatives:
+            return "0", []
+        return "(%s)" % " OR ".join(alternatives), args
+
+    def _source(self, query_string, filter):
+        """Create the FROM and WHERE clauses that find the works
+        matching a query string and a Filter.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        clauses, args = self._filter_clauses(filter)
+        source = "FROM works"
+        expression = self._text_expression(query_string, clauses, args)
+        if expression:
+            source = (
+                "FROM works_text JOIN works "
+                "ON works.work_id = works_text.rowid"
+            )
+            clauses = ["works_text MATCH ?"] + clauses
+            args = [expression] + args
+        return "%s WHERE %s" % (source, " AND ".join(clauses)), args
+
+    def _text_expression(self, query_string, clauses, args):
+        """Convert a query string into an FTS5 query.
+
+        Works that match every word of the query string are preferred.
+        If there are none, works that match any of them will do.
+
+        :return: A string, or None if there's no query string.
+        """
+        if not query_string:
+            return None
+        expression = self._match_expression(query_string, True)
+        if not expression:
+            return None
+        with self._lock:
+            found = self._connection.execute(
+                "SELECT 1 FROM works_text JOIN works "
+                "ON works.work_id = works_text.rowid "
+                "WHERE works_text MATCH ? AND %s LIMIT 1"
+                % " AND ".join(clauses), [expression] + args
+            ).fetchone()
+        if found:
+            return expression
+        return self._match_expression(query_string, False)
+
+    @classmethod
+    def _match_expression(cls, query_string, all_must_match=True):
+        """Convert a query string into an FTS5 query.
+
+        :return: A string, or None if the query string has no words.
+        """
+        words = cls.WORD_RE.findall(query_string.lower())
+        significant = [x for x in words if x not in ENGLISH_STOPWORDS]
+        words = significant or words
+        if not words:
+            return None
+        # Each word is quoted so that words like "not" aren't taken
+        # as operators. The last word may be incomplete.
+        terms = [u'"%s"' % x for x in words]
+        terms[-1] += u'*'
+        if all_must_match:
+            return u" AND ".join(terms)
+        return u" OR ".join(terms)
+
+    # Filtering.
+
+    @classmethod
+    def _in(cls, column, values):
+        """Create an IN clause.
+
+        :return: A 2-tuple (SQL, arguments). An empty list of values
+            matches nothing.
+        """
+        values = list(values)
+        if not values:
+            return "0", []
+        return "%s IN (%s)" % (column, ", ".join("?" for x in values)), values
+
+    @classmethod
+    def _exists(cls, table, alias, clause):
+        """Create a clause that's true if any of a work's rows in a side
+        table meet a condition.
+        """
+        return "EXISTS (SELECT 1 FROM %s %s WHERE %s.work_id = works.work_id AND %s)" % (
+            table, alias, alias, clause
+        )
+
+    @classmethod
+    def _filter_clauses(cls, filter):
+        """Convert a Filter into SQL clauses.
+
+        This mirrors Filter.build(). As in Elasticsearch, each
+        restriction on a list of subdocuments is satisfied if any
+        subdocument meets it.
+
+        :return: A 2-tuple (list of SQL clauses, list of arguments).
+        """
+        clauses = ["works.presentation_ready = 1"]
+        args = []
+
+        def add(clause, clause_args=[]):
+            clauses.append(clause)
+            args.extend(clause_args)
+
+        scrub_list = Filter._scrub_list
+        if filter:
+            for column, values in (
+                ('medium', filter.media), ('language', filter.languages),
+                ('audience', filter.audiences),
+            ):
+                if values:
+                    add(*cls._in("works.%s" % column, scrub_list(values)))
+            if filter.fiction is not None:
+                add("works.fiction = ?",
+                    [filter.fiction and 'fiction' or 'nonfiction'])
+        if not filter or not filter.audiences:
+            add("(works.audience IS NULL OR works.audience != ?)",
+                [Filter._scrub(Classifier.AUDIENCE_RESEARCH)])
+
+        # Works are only found through LicensePools that aren't
+        # suppressed and that are either open-access or licensed.
+        pool_clauses = [
+            ("NOT p.suppressed", []),
+            ("(p.licensed OR p.open_access)", []),
+        ]
+        if filter:
+            filter_ids = Filter._filter_ids
+            collection_ids = filter_ids(filter.collection_ids)
+            if collection_ids is not None:
+                pool_clauses.append(cls._in("p.collection_id", collection_ids))
+            license_datasources = filter_ids(filter.license_datasources)
+            if license_datasources is not None:
+                pool_clauses.append(
+                    cls._in("p.data_source_id", license_datasources)
+                )
+            if filter.availability == FacetConstants.AVAILABLE_NOW:
+                pool_clauses.append(("(p.open_access OR p.available)", []))
+            elif filter.availability == FacetConstants.AVAILABLE_OPEN_ACCESS:
+                pool_clauses.append(("p.open_access", []))
+            excluded = filter.excluded_audiobook_data_sources
+            if excluded:
+                clause, clause_args = cls._in("p.data_source_id", excluded)
+                pool_clauses.append((
+                    "NOT (p.medium IS ? AND p.data_source_id IS NOT NULL AND %s)"
+                    % clause, [Edition.AUDIO_MEDIUM] + clause_args
+                ))
+            if not filter.allow_holds:
+                pool_clauses.append(("(p.available OR p.open_access)", []))
+        for clause, clause_args in pool_clauses:
+            add(cls._exists("pools", "p", clause), clause_args)
+
+        if not filter:
+            return clauses, args
+
+        if filter.series:
+            add("works.series = ?", [filter.series.lower()])
+
+        if filter.target_age:
+            lower, upper = filter.target_age
+            # As in Filter.target_age_filter, a missing bound on the
+            # work's target age matches anything.
+            if upper is not None:
+                add("(works.target_age_lower IS NULL OR works.target_age_lower <= ?)",
+                    [upper])
+            if lower is not None:
+                add("(works.target_age_upper IS NULL OR works.target_age_upper >= ?)",
+                    [lower])
+
+        for genre_ids in filter.genre_restriction_sets:
+            clause, clause_args = cls._in(
+                "g.genre_id", Filter._filter_ids(genre_ids)
+            )
+            add(cls._exists("genres", "g", clause), clause_args)
+
+        for customlist_ids in filter.customlist_restriction_sets:
+            clause, clause_args = cls._in(
+                "l.list_id", Filter._filter_ids(customlist_ids)
+            )
+            add(cls._exists("lists", "l", clause), clause_args)
+
+        if filter.subcollection == FacetConstants.COLLECTION_FEATURED:
+            add("COALESCE(works.quality, 0) >= ?",
+                [filter.minimum_featured_quality])
+
+        if filter.identifiers:
+            alternatives = []
+            identifier_args = []
+            for x in Filter._scrub_identifiers(filter.identifiers):
+                alternatives.append("(i.type = ? AND i.identifier = ?)")
+                identifier_args.extend([x.type, x.identifier])
+            add(cls._exists("identifiers", "i", " OR ".join(alternatives)),
+                identifier_args)
+
+        if filter.author is not None:
+            add(*cls._author_clause(filter.author))
+
+        if filter.updated_after:
+            updated_after = filter.updated_after
+            if isinstance(updated_after, datetime.datetime):
+                updated_after = (
+                    updated_after - datetime.datetime.utcfromtimestamp(0)
+                ).total_seconds()
+            add("COALESCE(works.last_update_time, 0) >= ?", [updated_after])
+
+        return clauses, args
+
+    @classmethod
+    def _author_clause(cls, author):
+        """Find works with an author-level contribution by `author`.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        alternatives = []
+        args = []
+        for field, value, normalize in [
+            ('sort_name', author.sort_name, True),
+            ('display_name', author.display_name, True),
+            ('viaf', author.viaf, False),
+            ('lc', author.lc, False),
+        ]:
+            if not value or value == Edition.UNKNOWN_AUTHOR:
+                continue
+            if normalize:
+                value = value.lower()
+            alternatives.append("c.%s = ?" % field)
+            args.append(value)
+        if not alternatives:
+            return "0", []
+        roles, role_args = cls._in("c.role", Filter.AUTHOR_MATCH_ROLES)
+        return cls._exists(
+            "contributors", "c", "%s AND (%s)" % (
+                roles, " OR ".join(alternatives)
+            )
+        ), role_args + args
+
+    # Scoring and sorting.
+
+    def _score_expression(self, query_string, filter):
+        """Create an SQL expression for a work's score: its relevance
+        to the query string, plus its featurability if the Filter
+        asks for that.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        if query_string and self._match_expression(query_string):
+            score = "-bm25(works_text, %s)" % ", ".join(
+                str(weight) for name, weight in self.TEXT_COLUMNS
+            )
+        else:
+            score = "0"
+        args = []
+        if filter and filter.scoring_functions:
+            featurability, args = self._featurability_expression(filter)
+            score = "(%s + %s)" % (score, featurability)
+        return score, args
+
+    @classmethod
+    def _featurability_expression(cls, filter):
+        """Score a work the way Filter.featurability_scoring_functions
+        would.
+
+        The featurability functions are the only scoring functions in
+        use, so they're recognized by their presence rather than
+        interpreted.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        exponent = 2
+        cutoff = filter.minimum_featured_quality ** exponent
+        parts = [
+            "MIN(?, COALESCE(works.quality, 0)) * MIN(?, COALESCE(works.quality, 0)) * 5",
+            "(CASE WHEN %s THEN 5 ELSE 0 END)" % cls._exists(
+                "pools", "p", "p.available"
+            ),
+        ]
+        args = [cutoff, cutoff]
+
+        seed = cls._random_seed(filter)
+        if seed is not None:
+            parts.append("seeded_random(?, works.work_id) * 1.1")
+            args.append(seed)
+
+        list_ids = set()
+        for restriction in filter.customlist_restriction_sets:
+            list_ids.update(Filter._filter_ids(restriction))
+        if list_ids:
+            clause, clause_args = cls._in("l.list_id", list_ids)
+            parts.append("(CASE WHEN %s THEN 11 ELSE 0 END)" % cls._exists(
+                "lists", "l", "l.featured AND %s" % clause
+            ))
+            args.extend(clause_args)
+        return "(%s)" % " + ".join(parts), args
+
+    @classmethod
+    def _seeded_random(cls, seed, work_id):
+        """A random number that's always the same for a given seed
+        and work.
+        """
+        return random.Random("%s-%s" % (seed, work_id)).random()
+
+    @classmethod
+    def _random_seed(cls, filter):
+        """Find the seed of the random_score function among a Filter's
+        scoring functions, if there is one.
+        """
+        for function in filter.scoring_functions:
+            if hasattr(function, 'to_dict'):
+                function = function.to_dict()
+            if 'random_score' in function:
+                return function['random_score'].get('seed')
+        return None
+
+    @classmethod
+    def _sort_fields(cls, filter):
+        """Convert a Filter's sort order into a list of
+        (key, descending) 2-tuples.
+        """
+        if not filter or not filter.order:
+            # Sort by relevance, with the work ID as a tiebreaker.
+            return [('_score', True), ('work_id', False)]
+        fields = []
+        for field in filter.sort_order:
+            [(key, description)] = field.items()
+            if isinstance(description, dict):
+                description = description.get('order')
+            fields.append((key, description == 'desc'))
+        return fields
+
+    @classmethod
+    def _sort_expression(cls, key, filter):
+        """Create an SQL expression for the value of a sort key.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        if key in ('_id', 'work_id'):
+            return "works.work_id", []
+        if key == '_script':
+            # This is the only script used for sorting.
+            return cls._last_update_expression(filter)
+        if key == 'licensepools.availability_time':
+            clause, args = "1", []
+            collection_ids = Filter._filter_ids(filter.collection_ids)
+            if collection_ids is not None:
+                clause, args = cls._in("p.collection_id", collection_ids)
+            return (
+                "(SELECT MIN(p.availability_time) FROM pools p "
+                "WHERE p.work_id = works.work_id AND %s)" % clause
+            ), args
+        if key in cls.SORT_COLUMNS:
+            return "works.%s" % key, []
+        return "NULL", []
+
+    @classmethod
+    def _last_update_expression(cls, filter):
+        """Calculate a work's 'last update' time in the context of a
+        Filter, as CurrentMapping.WORK_LAST_UPDATE_SCRIPT does.
+
+        :return: A 2-tuple (SQL, arguments).
+        """
+        candidates = ["COALESCE(works.last_update_time, -1)"]
+        args = []
+        collection_ids = Filter._filter_ids(filter.collection_ids)
+        if collection_ids:
+            clause, clause_args = cls._in("p.collection_id", collection_ids)
+            candidates.append(
+                "COALESCE((SELECT MAX(p.availability_time) FROM pools p "
+                "WHERE p.work_id = works.work_id AND %s), -1)" % clause
+            )
+            args.extend(clause_args)
+        list_ids = set()
+        for restriction in filter.customlist_restriction_sets:
+            list_ids.update(Filter._filter_ids(restriction))
+        if list_ids:
+            clause, clause_args = cls._in("l.list_id", list_ids)
+            candidates.append(
+                "COALESCE((SELECT MAX(l.first_appearance) FROM lists l "
+                "WHERE l.work_id = works.work_id AND %s), -1)" % clause
+            )
+            args.extend(clause_args)
+        return "MAX(-1, %s)" % ", ".join(candidates), args
+
+    @classmethod
+    def _sortable(cls, key, value):
+        """Normalize a string the way the search mapping does before
+        sorting on it.
+        """
+        if not isinstance(value, basestring):
+            return value
+        if key == 'sort_author':
+            if value == Edition.UNKNOWN_AUTHOR:
+                # Unknown authors sort after everything else.
+                return u"\N{REPLACEMENT CHARACTER}"
+            value = re.sub(r"\s+;.*", "", value)
+            value = re.sub(r"\s+\([^)]+\)", "", value)
+        value = value.replace(".", "").replace("'", "")
+        return value.lower()
+
+    def _run_self_tests(self, _db, in_testing=False):
+        def _search_for_term():
+            return [
+                "%s (%s)" % (x.sort_title, x.sort_author)
+                for x in self.query_works(
+                    self.test_search_term, filter=None, pagination=None,
+                    debug=True
+                )
+            ]
+
+        yield self.run_test(
+            ("Search results for '%s':" %(self.test_search_term)),
+            _search_for_term
+        )
+
+        def _total_count():
+            return str(self.count_works(None))
+
+        yield self.run_test(
+            "Total number of documents in this search index:",
+            _total_count
+        )
@@ -14,10 +14,7 @@ from config import (
     CannotLoadConfiguration,
 )
 from lane import BaseFacets
-from external_search import (
-    ExternalSearchIndex,
-    SortKeyPagination,
-)
+from external_search import ExternalSearchIndex
 from model import (
     get_one,
     get_one_or_create,
@@ -646,7 +643,7 @@ class MARCExporter(object):
         if not mirror:
             raise Exception("No mirror integration is configured")
 
-        search_engine = search_engine or ExternalSearchIndex(self._db)
+        search_engine = search_engine or ExternalSearchIndex.load(self._db)
 
         # End time is before we start the query, because if any records are changed
         # during the processing we may not catch them, and they should be handled
@@ -654,7 +651,6 @@ class MARCExporter(object):
         end_time = datetime.datetime.utcnow()
 
         facets = MARCExporterFacets(start_time=start_time)
-        pagination = SortKeyPagination(size=query_batch_size)
 
         url = mirror.marc_file_url(self.library, lane, end_time, start_time)
         representation, ignore = get_one_or_create(
@@ -665,28 +661,27 @@ class MARCExporter(object):
         with mirror.multipart_upload(representation, url) as upload:
             this_batch = BytesIO()
             this_batch_size = 0
-            while pagination is not None:
-                # Retrieve one 'page' of works from the search index.
-                works = lane.works(
-                    self._db, pagination=pagination, facets=facets,
-                    search_engine=search_engine
+            # Make a single pass through the search index, loading
+            # works from the database one batch at a time.
+            works = lane.iter_all_works(
+                self._db, facets=facets, search_engine=search_engine,
+                batch_size=query_batch_size
+            )
+            for work in works:
+                # Create a record for each work and add it to the
+                # MARC file in progress.
+                record = self.create_record(
+                    work, annotator, force_refresh, self.integration
                 )
-                for work in works:
-                    # Create a record for each work and add it to the
-                    # MARC file in progress.
-                    record = self.create_record(
-                        work, annotator, force_refresh, self.integration
-                    )
-                    if record:
-                        this_batch.write(record.as_marc())
-                this_batch_size += pagination.this_page_size
+                if record:
+                    this_batch.write(record.as_marc())
+                this_batch_size += 1
                 if this_batch_size >= upload_batch_size:
                     # We've reached or exceeded the upload threshold.
                     # Upload one part of the multi-part document.
                     self._upload_batch(this_batch, upload)
                     this_batch = BytesIO()
                     this_batch_size = 0
-                pagination = pagination.next_page
 
             # Upload the final part of the multi-document, if
             # necessary.
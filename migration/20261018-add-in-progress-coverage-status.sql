@@ -0,0 +1,3 @@
+-- Coverage providers can claim items by giving them an 'in progress'
+-- coverage record that expires at the record's timestamp.
+alter type coverage_status add value if not exists 'in progress';
@@ -0,0 +1,20 @@
+-- Cached feeds are now stored gzip-compressed, alongside an ETag.
+-- Feeds that were cached before this change keep their uncompressed
+-- content until they are regenerated.
+DO $$
+ BEGIN
+  -- Add the 'compressed_content' column
+  BEGIN
+   ALTER TABLE cachedfeeds ADD COLUMN compressed_content bytea;
+  EXCEPTION
+   WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.compressed_content already exists, not creating it.';
+  END;
+
+  -- Add the 'etag' column
+  BEGIN
+   ALTER TABLE cachedfeeds ADD COLUMN etag varchar;
+  EXCEPTION
+   WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.etag already exists, not creating it.';
+  END;
+ END;
+$$;
@@ -11,17 +11,33 @@ from . import (
 
 from collections import namedtuple
 import datetime
+import hashlib
 import logging
+import struct
+import threading
 from sqlalchemy import (
+    Binary,
     Column,
     DateTime,
     ForeignKey,
     Index,
     Integer,
     Unicode,
+    text,
+)
+from sqlalchemy.orm import (
+    column_property,
+    defer,
 )
 from sqlalchemy.sql.expression import (
     and_,
+    or_,
+)
+from ..config import Configuration
+from ..util.cache import LRUCache
+from ..util.compression import (
+    gzip_compress,
+    gzip_decompress,
 )
 from ..util.flask_util import OPDSFeedResponse
 
@@ -54,8 +70,22 @@ class CachedFeed(Base):
     # A 'page' feed is associated with a set of values for pagination.
     pagination = Column(Unicode, nullable=False)
 
-    # The content of the feed.
-    content = Column(Unicode, nullable=True)
+    # The content of the feed, uncompressed. Feeds are no longer
+    # stored this way, but older feeds may still be in the database.
+    _content = Column(Unicode, nullable=True, name="content")
+
+    # The content of the feed, UTF-8 encoded and gzip-compressed. This
+    # can be sent as-is to clients that accept gzip.
+    compressed_content = Column(Binary, nullable=True)
+
+    # A hash of the uncompressed content, usable as an HTTP ETag.
+    etag = Column(Unicode, nullable=True)
+
+    # Whether the feed has any content. This is calculated by the
+    # database, so it can be checked without loading the content.
+    content_stored = column_property(
+        or_(_content != None, compressed_content != None)
+    )
 
     # Every feed is associated with a Library.
     library_id = Column(
@@ -82,6 +112,36 @@ class CachedFeed(Base):
 
     log = logging.getLogger("CachedFeed")
 
+    # An optional in-process cache that is consulted before going to
+    # the database. It's disabled by default; call
+    # configure_local_cache() to enable it.
+    local_cache = None
+
+    # Defaults for the in-process cache.
+    LOCAL_CACHE_MAX_ENTRIES = 500
+    LOCAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    LOCAL_CACHE_TTL = 60
+
+    # This named tuple is what's stored in the in-process cache. It
+    # has a timestamp, so it can be passed into _should_refresh()
+    # just like a CachedFeed.
+    LocalCacheEntry = namedtuple(
+        'LocalCacheEntry',
+        ['timestamp', 'compressed_content', 'etag', 'cached_at']
+    )
+
+    # If this is set, only one worker at a time will regenerate a
+    # given feed. While that happens, other workers will serve the
+    # stale feed, so long as it went stale less than this number of
+    # seconds ago. Call configure_single_flight() to set this.
+    single_flight_grace_period = None
+
+    # In-process locks used to make sure only one thread in this
+    # process regenerates a given feed. Keyed by the value returned
+    # by _local_cache_key().
+    _regeneration_locks = {}
+    _regeneration_locks_lock = threading.Lock()
+
     @classmethod
     def fetch(cls, _db, worklist, facets, pagination, refresher_method,
               max_age=None, raw=False, **response_kwargs
@@ -132,7 +192,10 @@ class CachedFeed(Base):
         # TODO: this constraint_clause might not be necessary anymore.
         # ISTR it was an attempt to avoid race conditions, and we do a
         # better job of that now.
-        constraint_clause = and_(cls.content!=None, cls.timestamp!=None)
+        constraint_clause = and_(
+            or_(cls._content!=None, cls.compressed_content!=None),
+            cls.timestamp!=None
+        )
         kwargs = dict(
             on_multiple='interchangeable',
             constraint=constraint_clause,
@@ -150,43 +213,154 @@ class CachedFeed(Base):
             # just going to replace it.
             feed_obj = None
         else:
-            feed_obj = get_one(_db, cls, **kwargs)
+            if not raw:
+                # The in-process cache can't provide a CachedFeed
+                # object, but it can provide everything needed to
+                # build a response.
+                local = cls._local_cache_lookup(keys)
+                if local and not cls._should_refresh(local, max_age):
+                    return cls._response(
+                        local.compressed_content, max_age, response_kwargs,
+                        compressed=True, etag=local.etag,
+                        last_modified=local.timestamp
+                    )
+            # If this is a conditional request, there's a good chance
+            # we won't need the feed content at all, so don't load it
+            # until we know we do.
+            load_content = raw or not OPDSFeedResponse.is_conditional_request()
+            feed_obj = cls._get_feed(_db, load_content, **kwargs)
 
         should_refresh = cls._should_refresh(feed_obj, max_age)
-        if should_refresh:
-            # This is a cache miss. Either feed_obj is None or
-            # it's no good. We need to generate a new feed.
-            feed_data = unicode(refresher_method())
-            generation_time = datetime.datetime.utcnow()
-
-            if max_age is not cls.IGNORE_CACHE:
-                # Having gone through all the trouble of generating
-                # the feed, we want to cache it in the database.
-
-                # Since it can take a while to generate a feed, and we know
-                # that the feed in the database is stale, it's possible that
-                # another thread _also_ noticed that feed was stale, and
-                # generated a similar feed while we were working.
-                #
-                # To avoid a database error, fetch the feed _again_ from the
-                # database rather than assuming we have the up-to-date
-                # object.
-                feed_obj, is_new = get_one_or_create(_db, cls, **kwargs)
-                if feed_obj.timestamp is None or feed_obj.timestamp < generation_time:
-                    # Either there was no contention for this object, or there
-                    # was contention but our feed is more up-to-date than
-                    # the other thread(s). Our feed takes priority.
-                    feed_obj.content = feed_data
-                    feed_obj.timestamp = generation_time
-        elif feed_obj:
-            feed_data = feed_obj.content
+        regeneration_lock = None
+        if should_refresh and cls._within_grace_period(feed_obj, max_age):
+            # We have a stale feed that's still good enough to serve
+            # if someone else is already generating a new one.
+            regeneration_lock = cls._acquire_regeneration_lock(_db, keys)
+            if regeneration_lock is None:
+                # Someone else is already generating a new one. Serve
+                # the stale feed rather than duplicating their work.
+                should_refresh = False
+        try:
+            if should_refresh:
+                feed_obj, feed_data = cls._refresh(
+                    _db, keys, kwargs, refresher_method, max_age
+                )
+        finally:
+            if regeneration_lock is not None:
+                cls._release_regeneration_lock(regeneration_lock)
+
+        validators = dict()
+        if feed_obj and not raw:
+            validators = dict(
+                etag=feed_obj.etag, last_modified=feed_obj.timestamp
+            )
+            # Feeds are stored compressed, so the client's copy will
+            # have the ETag of the compressed feed if it accepts gzip.
+            if OPDSFeedResponse.not_modified(gzipped=True, **validators):
+                # The client already has this feed. Send a 304
+                # response without ever loading the feed content.
+                return cls._response(
+                    None, max_age, response_kwargs, compressed=True,
+                    **validators
+                )
+
+        if not should_refresh and feed_obj:
+            cls._local_cache_store(keys, feed_obj)
 
         if raw and feed_obj:
             return feed_obj
 
-        # We have the information necessary to create a useful
-        # response-type object.
-        #
+        compressed = False
+        if feed_obj and feed_obj.compressed_content is not None:
+            # Rather than decompressing the feed, pass the compressed
+            # version into the response. It may be possible to send it
+            # to the client without ever decompressing it.
+            feed_data = feed_obj.compressed_content
+            compressed = True
+        elif feed_obj:
+            feed_data = feed_obj.content
+        return cls._response(
+            feed_data, max_age, response_kwargs, compressed=compressed,
+            **validators
+        )
+
+    @classmethod
+    def _get_feed(cls, _db, load_content=True, **kwargs):
+        """Look up a CachedFeed in the database.
+
+        :param load_content: If this is False, the feed content will
+            not be loaded until it's accessed. This saves transferring
+            the content of a feed that turns out not to be needed.
+        :param kwargs: The same arguments that would be passed into
+            get_one().
+        """
+        if load_content:
+            return get_one(_db, cls, **kwargs)
+        kwargs = dict(kwargs)
+        kwargs.pop('on_multiple', None)
+        constraint = kwargs.pop('constraint', None)
+        qu = _db.query(cls).options(
+            defer(cls._content), defer(cls.compressed_content)
+        ).filter_by(**kwargs)
+        if constraint is not None:
+            qu = qu.filter(constraint)
+        # Multiple matches are interchangeable.
+        return qu.first()
+
+    @classmethod
+    def _refresh(cls, _db, keys, kwargs, refresher_method, max_age):
+        """Generate a new feed and cache it in the database.
+
+        :return: A 2-tuple (CachedFeed, feed content). The CachedFeed
+            will be None if the feed should not be cached, in which case
+            the content may be a generator of Unicode strings.
+        """
+        feed_obj = None
+        # This is a cache miss. Either feed_obj is None or
+        # it's no good. We need to generate a new feed.
+        feed = refresher_method()
+        if max_age is cls.IGNORE_CACHE and getattr(feed, 'streaming', False):
+            # Nothing is going to be stored, so the feed can be sent
+            # to the client while it's being generated.
+            return feed_obj, feed.stream()
+        feed_data = unicode(feed)
+        generation_time = datetime.datetime.utcnow()
+
+        if max_age is not cls.IGNORE_CACHE:
+            # Having gone through all the trouble of generating
+            # the feed, we want to cache it in the database.
+
+            # Since it can take a while to generate a feed, and we know
+            # that the feed in the database is stale, it's possible that
+            # another thread _also_ noticed that feed was stale, and
+            # generated a similar feed while we were working.
+            #
+            # To avoid a database error, fetch the feed _again_ from the
+            # database rather than assuming we have the up-to-date
+            # object.
+            feed_obj, is_new = get_one_or_create(_db, cls, **kwargs)
+            if feed_obj.timestamp is None or feed_obj.timestamp < generation_time:
+                # Either there was no contention for this object, or there
+                # was contention but our feed is more up-to-date than
+                # the other thread(s). Our feed takes priority.
+                feed_obj.content = feed_data
+                feed_obj.timestamp = generation_time
+            cls._local_cache_store(keys, feed_obj)
+        return feed_obj, feed_data
+
+    @classmethod
+    def _response(cls, feed_data, max_age, response_kwargs, compressed=False,
+                  etag=None, last_modified=None):
+        """Create a useful response-type object for a feed.
+
+        :param feed_data: The content of the feed.
+        :param max_age: The value calculated by max_cache_age().
+        :param response_kwargs: Extra keyword arguments to pass into
+            the OPDSFeedResponse constructor.
+        :param compressed: If this is True, `feed_data` is gzip-compressed.
+        :param etag: The ETag of the feed, if known.
+        :param last_modified: The time the feed was generated, if known.
+        """
         # Set some defaults in case the caller didn't pass them in.
         if isinstance(max_age, int):
             response_kwargs.setdefault('max_age', max_age)
@@ -197,6 +371,12 @@ class CachedFeed(Base):
             # internal cache.
             response_kwargs['max_age'] = 0
 
+        if compressed:
+            response_kwargs['gzipped'] = True
+        if etag is not None:
+            response_kwargs.setdefault('etag', etag)
+        if last_modified is not None:
+            response_kwargs.setdefault('last_modified', last_modified)
         return OPDSFeedResponse(
             response=feed_data,
             **response_kwargs
@@ -342,14 +522,242 @@ class CachedFeed(Base):
             pagination_key=pagination_key
         )
 
+    @classmethod
+    def configure_local_cache(cls, max_entries=LOCAL_CACHE_MAX_ENTRIES,
+                              max_bytes=LOCAL_CACHE_MAX_BYTES,
+                              ttl=LOCAL_CACHE_TTL):
+        """Enable (or disable) the in-process cache of feed content.
+
+        The in-process cache saves a database round-trip and the
+        transfer of the feed content on most requests for popular
+        feeds. Since other processes may update a feed without this
+        process knowing about it, a feed will be served from the
+        in-process cache for at most `ttl` seconds.
+
+        :param max_entries: The maximum number of feeds to keep in
+            memory. If this is zero or None, the in-process cache is
+            disabled.
+        :param max_bytes: The maximum total size of the feeds to keep
+            in memory.
+        :param ttl: The maximum number of seconds a feed will be kept
+            in memory.
+        """
+        if not max_entries:
+            cls.local_cache = None
+            return
+        cls.local_cache = LRUCache(
+            max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+            size_function=lambda entry: len(entry.compressed_content)
+        )
+
+    @classmethod
+    def invalidate_local_cache(cls, library_id=None, lane_id=None):
+        """Evict feeds from the in-process cache.
+
+        :param library_id: Evict every feed associated with the Library
+            with this ID.
+        :param lane_id: Evict every feed associated with the Lane
+            with this ID.
+
+        If neither argument is provided, every feed is evicted.
+        """
+        cache = cls.local_cache
+        if cache is None:
+            return
+        if library_id is None and lane_id is None:
+            cache.clear()
+            return
+
+        def matches(key):
+            return (
+                (library_id is not None and key.library == library_id)
+                or (lane_id is not None and key.lane_id == lane_id)
+            )
+        cache.delete_where(matches)
+
+    @classmethod
+    def _local_cache_key(cls, keys):
+        """Turn a CachedFeedKeys into a key for the in-process cache.
+
+        The CachedFeedKeys may contain database objects, which can't
+        be shared between sessions, so they are replaced by their
+        database IDs.
+        """
+        library_id = getattr(keys.library, 'id', keys.library)
+        work_id = getattr(keys.work, 'id', keys.work)
+        return keys._replace(library=library_id, work=work_id)
+
+    @classmethod
+    def _local_cache_lookup(cls, keys):
+        """Look for a feed in the in-process cache.
+
+        :return: A LocalCacheEntry, or None.
+        """
+        cache = cls.local_cache
+        if cache is None:
+            return None
+        key = cls._local_cache_key(keys)
+        entry = cache.get(key)
+        if entry is None:
+            return None
+
+        last_update = Configuration._site_configuration_last_update()
+        if last_update and entry.cached_at < last_update:
+            # The site configuration has changed since this feed was
+            # cached, and the feed may no longer be accurate.
+            cache.delete(key)
+            return None
+        return entry
+
+    @classmethod
+    def _local_cache_store(cls, keys, feed_obj):
+        """Put a feed obtained from the database into the
+        in-process cache.
+        """
+        cache = cls.local_cache
+        if cache is None or feed_obj is None or not feed_obj.has_content:
+            return
+        compressed_content = feed_obj.compressed_content
+        if compressed_content is None:
+            # This feed was stored before feeds were compressed.
+            compressed_content = gzip_compress(feed_obj.content)
+        entry = cls.LocalCacheEntry(
+            timestamp=feed_obj.timestamp,
+            compressed_content=compressed_content, etag=feed_obj.etag,
+            cached_at=datetime.datetime.utcnow()
+        )
+        cache.set(cls._local_cache_key(keys), entry)
+
+    @classmethod
+    def configure_single_flight(cls, grace_period):
+        """Make sure only one worker at a time regenerates a given feed.
+
+        When a feed goes stale, the first worker to notice takes a lock
+        and regenerates the feed. Any other worker that asks for the
+        feed in the meantime gets the stale feed instead of
+        regenerating it a second time. The lock is a Postgres advisory
+        lock, so this works across processes and hosts.
+
+        :param grace_period: A stale feed will be served for at most
+            this number of seconds after it went stale. After that,
+            every worker regenerates it, as though single-flight
+            mode were off. If this is None, single-flight mode is
+            turned off.
+        """
+        if isinstance(grace_period, datetime.timedelta):
+            grace_period = grace_period.total_seconds()
+        cls.single_flight_grace_period = grace_period
+
+    @classmethod
+    def _within_grace_period(cls, feed_obj, max_age):
+        """Is `feed_obj` stale, but recent enough to be served while
+        another worker regenerates it?
+
+        This doesn't load the feed content, which may have been
+        deferred because the request might end in a 304 response.
+        """
+        grace_period = cls.single_flight_grace_period
+        if grace_period is None:
+            return False
+        if (feed_obj is None or not feed_obj.content_stored
+            or feed_obj.timestamp is None):
+            return False
+        if max_age in (cls.CACHE_FOREVER, cls.IGNORE_CACHE) or max_age <= 0:
+            # Either the feed can't go stale, or the caller insists on a
+            # fresh feed.
+            return False
+        cutoff = feed_obj.timestamp + datetime.timedelta(
+            seconds=max_age + grace_period
+        )
+        return cutoff > datetime.datetime.utcnow()
+
+    @classmethod
+    def _advisory_lock_id(cls, key):
+        """Convert a key from _local_cache_key() into a number that
+        can be used as a Postgres advisory lock ID.
+        """
+        digest = hashlib.md5(repr(tuple(key))).digest()
+        return struct.unpack(b"!q", digest[:8])[0]
+
+    @classmethod
+    def _acquire_regeneration_lock(cls, _db, keys):
+        """Try to acquire the right to regenerate a feed.
+
+        This never blocks. The in-process lock is released by
+        _release_regeneration_lock(); the Postgres lock is released
+        automatically when the current transaction ends, so that
+        other workers will see the regenerated feed as soon as they
+        are able to take the lock.
+
+        :return: A value to pass into _release_regeneration_lock(), or
+            None if someone else is already regenerating the feed.
+        """
+        key = cls._local_cache_key(keys)
+        with cls._regeneration_locks_lock:
+            lock = cls._regeneration_locks.setdefault(key, threading.Lock())
+        if not lock.acquire(False):
+            # Another thread in this process is regenerating the feed.
+            return None
+
+        acquired = _db.execute(
+            text("SELECT pg_try_advisory_xact_lock(:lock_id)"),
+            dict(lock_id=cls._advisory_lock_id(key))
+        ).scalar()
+        if not acquired:
+            # Another process is regenerating the feed.
+            cls._release_regeneration_lock(key)
+            return None
+        return key
+
+    @classmethod
+    def _release_regeneration_lock(cls, key):
+        """Release the in-process lock acquired by
+        _acquire_regeneration_lock().
+        """
+        with cls._regeneration_locks_lock:
+            lock = cls._regeneration_locks.pop(key, None)
+        if lock is not None:
+            lock.release()
+
+    @property
+    def has_content(self):
+        """Does this CachedFeed have any content at all?
+
+        This is cheaper than checking .content, which may have to
+        decompress the feed.
+        """
+        return self._content is not None or self.compressed_content is not None
+
+    @property
+    def content(self):
+        """The content of the feed, as a Unicode string."""
+        if self.compressed_content is not None:
+            return gzip_decompress(self.compressed_content).decode("utf8")
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        """Compress and store new content for this feed."""
+        self._content = None
+        if value is None:
+            self.compressed_content = None
+            self.etag = None
+            return
+        if isinstance(value, unicode):
+            value = value.encode("utf8")
+        self.compressed_content = gzip_compress(value)
+        self.etag = unicode(OPDSFeedResponse.calculate_etag(value))
+
     def update(self, _db, content):
         self.content = content
         self.timestamp = datetime.datetime.utcnow()
         flush(_db)
 
     def __repr__(self):
-        if self.content:
-            length = len(self.content)
+        if self.compressed_content is not None:
+            length = "%d compressed" % len(self.compressed_content)
+        elif self._content:
+            length = len(self._content)
         else:
             length = "No content"
         return "<CachedFeed #%s %s %s %s %s %s %s >" % (
@@ -193,6 +193,7 @@ class ExternalIntegration(Base, HasFullTableCache):
 
     # Integrations with SEARCH_GOAL
     ELASTICSEARCH = u'Elasticsearch'
+    LOCAL_SEARCH = u'Local search'
 
     # Integrations with DRM_GOAL
     ADOBE_VENDOR_ID = u'Adobe Vendor ID'
@@ -38,6 +38,10 @@ class BaseCoverageRecord(object):
     PERSISTENT_FAILURE = u'persistent failure'
     REGISTERED = u'registered'
 
+    # Some process has claimed the item and is working on it. The
+    # record's timestamp is the time at which that claim expires.
+    IN_PROGRESS = u'in progress'
+
     ALL_STATUSES = [REGISTERED, SUCCESS, TRANSIENT_FAILURE, PERSISTENT_FAILURE]
 
     # Count coverage as attempted if the record is not 'registered'.
@@ -49,7 +53,7 @@ class BaseCoverageRecord(object):
     DEFAULT_COUNT_AS_COVERED = [SUCCESS, PERSISTENT_FAILURE]
 
     status_enum = Enum(SUCCESS, TRANSIENT_FAILURE, PERSISTENT_FAILURE,
-                       REGISTERED, name='coverage_status')
+                       REGISTERED, IN_PROGRESS, name='coverage_status')
 
     @classmethod
     def not_covered(cls, count_as_covered=None,
@@ -75,8 +79,14 @@ class BaseCoverageRecord(object):
 
         # If we're looking for specific coverage statuses, then a
         # record does not count if it has some other status.
+        # An item that some other process is working on counts as
+        # covered until that process's claim on it expires.
+        claimed = and_(
+            cls.status==cls.IN_PROGRESS,
+            cls.timestamp > datetime.datetime.utcnow()
+        )
         missing = or_(
-            missing, ~cls.status.in_(count_as_covered)
+            missing, and_(~cls.status.in_(count_as_covered), ~claimed)
         )
 
         # If the record's timestamp is before the cutoff time, we
@@ -525,6 +535,7 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
     GENERATE_OPDS_OPERATION = u'generate-opds'
     GENERATE_MARC_OPERATION = u'generate-marc'
     UPDATE_SEARCH_INDEX_OPERATION = u'update-search-index'
+    UPDATE_SEARCH_INDEX_AVAILABILITY_OPERATION = u'update-search-availability'
 
     id = Column(Integer, primary_key=True)
     work_id = Column(Integer, ForeignKey('works.id'), index=True)
@@ -25,6 +25,7 @@ from patron import (
     Hold,
 )
 
+from collections import defaultdict
 import datetime
 import logging
 from sqlalchemy import (
@@ -39,7 +40,10 @@ from sqlalchemy import (
     Unicode,
     UniqueConstraint,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import (
+    joinedload,
+    relationship,
+)
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import func
 
@@ -594,7 +598,7 @@ class LicensePool(Base):
             # LicensePool.
             self.last_checked = as_of
             if self.work:
-                self.work.last_update_time = as_of
+                self.work.availability_updated(as_of)
 
         if changes_made:
             message, args = self.circulation_changelog(
@@ -1110,14 +1114,62 @@ class LicensePool(Base):
             self._open_access_download_url = url
         return self._open_access_download_url
 
+    @classmethod
+    def preload_open_access_links(cls, _db, pools):
+        """Find the best open-access link for many LicensePools at once.
+
+        Otherwise, finding the best open-access link takes a separate
+        query for every LicensePool that doesn't have it cached.
+
+        :param pools: A list of LicensePools. Any that aren't open
+            access, or already have the link cached, will be ignored.
+        """
+        from resource import (
+            Hyperlink,
+            Resource,
+        )
+        needed = [
+            pool for pool in pools
+            if pool.open_access and not pool._open_access_download_url
+            and pool.identifier_id is not None
+        ]
+        if not needed:
+            return
+        identifier_ids = set(pool.identifier_id for pool in needed)
+        qu = _db.query(Hyperlink.identifier_id, Resource).join(
+            Resource.links
+        ).filter(
+            Hyperlink.identifier_id.in_(identifier_ids)
+        ).filter(
+            Hyperlink.rel==LinkRelations.OPEN_ACCESS_DOWNLOAD
+        ).options(
+            joinedload(Resource.representation)
+        )
+        resources_by_identifier = defaultdict(list)
+        for identifier_id, resource in qu:
+            resources_by_identifier[identifier_id].append(resource)
+
+        for pool in needed:
+            resource = pool._best_open_access_resource(
+                resources_by_identifier[pool.identifier_id]
+            )
+            if resource and resource.representation:
+                pool._open_access_download_url = (
+                    resource.representation.public_url
+                )
+
     @property
     def best_open_access_resource(self):
         """Determine the best open-access Resource currently provided by this
         LicensePool.
         """
+        return self._best_open_access_resource(self.open_access_links)
+
+    def _best_open_access_resource(self, resources):
+        """Choose the best of the given open-access Resources."""
         best = None
         best_priority = -1
-        for resource in self.open_access_links:
+        for resource in resources:
             if not any(
                     [resource.representation and
                      resource.representation.media_type and
@@ -10,6 +10,7 @@ from sqlalchemy.orm.session import Session
 from . import (
     Base,
 )
+from cachedfeed import CachedFeed
 from admin import (
     Admin,
     AdminRole,
@@ -215,6 +216,13 @@ def refresh_library_cache(mapper, connection, target):
     # the cache will be repopulated.
     Library.reset_cache()
 
+@event.listens_for(Library, 'after_update')
+@event.listens_for(Library, 'after_delete')
+def library_feeds_out_of_date(mapper, connection, target):
+    # Feeds for this library that are cached in memory may no longer
+    # be accurate.
+    CachedFeed.invalidate_local_cache(library_id=target.id)
+
 # When a pool gets a work and a presentation edition for the first time,
 # the work should be added to any custom lists associated with the pool's
 # collection.
@@ -295,7 +303,11 @@ def last_update_time_change(target, value, oldvalue, initator):
     """A Work needs to have its search document re-indexed whenever its
     last_update_time changes.
 
-    Among other things, this happens whenever the LicensePool's availability
-    information changes.
+    The exception is when the change comes from
+    Work.availability_updated. Then only the availability information
+    in the search document needs to be updated, and that method takes
+    care of it.
     """
+    if target._availability_update_in_progress:
+        return
     target.external_index_needs_updating()
@@ -65,6 +65,7 @@ from sqlalchemy.orm.session import Session
 from sqlalchemy.sql import select
 from sqlalchemy.sql.expression import (
     and_,
+    exists,
     extract,
     or_,
     select,
@@ -106,6 +107,10 @@ class Work(Base):
     CURRENTLY_AVAILABLE = "currently_available"
     ALL = "all"
 
+    # This is True while availability_updated is changing
+    # last_update_time, so that change doesn't trigger a full reindex.
+    _availability_update_in_progress = False
+
     # If no quality data is available for a work, it will be assigned
     # a default quality based on where we got it.
     #
@@ -1203,6 +1208,31 @@ class Work(Base):
             WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
         )
 
+    def external_index_availability_needs_updating(self):
+        """Mark this work as needing the availability information in
+        its search document updated. This is much cheaper than a full
+        reindex, and it's all that's needed when only the
+        availability of the work's LicensePools has changed.
+        """
+        return self._reset_coverage(
+            WorkCoverageRecord.UPDATE_SEARCH_INDEX_AVAILABILITY_OPERATION
+        )
+
+    def availability_updated(self, as_of):
+        """Note that availability information for one of this Work's
+        LicensePools was updated as of the given time.
+
+        This changes last_update_time without triggering a full
+        reindex of the work; only the availability information in its
+        search document will be updated.
+        """
+        self._availability_update_in_progress = True
+        try:
+            self.last_update_time = as_of
+        finally:
+            self._availability_update_in_progress = False
+        self.external_index_availability_needs_updating()
+
     def update_external_index(self, client, add_coverage_record=True):
         """Create a WorkCoverageRecord so that this work's
         entry in the search index can be modified or deleted.
@@ -1406,6 +1436,131 @@ class Work(Base):
     # that Elasticsearch can parse as a date.
     ELASTICSEARCH_TIME_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS"."MS'
 
+    @classmethod
+    def _query_to_json(cls, query):
+        """Convert the results of a query to a JSON object."""
+        return select(
+            [func.row_to_json(literal_column(query.name))]
+        ).select_from(query)
+
+    @classmethod
+    def _query_to_json_array(cls, query):
+        """Convert the results of a query into a JSON array."""
+        return select(
+            [func.array_to_json(
+                func.array_agg(
+                    func.row_to_json(
+                        literal_column(query.name)
+                    )))]
+        ).select_from(query)
+
+    @classmethod
+    def _licensepools_search_query(cls, works_alias):
+        """Build the subquery behind the 'licensepools' section of a
+        search document.
+
+        :param works_alias: A subquery with 'work_id', 'quality' and
+            'presentation_edition_id' columns.
+        """
+        from licensing import LicensePool
+        from resource import (
+            Hyperlink,
+            Representation,
+            Resource,
+        )
+
+        work_id_column = literal_column(
+            works_alias.name + '.' + works_alias.c.work_id.name
+        )
+
+        work_presentation_edition_id_column = literal_column(
+            works_alias.name + '.' + works_alias.c.presentation_edition_id.name
+        )
+
+        work_quality_column = literal_column(
+            works_alias.name + '.' + works_alias.c.quality.name
+        )
+
+        # We need information about LicensePools for a few reasons:
+        #
+        # * We always want to filter out Works that are not available
+        #   in any of the collections associated with a given library
+        #   -- either because no licenses are owned, because the
+        #   LicensePools are suppressed, or (TODO) because there are no
+        #   delivery mechanisms.
+        # * A patron may want to sort a list of books by availability
+        #   date.
+        # * A patron may want to show only books currently available,
+        #   or only open-access books.
+        #
+        # Whenever LicensePool.open_access is changed, or
+        # licenses_available moves to zero or away from zero, the
+        # LicensePool signals that its Work needs reindexing.
+        #
+        # The work quality field is stored in the main document, but
+        # it's also stored here, so that we can apply a nested filter
+        # that combines quality with other fields found only in the subdocument.
+        #
+        # 'open_access_link' says whether LicensePool.best_open_access_link
+        # would find a link: either one has been cached, or there's an
+        # open-access Resource with a Representation in a supported
+        # media type and a public URL.
+        open_access_resource = exists().where(
+            and_(
+                Hyperlink.identifier_id==LicensePool.identifier_id,
+                Hyperlink.rel==LinkRelations.OPEN_ACCESS_DOWNLOAD,
+                Hyperlink.resource_id==Resource.id,
+                Resource.representation_id==Representation.id,
+                or_(*[
+                    Representation.media_type.startswith(media_type)
+                    for media_type
+                    in Representation.SUPPORTED_BOOK_MEDIA_TYPES
+                ]),
+                func.coalesce(
+                    Representation.mirror_url, Representation.url,
+                    Resource.url
+                ) != None,
+            )
+        )
+        licensepools = select(
+            [
+                LicensePool.id.label('licensepool_id'),
+                LicensePool.data_source_id.label('data_source_id'),
+                LicensePool.collection_id.label('collection_id'),
+                LicensePool.open_access.label('open_access'),
+                LicensePool.suppressed,
+                LicensePool.superceded,
+                (LicensePool.licenses_available > 0).label('available'),
+                (LicensePool.licenses_owned > 0).label('licensed'),
+                and_(
+                    LicensePool.open_access,
+                    or_(
+                        LicensePool._open_access_download_url != None,
+                        open_access_resource,
+                    )
+                ).label('open_access_link'),
+                work_quality_column,
+                Edition.medium,
+                func.extract(
+                    "EPOCH",
+                    LicensePool.availability_time,
+                ).label('availability_time'),
+                Identifier.type.label('identifier_type'),
+                Identifier.identifier.label('identifier'),
+            ]
+        ).where(
+            and_(
+                LicensePool.work_id==work_id_column,
+                LicensePool.identifier_id==Identifier.id,
+                work_presentation_edition_id_column==Edition.id,
+                or_(
+                    LicensePool.open_access,
+                    LicensePool.licenses_owned>0,
+                ),
+            )
+        ).alias("licensepools_subquery")
+        return licensepools
+
     @classmethod
     def to_search_documents(cls, works, policy=None):
         """Generate search documents for these Works.
@@ -1458,6 +1613,7 @@ class Work(Base):
              Work.popularity,
              Work.presentation_ready,
              Work.presentation_edition_id,
+             Work.simple_opds_entry,
              func.extract(
                  "EPOCH",
                  Work.last_update_time,
@@ -1475,29 +1631,8 @@ class Work(Base):
             works_alias.name + '.' + works_alias.c.work_id.name
         )
 
-        work_presentation_edition_id_column = literal_column(
-            works_alias.name + '.' + works_alias.c.presentation_edition_id.name
-        )
-
-        work_quality_column = literal_column(
-            works_alias.name + '.' + works_alias.c.quality.name
-        )
-
-        def query_to_json(query):
-            """Convert the results of a query to a JSON object."""
-            return select(
-                [func.row_to_json(literal_column(query.name))]
-            ).select_from(query)
-
-        def query_to_json_array(query):
-            """Convert the results of a query into a JSON array."""
-            return select(
-                [func.array_to_json(
-                    func.array_agg(
-                        func.row_to_json(
-                            literal_column(query.name)
-                        )))]
-            ).select_from(query)
+        query_to_json = cls._query_to_json
+        query_to_json_array = cls._query_to_json_array
 
         # This subquery gets Collection IDs for collections
         # that own more than zero licenses for this book.
@@ -1506,53 +1641,8 @@ class Work(Base):
             Subject,
         )
         from customlist import CustomListEntry
-        from licensing import LicensePool, LicensePoolDeliveryMechanism
 
-        # We need information about LicensePools for a few reasons:
-        #
-        # * We always want to filter out Works that are not available
-        #   in any of the collections associated with a given library
-        #   -- either because no licenses are owned, because the
-        #   LicensePools are suppressed, or (TODO) because there are no
-        #   delivery mechanisms.
-        # * A patron may want to sort a list of books by availability
-        #   date.
-        # * A patron may want to show only books currently available,
-        #   or only open-access books.
-        #
-        # Whenever LicensePool.open_access is changed, or
-        # licenses_available moves to zero or away from zero, the
-        # LicensePool signals that its Work needs reindexing.
-        #
-        # The work quality field is stored in the main document, but
-        # it's also stored here, so that we can apply a nested filter
-        # that combines quality with other fields found only in the subdocument.
-        licensepools = select(
-            [
-                LicensePool.id.label('licensepool_id'),
-                LicensePool.data_source_id.label('data_source_id'),
-                LicensePool.collection_id.label('collection_id'),
-                LicensePool.open_access.label('open_access'),
-                LicensePool.suppressed,
-                (LicensePool.licenses_available > 0).label('available'),
-                (LicensePool.licenses_owned > 0).label('licensed'),
-                work_quality_column,
-                Edition.medium,
-                func.extract(
-                    "EPOCH",
-                    LicensePool.availability_time,
-                ).label('availability_time')
-            ]
-        ).where(
-            and_(
-                LicensePool.work_id==work_id_column,
-                work_presentation_edition_id_column==Edition.id,
-                or_(
-                    LicensePool.open_access,
-                    LicensePool.licenses_owned>0,
-                ),
-            )
-        ).alias("licensepools_subquery")
+        licensepools = cls._licensepools_search_query(works_alias)
         licensepools_json = query_to_json_array(licensepools)
 
         # This subquery gets CustomList IDs for all lists
@@ -1696,6 +1786,10 @@ class Work(Base):
              works_alias.c.presentation_ready,
              works_alias.c.last_update_time,
 
+             # The cached OPDS entry isn't searchable, but it lets a
+             # feed be built from search results alone.
+             works_alias.c.simple_opds_entry.label('opds_entry'),
+
              # Convert true/false to "Fiction"/"Nonfiction".
              case(
                     [(works_alias.c.fiction==True, literal_column("'Fiction'"))],
@@ -1761,6 +1855,49 @@ class Work(Base):
         """Generate a search document for this Work."""
         return Work.to_search_documents([self])[0]
 
+    @classmethod
+    def to_availability_search_documents(cls, works):
+        """Generate partial search documents for these Works, containing
+        only the fields that change along with their availability:
+        'licensepools' and 'last_update_time'.
+
+        This only needs the works, licensepools, identifiers and
+        editions tables, so it's much cheaper than
+        to_search_documents.
+        """
+        if not works:
+            return []
+
+        _db = Session.object_session(works[0])
+
+        works_alias = select(
+            [Work.id.label('work_id'),
+             Work.quality,
+             Work.presentation_edition_id,
+             func.extract(
+                 "EPOCH",
+                 Work.last_update_time,
+             ).label('last_update_time')
+            ],
+            and_(
+                Work.id.in_((w.id for w in works)),
+                Work.presentation_edition_id != None,
+            )
+        ).alias('works_alias')
+
+        licensepools = cls._licensepools_search_query(works_alias)
+        search_data = select(
+            [works_alias.c.work_id.label("_id"),
+             works_alias.c.last_update_time,
+             cls._query_to_json_array(licensepools).label("licensepools"),
+            ]
+        ).select_from(
+            works_alias
+        ).alias("search_data_subquery")
+
+        result = _db.execute(cls._query_to_json(search_data))
+        return [r[0] for r in result]
+
     def mark_licensepools_as_superceded(self):
         """Make sure that all but the single best open-access LicensePool for
         this Work are superceded. A non-open-access LicensePool should
@@ -1842,7 +1979,7 @@ class Work(Base):
         if search_index is None:
             try:
                 from ..external_search import ExternalSearchIndex
-                search_index = ExternalSearchIndex(_db)
+                search_index = ExternalSearchIndex.load(_db)
             except CannotLoadConfiguration, e:
                 # No search index is configured. This is fine -- just skip that part.
                 pass
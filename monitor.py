@@ -1,10 +1,13 @@
 from nose.tools import set_trace
+from collections import namedtuple
 import datetime
 import os
 import logging
 import time
 import traceback
+from sqlalchemy import inspect
 from sqlalchemy.orm import defer
+from sqlalchemy.orm.interfaces import ONETOMANY
 from sqlalchemy.sql import select
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import (
@@ -30,6 +33,7 @@ from model import (
     ExternalIntegration,
     CustomListEntry,
     Identifier,
+    Library,
     LicensePool,
     Patron,
     PresentationCalculationPolicy,
@@ -740,6 +744,247 @@ class CustomListEntryWorkUpdateMonitor(CustomListEntrySweepMonitor):
         item.set_work()
 
 
+class CachedFeedPrewarmMonitor(Monitor):
+    """Refresh the cached feeds for every lane before they go stale,
+    so that patrons don't have to wait while they're generated.
+
+    For every visible lane in a library, the groups feed (if the lane
+    has sublanes) and the first page of the default feed are
+    considered. Any of these feeds that are missing, or that will go
+    stale within the refresh window, are regenerated, most popular
+    first.
+
+    Generating a feed requires an Annotator that knows how to build
+    URLs in an application-specific way, so this Monitor will probably
+    need to be given one, or subclassed so that annotator_for() does
+    the right thing.
+    """
+    SERVICE_NAME = "Cached Feed Pre-warmer"
+
+    # A feed will be refreshed if it's due to go stale within this
+    # amount of time.
+    REFRESH_WINDOW = datetime.timedelta(minutes=5)
+
+    # A feed that would otherwise be cached forever will be refreshed
+    # once it's this old.
+    CACHE_FOREVER_REFRESH_AGE = datetime.timedelta(hours=1)
+
+    # This named tuple describes a single feed that might need to be
+    # refreshed.
+    PrewarmCandidate = namedtuple(
+        'PrewarmCandidate',
+        ['worklist', 'facets', 'pagination', 'depth', 'expires']
+    )
+
+    def __init__(self, _db, annotator=None, libraries=None,
+                 search_engine=None, refresh_window=None, max_feeds=None):
+        """Constructor.
+
+        :param annotator: An Annotator (or Annotator subclass) to use
+            when generating feeds.
+        :param libraries: Only refresh feeds for these Libraries. By
+            default, feeds for every library are refreshed.
+        :param search_engine: An ExternalSearchIndex to use when
+            generating feeds.
+        :param refresh_window: A feed will be refreshed if it's due to
+            go stale within this number of seconds (or timedelta).
+        :param max_feeds: Refresh at most this number of feeds in a
+            single run.
+        """
+        super(CachedFeedPrewarmMonitor, self).__init__(_db)
+        self.annotator = annotator
+        self.library_ids = None
+        if libraries is not None:
+            self.library_ids = [x.id for x in libraries]
+        self.search_engine = search_engine
+        if refresh_window is None:
+            refresh_window = self.REFRESH_WINDOW
+        if not isinstance(refresh_window, datetime.timedelta):
+            refresh_window = datetime.timedelta(seconds=refresh_window)
+        self.refresh_window = refresh_window
+        self.max_feeds = max_feeds
+
+    @property
+    def libraries(self):
+        qu = self._db.query(Library)
+        if self.library_ids is not None:
+            qu = qu.filter(Library.id.in_(self.library_ids))
+        return qu.order_by(Library.id)
+
+    def run_once(self, *args, **kwargs):
+        now = datetime.datetime.utcnow()
+        candidates = []
+        not_due = 0
+        for library in self.libraries:
+            for candidate in self.candidates(library):
+                if candidate.expires is None or candidate.expires > (
+                    now + self.refresh_window
+                ):
+                    not_due += 1
+                else:
+                    candidates.append(candidate)
+
+        candidates.sort(key=self.priority)
+        if self.max_feeds is not None:
+            candidates = candidates[:self.max_feeds]
+
+        refreshed = 0
+        failures = 0
+        total_time = 0
+        slowest = 0
+        for candidate in candidates:
+            started = time.time()
+            try:
+                self.refresh(candidate)
+            except Exception, e:
+                self._db.rollback()
+                self.log.error(
+                    "Could not refresh feed for %s", self.describe(candidate),
+                    exc_info=e
+                )
+                failures += 1
+                continue
+            self._db.commit()
+            elapsed = time.time() - started
+            total_time += elapsed
+            slowest = max(slowest, elapsed)
+            refreshed += 1
+            self.log.info(
+                "Refreshed feed for %s in %.2f sec", self.describe(candidate),
+                elapsed
+            )
+
+        achievements = (
+            "Feeds refreshed: %d. Failures: %d. Not due for refresh: %d. "
+            "Time spent refreshing: %.2f sec. Slowest feed: %.2f sec." % (
+                refreshed, failures, not_due, total_time, slowest
+            )
+        )
+        return TimestampData(achievements=achievements)
+
+    def candidates(self, library):
+        """Find every feed for `library` that might need refreshing.
+
+        :yield: A sequence of PrewarmCandidate objects.
+        """
+        from lane import (
+            Facets,
+            FeaturedFacets,
+            Pagination,
+            WorkList,
+        )
+        top_level = WorkList.top_level_for_library(self._db, library)
+        queue = [(top_level, 0)]
+        while queue:
+            worklist, depth = queue.pop(0)
+            if worklist.has_visible_children:
+                yield self.candidate(
+                    worklist, FeaturedFacets.default(library), None, depth
+                )
+            yield self.candidate(
+                worklist, Facets.default(library), Pagination.default(),
+                depth
+            )
+            for child in worklist.visible_children:
+                queue.append((child, depth+1))
+
+    def candidate(self, worklist, facets, pagination, depth):
+        """Find out when a feed will go stale.
+
+        :return: A PrewarmCandidate. Its .expires will be None if the
+            feed is never cached, and therefore can't be pre-warmed.
+        """
+        keys = CachedFeed._prepare_keys(self._db, worklist, facets, pagination)
+        max_age = CachedFeed.max_cache_age(worklist, keys.feed_type, facets)
+        if max_age is CachedFeed.IGNORE_CACHE:
+            max_age = 0
+        elif max_age is CachedFeed.CACHE_FOREVER:
+            max_age = self.CACHE_FOREVER_REFRESH_AGE.total_seconds()
+
+        expires = None
+        if max_age > 0:
+            feed = get_one(
+                self._db, CachedFeed, on_multiple='interchangeable',
+                type=keys.feed_type, library=keys.library, work=keys.work,
+                lane_id=keys.lane_id, unique_key=keys.unique_key,
+                facets=keys.facets_key, pagination=keys.pagination_key
+            )
+            if feed is None or feed.timestamp is None:
+                # The feed has never been generated. It's overdue.
+                expires = datetime.datetime.min
+            else:
+                expires = feed.timestamp + datetime.timedelta(seconds=max_age)
+        return self.PrewarmCandidate(
+            worklist=worklist, facets=facets, pagination=pagination,
+            depth=depth, expires=expires
+        )
+
+    def request_frequency(self, candidate):
+        """How often do patrons request this feed?
+
+        There's no record of this in the database, so by default every
+        feed is considered equally popular. A subclass with access to
+        request logs or analytics can provide real numbers.
+
+        :return: A number; bigger numbers mean more requests.
+        """
+        return 0
+
+    def priority(self, candidate):
+        """Determine the order in which feeds are refreshed.
+
+        The most frequently requested feeds come first. Among feeds
+        that are equally popular, feeds for lanes closer to the top
+        of the lane hierarchy come first, since patrons pass through
+        them on their way to the others. After that, the feeds that
+        went stale (or will go stale) first come first.
+
+        :return: A sort key.
+        """
+        return (
+            -self.request_frequency(candidate), candidate.depth,
+            candidate.pagination is not None, candidate.expires
+        )
+
+    def annotator_for(self, worklist, facets):
+        """Find the Annotator to use when generating a feed."""
+        return self.annotator
+
+    def describe(self, candidate):
+        if candidate.pagination is None:
+            feed_type = "groups"
+        else:
+            feed_type = "page"
+        return "%s (%s)" % (
+            candidate.worklist.display_name or candidate.worklist.unique_key,
+            feed_type
+        )
+
+    def refresh(self, candidate):
+        """Regenerate a feed and store it in the database."""
+        from opds import AcquisitionFeed
+        worklist = candidate.worklist
+        facets = candidate.facets
+        pagination = candidate.pagination
+        annotator = AcquisitionFeed._make_annotator(
+            self.annotator_for(worklist, facets)
+        )
+        title = worklist.display_name
+        if pagination is None:
+            url = annotator.groups_url(worklist, facets)
+            AcquisitionFeed.groups(
+                self._db, title, url, worklist, annotator, facets=facets,
+                max_age=0, search_engine=self.search_engine
+            )
+        else:
+            url = annotator.feed_url(worklist, facets, pagination)
+            AcquisitionFeed.page(
+                self._db, title, url, worklist, annotator, facets=facets,
+                pagination=pagination, max_age=0,
+                search_engine=self.search_engine
+            )
+
+
 class ReaperMonitor(Monitor):
     """A Monitor that deletes database rows that have expired but
     have no other process to delete them.
@@ -762,11 +1007,18 @@ class ReaperMonitor(Monitor):
     and aren't important to the reaping process, put their field names
     into a list called LARGE_FIELDS and the Reaper will avoid fetching
     that information, improving performance.
+
+    By default, rows are deleted a batch at a time with DELETE
+    statements, without loading them into the ORM. This isn't done if
+    the model class has a relationship that cascades deletes; those
+    rows go through delete() one at a time. If your subclass overrides
+    delete() to do extra work, set BULK_DELETE to False.
     """
     MODEL_CLASS = None
     TIMESTAMP_FIELD = None
     MAX_AGE = None
     BATCH_SIZE = 1000
+    BULK_DELETE = True
 
     REGISTRY = []
 
@@ -797,7 +1049,19 @@ class ReaperMonitor(Monitor):
         """
         return self.timestamp_field < self.cutoff
 
+    @property
+    def bulk_delete(self):
+        """Can rows be deleted without going through the ORM?"""
+        if not self.BULK_DELETE:
+            return False
+        return not any(
+            relationship.cascade.delete
+            for relationship in inspect(self.MODEL_CLASS).relationships
+        )
+
     def run_once(self, *args, **kwargs):
+        if self.bulk_delete:
+            return self.run_once_in_bulk()
         rows_deleted = 0
         qu = self.query()
         to_defer = getattr(self.MODEL_CLASS, 'LARGE_FIELDS', [])
@@ -814,6 +1078,62 @@ class ReaperMonitor(Monitor):
             count = qu.count()
         return TimestampData(achievements="Items deleted: %d" % rows_deleted)
 
+    def run_once_in_bulk(self):
+        """Delete rows in batches of up to BATCH_SIZE, in order of id,
+        until there are none left to delete.
+        """
+        id_field = self.MODEL_CLASS.id
+        qu = self.query().with_entities(id_field).order_by(id_field).limit(
+            self.BATCH_SIZE
+        )
+        table = self.MODEL_CLASS.__table__
+        rows_deleted = 0
+        start = time.time()
+        while True:
+            ids = [x for x, in qu]
+            if not ids:
+                break
+            self.clear_references(ids)
+            self._db.execute(table.delete().where(table.c.id.in_(ids)))
+            self._db.commit()
+            rows_deleted += len(ids)
+            self.log.debug("Deleted %d row(s), up to id %d", len(ids), ids[-1])
+            if len(ids) < self.BATCH_SIZE:
+                break
+        elapsed = time.time() - start
+        self.log.info(
+            "Deleted %d row(s) in %.2fsec (%.1f rows/sec)", rows_deleted,
+            elapsed, rows_deleted / max(elapsed, 0.001)
+        )
+        return TimestampData(achievements="Items deleted: %d" % rows_deleted)
+
+    def clear_references(self, ids):
+        """Do what the ORM would do to other rows that refer to the
+        rows about to be deleted: clear their foreign keys, or, for a
+        many-to-many relationship, remove them from the association
+        table.
+        """
+        table = self.MODEL_CLASS.__table__
+        for relationship in inspect(self.MODEL_CLASS).relationships:
+            if relationship.viewonly or relationship.passive_deletes:
+                continue
+            if relationship.secondary is not None:
+                for local, remote in relationship.synchronize_pairs:
+                    values = select([local]).where(table.c.id.in_(ids))
+                    self._db.execute(
+                        relationship.secondary.delete().where(
+                            remote.in_(values)
+                        )
+                    )
+            elif relationship.direction is ONETOMANY:
+                for local, remote in relationship.local_remote_pairs:
+                    values = select([local]).where(table.c.id.in_(ids))
+                    self._db.execute(
+                        remote.table.update().where(
+                            remote.in_(values)
+                        ).values({remote.name: None})
+                    )
+
     def delete(self, row):
         """Delete a row from the database.
 
@@ -859,12 +1179,15 @@ class WorkReaper(ReaperMonitor):
     """
     MODEL_CLASS = Work
 
+    # Works must also be removed from the search index.
+    BULK_DELETE = False
+
     def __init__(self, *args, **kwargs):
         from external_search import ExternalSearchIndex
         search_index_client = kwargs.pop('search_index_client', None)
         super(WorkReaper, self).__init__(*args, **kwargs)
         self.search_index_client = (
-            search_index_client or ExternalSearchIndex(self._db)
+            search_index_client or ExternalSearchIndex.load(self._db)
         )
 
     def query(self):
@@ -883,6 +1206,9 @@ class CollectionReaper(ReaperMonitor):
     """Remove collections that have been marked for deletion."""
     MODEL_CLASS = Collection
 
+    # Collections are deleted through Collection.delete().
+    BULK_DELETE = False
+
     @property
     def where_clause(self):
         """A SQLAlchemy clause that identifies the database rows to be reaped.
@@ -913,29 +1239,67 @@ class ScrubberMonitor(ReaperMonitor):
 
     * SCRUB_FIELD - The field whose value will be set to None when a row
       is scrubbed.
+
+    Rows are scrubbed in ranges of BATCH_SIZE ids, one UPDATE statement
+    per range. A subclass MAY define MAX_ROWS_PER_SECOND (or the
+    `max_rows_per_second` constructor argument may be passed in) to
+    pause between ranges so the scrubber doesn't overload the
+    database.
     """
+    MAX_ROWS_PER_SECOND = None
+
     def __init__(self, *args, **kwargs):
         """Set the name of the Monitor based on which field is being
         scrubbed.
         """
+        max_rows_per_second = kwargs.pop('max_rows_per_second', None)
         super(ScrubberMonitor, self).__init__(*args, **kwargs)
         self.SERVICE_NAME = "Scrubber for %s.%s" % (
             self.MODEL_CLASS.__name__,
             self.SCRUB_FIELD
         )
+        self.max_rows_per_second = (
+            max_rows_per_second or self.MAX_ROWS_PER_SECOND
+        )
 
     def run_once(self, *args, **kwargs):
         """Find all rows that need to be scrubbed, and scrub them."""
         rows_scrubbed = 0
         cls = self.MODEL_CLASS
-        update = cls.__table__.update().where(
-            self.where_clause
-        ).values(
-            {self.SCRUB_FIELD : None}
-        ).returning(cls.id)
-        scrubbed = self._db.execute(update).fetchall()
-        self._db.commit()
-        return TimestampData(achievements="Items scrubbed: %d" % len(scrubbed))
+        table = cls.__table__
+        first_id, last_id = self._db.query(
+            func.min(cls.id), func.max(cls.id)
+        ).filter(self.where_clause).one()
+
+        start = first_id
+        while start is not None and start <= last_id:
+            end = start + self.BATCH_SIZE - 1
+            started_at = time.time()
+            update = table.update().where(
+                and_(self.where_clause, table.c.id.between(start, end))
+            ).values(
+                {self.SCRUB_FIELD : None}
+            )
+            scrubbed = self._db.execute(update).rowcount
+            self._db.commit()
+            rows_scrubbed += scrubbed
+            self.log.debug("Scrubbed %d row(s) in %d-%d", scrubbed, start, end)
+            self.throttle(scrubbed, time.time() - started_at)
+            start = end + 1
+        return TimestampData(achievements="Items scrubbed: %d" % rows_scrubbed)
+
+    def throttle(self, rows, elapsed):
+        """If scrubbing `rows` rows in `elapsed` seconds was faster than
+        max_rows_per_second allows, sleep to make up the difference.
+        """
+        if not self.max_rows_per_second or not rows:
+            return
+        minimum = rows / float(self.max_rows_per_second)
+        if elapsed < minimum:
+            self.sleep(minimum - elapsed)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
 
     @property
     def where_clause(self):
@@ -58,6 +58,7 @@ from lane import (
     WorkList,
 )
 
+from util.cache import LRUCache
 from util.flask_util import (
     OPDSEntryResponse,
     OPDSFeedResponse,
@@ -585,6 +586,55 @@ class AcquisitionFeed(OPDSFeed):
 
     FACET_REL = "http://opds-spec.org/facet"
 
+    # Parsed versions of recently used cached OPDS entries, so that a
+    # popular entry doesn't have to be parsed every time it shows up
+    # in a feed. Each value is a 2-tuple (serialized entry, parsed
+    # entry). Call configure_entry_templates() to change the size of
+    # the cache or disable it.
+    ENTRY_TEMPLATE_CACHE_SIZE = 5000
+    entry_templates = LRUCache(max_entries=ENTRY_TEMPLATE_CACHE_SIZE)
+
+    @classmethod
+    def configure_entry_templates(cls, max_entries=ENTRY_TEMPLATE_CACHE_SIZE):
+        """Change the size of the cache of parsed OPDS entries.
+
+        :param max_entries: The maximum number of parsed entries to keep
+            in memory. If this is zero or None, every cached entry will
+            be parsed every time it's used.
+        """
+        if not max_entries:
+            cls.entry_templates = None
+        else:
+            cls.entry_templates = LRUCache(max_entries=max_entries)
+
+    @classmethod
+    def _parse_cached_entry(cls, work, field, xml):
+        """Turn a cached OPDS entry into an lxml Element.
+
+        Copying a parsed entry is much faster than parsing it, so the
+        parsed version is kept around as a template.
+
+        :param work: The Work the entry is for.
+        :param field: The name of the field where the entry is cached.
+        :param xml: The cached entry, as a string.
+        :return: An Element that can be modified without affecting
+            the template.
+        """
+        cache = cls.entry_templates
+        if cache is None or work.id is None:
+            return etree.fromstring(xml)
+
+        key = (work.id, field, work.last_update_time)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == xml:
+            template = cached[1]
+        else:
+            # Either this entry has never been parsed or it's been
+            # regenerated since it was parsed.
+            template = etree.fromstring(xml)
+            cache.set(key, (xml, template))
+        return copy.deepcopy(template)
+
     @classmethod
     def groups(cls, _db, title, url, worklist, annotator,
                facets=None, max_age=None,
@@ -669,7 +719,9 @@ class AcquisitionFeed(OPDSFeed):
             all_works.append(work)
 
         all_works = annotator.sort_works_for_groups_feed(all_works)
-        feed = AcquisitionFeed(_db, title, url, all_works, annotator)
+        feed = AcquisitionFeed(
+            _db, title, url, all_works, annotator, streaming=True
+        )
 
         # Regardless of whether or not the entries in feed can be
         # grouped together, we want to apply certain feed-level
@@ -699,10 +751,16 @@ class AcquisitionFeed(OPDSFeed):
     def page(cls, _db, title, url, worklist, annotator,
              facets=None, pagination=None,
              max_age=None, search_engine=None, search_debug=False,
-             **response_kwargs
+             search_only=False, **response_kwargs
     ):
         """Create a feed representing one page of works from a given lane.
 
+        :param search_only: If this is True, the feed will be built
+            from search results alone wherever possible, without
+            loading Works from the database. This is only safe if
+            `annotator` uses the simple OPDS entry and needs nothing
+            from the database that isn't in the search index. See
+            HitBackedWork.
         :param response_kwargs: Extra keyword arguments to pass into
             the OPDSFeedResponse constructor.
 
@@ -716,7 +774,7 @@ class AcquisitionFeed(OPDSFeed):
         def refresh():
             return cls._generate_page(
                 _db, title, url, worklist, annotator, facets, pagination,
-                search_engine, search_debug
+                search_engine, search_debug, search_only
             )
 
         response_kwargs.setdefault('max_age', max_age)
@@ -728,14 +786,17 @@ class AcquisitionFeed(OPDSFeed):
     @classmethod
     def _generate_page(
         cls, _db, title, url, lane, annotator, facets, pagination,
-        search_engine, search_debug
+        search_engine, search_debug, search_only=False
     ):
         """Internal method called by page() when a cached feed
         must be regenerated.
         """
+        kwargs = dict()
+        if search_only:
+            kwargs['search_only'] = True
         works = lane.works(
             _db, facets=facets, pagination=pagination,
-            search_engine=search_engine, debug=search_debug
+            search_engine=search_engine, debug=search_debug, **kwargs
         )
 
         if not isinstance(works, list):
@@ -749,7 +810,7 @@ class AcquisitionFeed(OPDSFeed):
             # Pagination.page_loaded may or may not have been called
             # yet.
             pagination.page_loaded(works)
-        feed = cls(_db, title, url, works, annotator)
+        feed = cls(_db, title, url, works, annotator, streaming=True)
 
         entrypoints = facets.selectable_entrypoints(lane)
         if entrypoints:
@@ -814,6 +875,8 @@ class AcquisitionFeed(OPDSFeed):
 
     def as_response(self, **kwargs):
         """Convert this feed into an OPDSFEedResponse."""
+        if self.streaming:
+            return OPDSFeedResponse(self.stream(), **kwargs)
         return OPDSFeedResponse(self, **kwargs)
 
     def as_error_response(self, **kwargs):
@@ -982,7 +1045,7 @@ class AcquisitionFeed(OPDSFeed):
             _db, query, search_engine, pagination=pagination, facets=facets
         )
         opds_feed = AcquisitionFeed(
-            _db, title, url, results, annotator=annotator
+            _db, title, url, results, annotator=annotator, streaming=True
         )
         AcquisitionFeed.add_link_to_feed(
             feed=opds_feed.feed, rel='start',
@@ -1022,7 +1085,7 @@ class AcquisitionFeed(OPDSFeed):
         opds_feed.add_breadcrumbs(lane, include_lane=True)
 
         annotator.annotate_feed(opds_feed, lane)
-        return OPDSFeedResponse(response=unicode(opds_feed), **response_kwargs)
+        return opds_feed.as_response(**response_kwargs)
 
     @classmethod
     def single_entry(
@@ -1074,6 +1137,11 @@ class AcquisitionFeed(OPDSFeed):
             response_kwargs['private'] = True
         elif isinstance(entry, etree._Element):
             entry = etree.tostring(entry)
+            # The entry may include information specific to the
+            # client, so the ETag has to be based on the entry itself.
+            response_kwargs.setdefault(
+                'etag', OPDSEntryResponse.calculate_etag(entry)
+            )
 
         # It's common for a single OPDS entry to be returned as the
         # result of an unsafe operation, so we will default to setting
@@ -1081,6 +1149,11 @@ class AcquisitionFeed(OPDSFeed):
         response_kwargs.setdefault('max_age', 0)
         response_kwargs.setdefault('private', True)
 
+        if (isinstance(work, Work) and work.last_update_time
+            and not response_kwargs['private']):
+            # A public entry only changes when the work does.
+            response_kwargs.setdefault('last_modified', work.last_update_time)
+
         return OPDSEntryResponse(response=entry, **response_kwargs)
 
     @classmethod
@@ -1116,18 +1189,29 @@ class AcquisitionFeed(OPDSFeed):
             )
 
     def __init__(self, _db, title, url, works, annotator=None,
-                 precomposed_entries=[]):
+                 precomposed_entries=[], streaming=False):
         """Turn a list of works, messages, and precomposed <opds> entries
         into a feed.
+
+        :param streaming: If this is True, the <entry> tags will not be
+            added to the feed tree. Instead, each one will be created
+            and serialized on its own as the feed is serialized. See
+            stream().
         """
         if not annotator:
             annotator = Annotator
         if callable(annotator):
             annotator = annotator()
         self.annotator = annotator
+        self.streaming = streaming
 
         super(AcquisitionFeed, self).__init__(title, url)
 
+        if streaming:
+            self.works = works
+            self.precomposed_entries = precomposed_entries
+            return
+
         for work in works:
             self.add_entry(work)
 
@@ -1137,6 +1221,38 @@ class AcquisitionFeed(OPDSFeed):
                 entry = entry.tag
             self.feed.append(entry)
 
+    def __unicode__(self):
+        if self.streaming:
+            return u"".join(self.stream())
+        return super(AcquisitionFeed, self).__unicode__()
+
+    def stream(self):
+        """Serialize a streaming feed one piece at a time.
+
+        Each <entry> is created just before it's needed and serialized
+        immediately, so the whole feed never has to exist as an lxml
+        tree. A cached entry is never parsed at all; its annotations
+        are spliced into it.
+
+        :yield: Unicode strings which, put together, make up the feed
+            document.
+        """
+        return self.iter_serialize(self._serialized_entries())
+
+    def _serialized_entries(self):
+        """Create and serialize the entries for a streaming feed."""
+        for work in self.works:
+            entry = self.create_entry(work, as_string=True)
+            if isinstance(entry, OPDSMessage):
+                entry = etree.tounicode(entry.tag)
+            if entry is not None:
+                yield entry
+
+        for entry in self.precomposed_entries:
+            if isinstance(entry, OPDSMessage):
+                entry = entry.tag
+            yield etree.tounicode(entry)
+
     def add_entry(self, work):
         """Attempt to create an OPDS <entry>. If successful, append it to
         the feed.
@@ -1150,8 +1266,12 @@ class AcquisitionFeed(OPDSFeed):
         return entry
 
     def create_entry(self, work, even_if_no_license_pool=False,
-                     force_create=False, use_cache=True):
-        """Turn a work into an entry for an acquisition feed."""
+                     force_create=False, use_cache=True, as_string=False):
+        """Turn a work into an entry for an acquisition feed.
+
+        :param as_string: If this is True, the entry will be returned
+            as a Unicode string rather than an lxml Element.
+        """
         identifier = None
         if isinstance(work, Edition):
             active_edition = work
@@ -1196,7 +1316,7 @@ class AcquisitionFeed(OPDSFeed):
         try:
             return self._create_entry(
                 work, active_license_pool, active_edition, identifier,
-                force_create, use_cache
+                force_create, use_cache, as_string
             )
         except UnfulfillableWork, e:
             logging.info(
@@ -1216,7 +1336,8 @@ class AcquisitionFeed(OPDSFeed):
             return None
 
     def _create_entry(self, work, active_license_pool, edition,
-                      identifier, force_create=False, use_cache=True):
+                      identifier, force_create=False, use_cache=True,
+                      as_string=False):
         """Build a complete OPDS entry for the given Work.
 
         The OPDS entry will contain bibliographic information about
@@ -1237,7 +1358,11 @@ class AcquisitionFeed(OPDSFeed):
             in the appropriate storage field of Work -- either
             simple_opds_entry or verbose_opds_entry. (NOTE: this has some
             overlap with force_create which is difficult to explain.)
-        :return: An lxml Element object
+        :param as_string: If this is True, return the entry as a
+            Unicode string. If the entry is cached, this saves
+            parsing and reserializing it.
+        :return: An lxml Element object, or a Unicode string if
+            `as_string` is True.
         """
         xml = None
         field = self.annotator.opds_cache_field
@@ -1245,8 +1370,15 @@ class AcquisitionFeed(OPDSFeed):
         if field and work and not force_create and use_cache:
             xml = getattr(work, field)
 
+        if xml and as_string:
+            spliced = self._splice_annotations(
+                xml, work, active_license_pool, edition, identifier
+            )
+            if spliced is not None:
+                return spliced
+
         if xml:
-            xml = etree.fromstring(xml)
+            xml = self._parse_cached_entry(work, field, xml)
         else:
             xml = self._make_entry_xml(work, edition)
             data = etree.tounicode(xml)
@@ -1258,8 +1390,55 @@ class AcquisitionFeed(OPDSFeed):
         self.annotator.annotate_work_entry(
             work, active_license_pool, edition, identifier, self, xml)
 
+        if as_string:
+            return etree.tounicode(xml)
         return xml
 
+    # Finds the namespace declarations in a start tag.
+    NAMESPACE_DECLARATION = re.compile(r'xmlns(?::\w+)?="[^"]*"')
+
+    def _splice_annotations(self, xml, work, active_license_pool, edition,
+                            identifier):
+        """Annotate a cached <entry> tag without parsing it.
+
+        The annotations are added to an empty <entry> tag, which is
+        serialized, and the result is inserted just before the end of
+        the cached entry. This works because annotate_work_entry()
+        only ever adds tags to an entry.
+
+        :param xml: A cached <entry> tag, as a string.
+        :return: A Unicode string, or None if the annotations can't be
+            spliced into this particular entry.
+        """
+        if isinstance(xml, bytes):
+            xml = xml.decode("utf8")
+        closing_tag = u"</entry>"
+        xml = xml.rstrip()
+        if not xml.endswith(closing_tag):
+            return None
+
+        shell = AtomFeed.entry()
+        self.annotator.annotate_work_entry(
+            work, active_license_pool, edition, identifier, self, shell
+        )
+        if not len(shell):
+            return xml
+
+        annotated = etree.tounicode(shell)
+        start_tag_end = annotated.index(u">") + 1
+        start_tag = annotated[:start_tag_end]
+        annotations = annotated[start_tag_end:-len(closing_tag)]
+
+        # The annotations rely on namespace declarations in the start
+        # tag. If the cached entry was created with different
+        # declarations, it has to be parsed after all.
+        cached_start_tag = xml[:xml.index(u">") + 1]
+        for declaration in self.NAMESPACE_DECLARATION.findall(start_tag):
+            if declaration not in cached_start_tag:
+                return None
+
+        return xml[:-len(closing_tag)] + annotations + closing_tag
+
     def _make_entry_xml(self, work, edition):
         """Create a new (incomplete) OPDS entry for the given work.
 
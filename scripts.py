@@ -2,10 +2,12 @@ import argparse
 import datetime
 import imp
 import logging
+import multiprocessing
 import os
 import random
 import re
 import requests
+import signal
 import string
 import subprocess
 import time
@@ -22,6 +24,7 @@ from collections import defaultdict
 from external_search import (
     ExternalSearchIndex,
     Filter,
+    SearchIndexAvailabilityCoverageProvider,
     SearchIndexCoverageProvider,
 )
 import json
@@ -45,8 +48,10 @@ from app_server import ComplaintController
 # from axis import Axis360BibliographicCoverageProvider
 from config import Configuration, CannotLoadConfiguration
 from coverage import (
+    CollectionCoverageProvider,
     CollectionCoverageProviderJob,
     CoverageProviderProgress,
+    CoverageProviderRangeJob,
 )
 from lane import Lane
 from metadata_layer import (
@@ -90,6 +95,7 @@ from model import (
 )
 from model.configuration import ExternalIntegrationLink
 from monitor import (
+    CachedFeedPrewarmMonitor,
     CollectionMonitor,
     ReaperMonitor,
 )
@@ -465,6 +471,155 @@ class RunThreadedCollectionCoverageProviderScript(Script):
         return fast_query_count(qu), provider.batch_size
 
 
+# The state of a worker process started by
+# RunCoverageProviderProcessesScript. Every worker process has its own
+# database session.
+_coverage_worker = dict()
+
+def _coverage_worker_initialize(url, stop):
+    # The parent process decides what to do about an interrupt.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _coverage_worker['_db'] = SessionManager.sessionmaker(url=url)()
+    _coverage_worker['stop'] = stop
+
+def _coverage_worker_run(job):
+    return job.run(_coverage_worker['_db'], stop=_coverage_worker['stop'])
+
+
+class RunCoverageProviderProcessesScript(Script):
+    """Run a coverage provider in several processes at once.
+
+    The ids of the items that need coverage are divided into ranges,
+    and each worker process covers one range at a time. Since the
+    processes don't share an interpreter, CPU-heavy providers can
+    use every core.
+    """
+
+    DEFAULT_PROCESS_COUNT = 4
+
+    # Create more ranges than there are processes, so that a process
+    # that finishes a sparse range can move on to another one.
+    RANGES_PER_PROCESS = 4
+
+    # How often, in seconds, to check for a signal while waiting
+    # on the worker processes.
+    POLL_INTERVAL = 1
+
+    def __init__(self, provider_class, process_count=None, _db=None,
+        **provider_kwargs
+    ):
+        super(RunCoverageProviderProcessesScript, self).__init__(_db)
+        self.provider_class = provider_class
+        self.process_count = process_count or self.DEFAULT_PROCESS_COUNT
+        self.provider_kwargs = provider_kwargs
+
+        # Once this is set, no worker process will start a new batch.
+        self.stop = multiprocessing.Event()
+
+    def providers(self):
+        if issubclass(self.provider_class, CollectionCoverageProvider):
+            return list(
+                self.provider_class.all(self._db, **self.provider_kwargs)
+            )
+        return [self.provider_class(self._db, **self.provider_kwargs)]
+
+    def do_run(self, pool=None):
+        """Run the coverage provider for every relevant collection.
+
+        :param pool: A multiprocessing.Pool (or other) object for use
+            in testing environments.
+        """
+        progress = []
+        for provider in self.providers():
+            if self.stop.is_set():
+                break
+            progress.append(self.run_provider(provider, pool))
+        return progress
+
+    def run_provider(self, provider, pool=None):
+        """Cover everything that needs coverage from one provider, and
+        record the combined results in its timestamp.
+        """
+        if provider.KEYSET_COLUMN is None:
+            raise ValueError(
+                "%s can't be divided into id ranges." % provider.service_name
+            )
+        progress = CoverageProviderProgress(start=datetime.datetime.utcnow())
+
+        # As with run_once_and_update_timestamp, items that have never
+        # been attempted come first, then transient failures.
+        for covered_statuses in [
+            BaseCoverageRecord.PREVIOUSLY_ATTEMPTED,
+            BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED,
+        ]:
+            if self.stop.is_set():
+                break
+            ranges = provider.id_ranges(
+                self.process_count * self.RANGES_PER_PROCESS,
+                count_as_covered=covered_statuses
+            )
+            jobs = [
+                CoverageProviderRangeJob(
+                    self.provider_class, provider.collection_id,
+                    start_after, end, covered_statuses,
+                    **self.provider_kwargs
+                ) for start_after, end in ranges
+            ]
+            # Don't keep a transaction open while the workers run.
+            self._db.commit()
+            for result in self.run_jobs(jobs, pool):
+                progress.successes += result.successes
+                progress.transient_failures += result.transient_failures
+                progress.persistent_failures += result.persistent_failures
+                if result.exception and not progress.exception:
+                    progress.exception = result.exception
+
+        progress.finish = datetime.datetime.utcnow()
+        provider.finalize_timestampdata(progress)
+        return progress
+
+    def run_jobs(self, jobs, pool=None):
+        """Run a number of CoverageProviderRangeJobs in the pool and
+        yield a CoverageProviderProgress for each one as it finishes.
+        """
+        if not jobs:
+            return
+        own_pool = pool is None
+        if own_pool:
+            # The worker processes must not share this process's
+            # database connections.
+            engine = self._db.get_bind().engine
+            engine.dispose()
+            pool = multiprocessing.Pool(
+                self.process_count, initializer=_coverage_worker_initialize,
+                initargs=(engine.url, self.stop)
+            )
+        previous_handler = signal.signal(signal.SIGTERM, self.handle_signal)
+        try:
+            results = pool.imap_unordered(_coverage_worker_run, jobs)
+            while True:
+                try:
+                    yield results.next(self.POLL_INTERVAL)
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                except KeyboardInterrupt:
+                    self.handle_signal()
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            if own_pool:
+                pool.close()
+                pool.join()
+
+    def handle_signal(self, *args):
+        """Let the worker processes finish their current batches, then
+        stop.
+        """
+        self.log.warn("Stopping once the current batches are done.")
+        self.stop.set()
+
+
 class RunWorkCoverageProviderScript(RunCollectionCoverageProviderScript):
     """Run a WorkCoverageProvider on every relevant Work in the system."""
 
@@ -2998,7 +3153,7 @@ class WhereAreMyBooksScript(CollectionInputScript):
         super(WhereAreMyBooksScript, self).__init__(_db)
         self.output = output or sys.stdout
         try:
-            self.search = search or ExternalSearchIndex(_db)
+            self.search = search or ExternalSearchIndex.load(_db)
         except CannotLoadConfiguration, e:
             self.out("Here's your problem: the search integration is missing or misconfigured.")
             raise e
@@ -3162,6 +3317,38 @@ class ListCollectionMetadataIdentifiersScript(CollectionInputScript):
 
 class UpdateLaneSizeScript(LaneSweeperScript):
 
+    @classmethod
+    def arg_parser(cls, _db):
+        parser = super(UpdateLaneSizeScript, cls).arg_parser(_db)
+        parser.add_argument(
+            '--batch',
+            help='Estimate the size of every lane at once, using a few large requests to the search index rather than several requests per lane.',
+            action='store_true'
+        )
+        return parser
+
+    def do_run(self, cmd_args=None, search_engine=None):
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        if parsed.batch:
+            self.process_libraries_in_batch(parsed.libraries, search_engine)
+        else:
+            self.process_libraries(parsed.libraries)
+
+    def process_libraries_in_batch(self, libraries, search_engine=None):
+        """Update the estimated size of every Lane in the given
+        libraries in one pass.
+        """
+        library_ids = [library.id for library in libraries]
+        if not library_ids:
+            return
+        lanes = self._db.query(Lane).filter(
+            Lane.library_id.in_(library_ids)
+        ).order_by(Lane.id).all()
+        Lane.update_sizes(self._db, lanes, search_engine)
+        for lane in lanes:
+            self.log.info("%s: %d", lane.full_identifier, lane.size)
+        self._db.commit()
+
     def should_process_lane(self, lane):
         """We don't want to process generic WorkLists -- there's nowhere
         to store the data.
@@ -3174,6 +3361,51 @@ class UpdateLaneSizeScript(LaneSweeperScript):
         self.log.info("%s: %d", lane.full_identifier, lane.size)
 
 
+class CachedFeedPrewarmScript(LibraryInputScript):
+    """Refresh the cached feeds for each library's lanes before they
+    go stale.
+    """
+
+    name = "Pre-warm cached feeds"
+
+    def __init__(self, _db=None, annotator=None,
+                 monitor_class=CachedFeedPrewarmMonitor, search_engine=None):
+        """Constructor.
+
+        :param annotator: The Annotator to use when generating feeds.
+        :param monitor_class: A subclass of CachedFeedPrewarmMonitor.
+        """
+        super(CachedFeedPrewarmScript, self).__init__(_db)
+        self.annotator = annotator
+        self.monitor_class = monitor_class
+        self.search_engine = search_engine
+
+    @classmethod
+    def arg_parser(cls, _db):
+        parser = super(CachedFeedPrewarmScript, cls).arg_parser(_db)
+        parser.add_argument(
+            '--refresh-window',
+            help='Refresh feeds that will go stale within this number of seconds.',
+            type=int,
+        )
+        parser.add_argument(
+            '--max-feeds',
+            help='Refresh at most this number of feeds.',
+            type=int,
+        )
+        return parser
+
+    def do_run(self, cmd_args=None):
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        monitor = self.monitor_class(
+            self._db, annotator=self.annotator, libraries=parsed.libraries,
+            search_engine=self.search_engine,
+            refresh_window=parsed.refresh_window, max_feeds=parsed.max_feeds
+        )
+        monitor.run()
+        return monitor
+
+
 class UpdateCustomListSizeScript(CustomListSweeperScript):
     def process_custom_list(self, custom_list):
         custom_list.update_size()
@@ -3200,17 +3432,48 @@ class RebuildSearchIndexScript(
 ):
     """Completely delete the search index and recreate it."""
 
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--fast',
+            help='Build a new index alongside the current one, and only start searching it once every work has been indexed. The current index must be for an older version of the mapping.',
+            action='store_true'
+        )
+        return parser
+
     def __init__(self, *args, **kwargs):
+        """Constructor.
+
+        :param fast: If this is True, a new index is built with
+            settings that make it fast to load, and the alias is only
+            moved to it once every work has been indexed. See
+            ExternalSearchIndex.start_rebuild(). Defaults to the
+            --fast command-line argument.
+        :param cmd_args: Command-line arguments, for use in tests.
+        """
+        cmd_args = kwargs.pop('cmd_args', None)
+        fast = kwargs.pop('fast', None)
+        if fast is None:
+            fast = self.parse_command_line(cmd_args=cmd_args).fast
+        self.fast = fast
         search = kwargs.get('search_index_client', None)
-        self.search = search or ExternalSearchIndex(self._db)
+        self.search = search or ExternalSearchIndex.load(self._db)
+
+        # The SearchIndexCoverageProvider must upload documents to
+        # whichever index is being rebuilt.
+        kwargs['search_index_client'] = self.search
         super(RebuildSearchIndexScript, self).__init__(
             SearchIndexCoverageProvider, *args, **kwargs
         )
 
     def do_run(self):
-        # Calling setup_index will destroy the index and recreate it
-        # empty.
-        self.search.setup_index()
+        if self.fast:
+            restore_settings = self.search.start_rebuild(self._db)
+        else:
+            # Calling setup_index will destroy the index and recreate it
+            # empty.
+            self.search.setup_index()
 
         # Remove all search coverage records so the
         # SearchIndexCoverageProvider will start from scratch.
@@ -3218,7 +3481,36 @@ class RebuildSearchIndexScript(
         self.log.info("Deleted %d search coverage records.", count)
 
         # Now let the SearchIndexCoverageProvider do its thing.
-        return super(RebuildSearchIndexScript, self).do_run()
+        progress = super(RebuildSearchIndexScript, self).do_run()
+
+        if self.fast:
+            crashed = (
+                len(progress) < len(self.providers)
+                or any(x.exception for x in progress)
+            )
+            if crashed:
+                # The coverage provider crashed, so the new index is
+                # incomplete. Leave the alias where it is.
+                self.log.error(
+                    "Rebuild of index %s did not finish; not moving the alias to it.",
+                    self.search.works_index
+                )
+            else:
+                # Make the new index ready for searching and start
+                # using it.
+                self.search.finish_rebuild(self._db, restore_settings)
+        return progress
+
+
+class UpdateSearchIndexAvailabilityScript(RunWorkCoverageProviderScript):
+    """Update the availability information in the search index for
+    every Work whose LicensePools have changed availability.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(UpdateSearchIndexAvailabilityScript, self).__init__(
+            SearchIndexAvailabilityCoverageProvider, *args, **kwargs
+        )
 
 
 class SearchIndexCoverageRemover(TimestampScript, RemovesSearchCoverage):
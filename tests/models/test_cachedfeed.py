@@ -5,6 +5,7 @@ from nose.tools import (
     set_trace,
 )
 import datetime
+from sqlalchemy import inspect
 from .. import DatabaseTest
 from ...classifier import Classifier
 from ...lane import (
@@ -13,9 +14,14 @@ from ...lane import (
     Lane,
     WorkList,
 )
+from ...model import get_one_or_create
 from ...model.cachedfeed import CachedFeed
 from ...model.configuration import ConfigurationSetting
 from ...opds import AcquisitionFeed
+from ...util.compression import (
+    gzip_compress,
+    gzip_decompress,
+)
 from ...util.flask_util import OPDSFeedResponse
 from ...util.opds_writer import OPDSFeed
 
@@ -398,6 +404,381 @@ class TestCachedFeed(DatabaseTest):
         eq_(OPDSFeed.DEFAULT_MAX_AGE, r.max_age)
 
 
+    def test_local_cache(self):
+        # Verify that when the in-process cache is enabled, fetch()
+        # can serve a feed without going to the database.
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = self._lane()
+        refresher = MockFeedGenerator()
+        args = (self._db, lane, facets, pagination, refresher)
+
+        CachedFeed.configure_local_cache(max_entries=10)
+        try:
+            # Generating the feed puts it in the local cache as well
+            # as the database.
+            r = CachedFeed.fetch(*args, max_age=0)
+            eq_("This is feed #1", r.data)
+            eq_(1, len(CachedFeed.local_cache))
+            [key] = CachedFeed.local_cache._entries.keys()
+            eq_(self._default_library.id, key.library)
+            eq_(lane.id, key.lane_id)
+
+            # Change the database copy behind the local cache's back.
+            # The next request is served from the local cache.
+            cf = self._db.query(CachedFeed).one()
+            cf.content = u"Changed in the database."
+            r = CachedFeed.fetch(*args, max_age=1000)
+            eq_("This is feed #1", r.data)
+
+            # When raw=True, the local cache is not used, since the
+            # caller wants an actual CachedFeed. The database copy is
+            # put into the local cache.
+            feed = CachedFeed.fetch(*args, max_age=1000, raw=True)
+            eq_(u"Changed in the database.", feed.content)
+            r = CachedFeed.fetch(*args, max_age=1000)
+            eq_(u"Changed in the database.", r.data)
+
+            # The local cache obeys max_age just like the database.
+            r = CachedFeed.fetch(*args, max_age=0)
+            eq_("This is feed #2", r.data)
+
+            # Changing the lane evicts its feeds from the local cache.
+            lane.display_name = u"A new name"
+            self._db.flush()
+            eq_(0, len(CachedFeed.local_cache))
+
+            # So does changing the library.
+            CachedFeed.fetch(*args, max_age=1000)
+            eq_(1, len(CachedFeed.local_cache))
+            self._default_library.name = u"A new name"
+            self._db.flush()
+            eq_(0, len(CachedFeed.local_cache))
+
+            # A feed cached before the last site configuration change
+            # is ignored.
+            CachedFeed.fetch(*args, max_age=1000)
+            [key] = CachedFeed.local_cache._entries.keys()
+            entry = CachedFeed.local_cache.get(key)
+            CachedFeed.local_cache.set(
+                key, entry._replace(
+                    compressed_content=gzip_compress(u"Outdated"),
+                    cached_at=datetime.datetime(2000, 1, 1)
+                )
+            )
+            r = CachedFeed.fetch(*args, max_age=1000)
+            eq_("This is feed #2", r.data)
+
+            # Disabling the local cache removes it altogether.
+            CachedFeed.configure_local_cache(max_entries=0)
+            eq_(None, CachedFeed.local_cache)
+        finally:
+            CachedFeed.configure_local_cache(max_entries=0)
+
+    def test_single_flight(self):
+        # Verify that in single-flight mode, a worker that can't get
+        # the regeneration lock serves a stale feed instead of
+        # regenerating it.
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = self._lane()
+        refresher = MockFeedGenerator()
+        args = (self._db, lane, facets, pagination, refresher)
+
+        class Mock(CachedFeed):
+            LOCK = "a lock"
+            released = []
+
+            @classmethod
+            def _acquire_regeneration_lock(cls, _db, keys):
+                return cls.LOCK
+
+            @classmethod
+            def _release_regeneration_lock(cls, lock):
+                cls.released.append(lock)
+
+        feed = Mock.fetch(*args, max_age=0, raw=True)
+        eq_("This is feed #1", feed.content)
+
+        # Make the feed stale.
+        feed.timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=100
+        )
+
+        # Single-flight mode is off, so the lock isn't even requested.
+        Mock.LOCK = None
+        feed = Mock.fetch(*args, max_age=60, raw=True)
+        eq_("This is feed #2", feed.content)
+        eq_([], Mock.released)
+
+        Mock.configure_single_flight(datetime.timedelta(minutes=5))
+        try:
+            eq_(300, Mock.single_flight_grace_period)
+
+            # Someone else holds the lock, so the stale feed is served.
+            feed.timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=100
+            )
+            feed = Mock.fetch(*args, max_age=60, raw=True)
+            eq_("This is feed #2", feed.content)
+            r = Mock.fetch(*args, max_age=60)
+            eq_("This is feed #2", r.data)
+
+            # If we get the lock, we regenerate the feed and release
+            # the lock afterwards.
+            Mock.LOCK = "a lock"
+            feed = Mock.fetch(*args, max_age=60, raw=True)
+            eq_("This is feed #3", feed.content)
+            eq_(["a lock"], Mock.released)
+
+            # Once the feed is too stale, it's regenerated even if
+            # someone else is regenerating it.
+            Mock.LOCK = None
+            feed.timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+                hours=1
+            )
+            feed = Mock.fetch(*args, max_age=60, raw=True)
+            eq_("This is feed #4", feed.content)
+
+            # The lock is released even if the refresher raises an
+            # exception.
+            Mock.LOCK = "another lock"
+            feed.timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=100
+            )
+            def explode():
+                raise Exception("Kaboom")
+            assert_raises_regexp(
+                Exception, "Kaboom", Mock.fetch, self._db, lane, facets,
+                pagination, explode, max_age=60
+            )
+            eq_(["a lock", "another lock"], Mock.released)
+        finally:
+            Mock.configure_single_flight(None)
+
+    def test__within_grace_period(self):
+        class MockCachedFeed(object):
+            def __init__(self, timestamp, content_stored=True):
+                self.timestamp = timestamp
+                self.content_stored = content_stored
+
+        now = datetime.datetime.utcnow()
+        five_minutes_old = MockCachedFeed(now - datetime.timedelta(minutes=5))
+        m = CachedFeed._within_grace_period
+
+        # Single-flight mode is off.
+        eq_(False, m(five_minutes_old, 60))
+
+        CachedFeed.configure_single_flight(600)
+        try:
+            eq_(True, m(five_minutes_old, 60))
+
+            # Too stale.
+            eq_(False, m(five_minutes_old, -400))
+
+            # There's no feed to serve.
+            eq_(False, m(None, 60))
+            eq_(False, m(MockCachedFeed(now, False), 60))
+            eq_(False, m(MockCachedFeed(None), 60))
+
+            # The caller insists on a fresh feed.
+            eq_(False, m(five_minutes_old, 0))
+            eq_(False, m(five_minutes_old, CachedFeed.IGNORE_CACHE))
+        finally:
+            CachedFeed.configure_single_flight(None)
+
+    def test__within_grace_period_does_not_load_content(self):
+        lane = self._lane()
+        feed, ignore = get_one_or_create(
+            self._db, CachedFeed, lane=lane, type=CachedFeed.PAGE_TYPE,
+            facets=u"facets", pagination=u"pagination"
+        )
+        feed.content = u"content"
+        feed.timestamp = (
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        )
+        self._db.flush()
+        self._db.expunge_all()
+
+        feed = CachedFeed._get_feed(
+            self._db, load_content=False, lane_id=lane.id,
+            type=CachedFeed.PAGE_TYPE
+        )
+        CachedFeed.configure_single_flight(600)
+        try:
+            eq_(True, CachedFeed._within_grace_period(feed, 60))
+        finally:
+            CachedFeed.configure_single_flight(None)
+        unloaded = inspect(feed).unloaded
+        assert 'compressed_content' in unloaded
+        assert '_content' in unloaded
+
+    def test_regeneration_lock(self):
+        lane = self._lane()
+        keys = CachedFeed._prepare_keys(self._db, lane, None, None)
+        other_keys = keys._replace(pagination_key=u"other")
+
+        acquire = CachedFeed._acquire_regeneration_lock
+        release = CachedFeed._release_regeneration_lock
+
+        lock = acquire(self._db, keys)
+        assert lock is not None
+
+        # While the lock is held, another thread in this process
+        # can't acquire it.
+        eq_(None, acquire(self._db, keys))
+
+        # But a lock for a different feed can be acquired.
+        other_lock = acquire(self._db, other_keys)
+        assert other_lock is not None
+        release(other_lock)
+
+        # Once released, the lock can be acquired again.
+        release(lock)
+        lock = acquire(self._db, keys)
+        assert lock is not None
+        release(lock)
+        eq_({}, CachedFeed._regeneration_locks)
+
+        # The advisory lock ID is a stable 64-bit number.
+        lock_id = CachedFeed._advisory_lock_id(lock)
+        eq_(lock_id, CachedFeed._advisory_lock_id(lock))
+        assert lock_id != CachedFeed._advisory_lock_id(other_lock)
+        assert -2**63 <= lock_id < 2**63
+
+    def test_content_is_compressed(self):
+        feed = CachedFeed(type=u"a type", pagination=u"")
+
+        # Setting .content stores a compressed version of the content,
+        # and its ETag.
+        feed.content = u"A feed \N{SNOWMAN}"
+        eq_(None, feed._content)
+        eq_(u"A feed \N{SNOWMAN}".encode("utf8"),
+            gzip_decompress(feed.compressed_content))
+        eq_(OPDSFeedResponse.calculate_etag(u"A feed \N{SNOWMAN}"),
+            feed.etag)
+        eq_(32, len(feed.etag))
+        eq_(True, feed.has_content)
+
+        # Getting .content decompresses it.
+        eq_(u"A feed \N{SNOWMAN}", feed.content)
+
+        # A feed that was stored before compression was introduced
+        # can still be read.
+        feed.compressed_content = None
+        feed._content = u"An old feed"
+        eq_(u"An old feed", feed.content)
+        eq_(True, feed.has_content)
+
+        # Clearing the content clears everything.
+        feed.content = None
+        eq_(None, feed.content)
+        eq_(None, feed.etag)
+        eq_(False, feed.has_content)
+
+    def test_response_is_compressed(self):
+        # If a feed is served from the cache, its compressed content
+        # is passed into the response. It's decompressed only if the
+        # client doesn't accept gzip.
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        wl = WorkList()
+        wl.initialize(self._default_library)
+
+        def refresh():
+            return u"Here's a feed."
+        args = (self._db, wl, facets, pagination, refresh)
+
+        from flask import Flask
+        app = Flask(__name__)
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            r = CachedFeed.fetch(*args, max_age=102)
+            eq_("gzip", r.headers['Content-Encoding'])
+            eq_("Here's a feed.", gzip_decompress(r.data))
+
+            # Same for a cache hit.
+            r = CachedFeed.fetch(*args, max_age=102)
+            eq_("gzip", r.headers['Content-Encoding'])
+            eq_("Here's a feed.", gzip_decompress(r.data))
+
+        with app.test_request_context():
+            r = CachedFeed.fetch(*args, max_age=102)
+            assert 'Content-Encoding' not in r.headers
+            eq_("Here's a feed.", r.data)
+
+        # If the feed isn't cached, there's nothing compressed to send.
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            r = CachedFeed.fetch(*args, max_age=CachedFeed.IGNORE_CACHE)
+            assert 'Content-Encoding' not in r.headers
+            eq_("Here's a feed.", r.data)
+
+    def test_conditional_get(self):
+        # If the client already has the current version of a cached
+        # feed, a 304 response is sent without loading the feed content.
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        wl = WorkList()
+        wl.initialize(self._default_library)
+
+        def refresh():
+            return u"Here's a feed."
+        args = (self._db, wl, facets, pagination, refresh)
+
+        from flask import Flask
+        app = Flask(__name__)
+        with app.test_request_context():
+            r = CachedFeed.fetch(*args, max_age=102)
+        eq_(200, r.status_code)
+        [feed] = self._db.query(CachedFeed).all()
+        eq_('"%s"' % feed.etag, r.headers['ETag'])
+        assert 'Last-Modified' in r.headers
+        etag = r.headers['ETag']
+
+        # Make sure the next fetch comes from the database rather
+        # than from the object we already have.
+        self._db.expunge(feed)
+        with app.test_request_context(headers={"If-None-Match": etag}):
+            r = CachedFeed.fetch(*args, max_age=102)
+            eq_(304, r.status_code)
+            eq_("", r.data)
+            eq_(etag, r.headers['ETag'])
+
+            # The feed content was never loaded.
+            [feed] = [x for x in self._db.identity_map.values()
+                      if isinstance(x, CachedFeed)]
+            assert 'compressed_content' not in feed.__dict__
+
+        # A client that accepts gzip gets the compressed feed, which
+        # has its own ETag, and can make conditional requests with it.
+        headers = {"Accept-Encoding": "gzip"}
+        with app.test_request_context(headers=headers):
+            r = CachedFeed.fetch(*args, max_age=102)
+            eq_('"%s-gzip"' % feed.etag, r.headers['ETag'])
+            eq_("Accept-Encoding", r.headers['Vary'])
+        headers["If-None-Match"] = r.headers['ETag']
+        self._db.expire_all()
+        with app.test_request_context(headers=headers):
+            r = CachedFeed.fetch(*args, max_age=102)
+            eq_(304, r.status_code)
+            eq_("Accept-Encoding", r.headers['Vary'])
+
+        # A client with some other version of the feed gets the
+        # whole thing.
+        with app.test_request_context(headers={"If-None-Match": '"abc"'}):
+            r = CachedFeed.fetch(*args, max_age=102)
+            eq_(200, r.status_code)
+            eq_("Here's a feed.", r.data)
+
+        # The same is true when the feed comes from the in-process cache.
+        CachedFeed.configure_local_cache(max_entries=10)
+        try:
+            r = CachedFeed.fetch(*args, max_age=102)
+            with app.test_request_context(headers={"If-None-Match": etag}):
+                r = CachedFeed.fetch(*args, max_age=102)
+                eq_(304, r.status_code)
+        finally:
+            CachedFeed.configure_local_cache(max_entries=0)
+
     # Tests of helper methods.
 
     def test_feed_type(self):
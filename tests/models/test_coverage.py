@@ -232,6 +232,19 @@ class TestBaseCoverageRecord(DatabaseTest):
             count_as_not_covered_if_covered_before=one_second_after
         )
 
+        # An identifier that some process has claimed counts as
+        # covered until the claim expires.
+        claimed = self._identifier()
+        claimed_record = self._coverage_record(
+            claimed, source, status=CoverageRecord.IN_PROGRESS
+        )
+        now = datetime.datetime.utcnow()
+        claimed_record.timestamp = now + datetime.timedelta(seconds=3600)
+        check_not_covered([no_coverage, transient])
+
+        claimed_record.timestamp = now - datetime.timedelta(seconds=3600)
+        check_not_covered([no_coverage, transient, claimed])
+
 class TestCoverageRecord(DatabaseTest):
 
     def test_lookup(self):
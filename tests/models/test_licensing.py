@@ -548,6 +548,33 @@ class TestLicensePool(DatabaseTest):
         # Only the two open-access download links show up.
         eq_(set([oa1, oa2]), set(pool.open_access_links))
 
+    def test_preload_open_access_links(self):
+        edition, pool1 = self._edition(with_open_access_download=True)
+        edition, pool2 = self._edition(with_open_access_download=True)
+        edition, no_link = self._edition(with_license_pool=True)
+        no_link.open_access = True
+        edition, not_open_access = self._edition(with_license_pool=True)
+        not_open_access.open_access = False
+        pools = [pool1, pool2, no_link, not_open_access]
+        for pool in pools:
+            pool._open_access_download_url = None
+
+        LicensePool.preload_open_access_links(self._db, pools)
+
+        # The best open-access link was found and cached for every
+        # pool that has one.
+        for pool in (pool1, pool2):
+            [resource] = pool.open_access_links
+            eq_(resource.representation.public_url,
+                pool._open_access_download_url)
+        eq_(None, no_link._open_access_download_url)
+        eq_(None, not_open_access._open_access_download_url)
+
+        # A link that's already cached is left alone.
+        pool1._open_access_download_url = "http://cached/"
+        LicensePool.preload_open_access_links(self._db, [pool1])
+        eq_("http://cached/", pool1._open_access_download_url)
+
     def test_better_open_access_pool_than(self):
 
         gutenberg_1 = self._licensepool(
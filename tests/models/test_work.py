@@ -1079,6 +1079,10 @@ class TestWork(DatabaseTest):
         assert_time_match(work.last_update_time, search_doc['last_update_time'])
         eq_(dict(lower=7, upper=8), search_doc['target_age'])
 
+        # The cached OPDS entry is included so that a feed can be
+        # built from search results alone.
+        eq_(work.simple_opds_entry, search_doc['opds_entry'])
+
         # Each LicensePool for the Work is listed in
         # the 'licensepools' section.
         licensepools = search_doc['licensepools']
@@ -1094,9 +1098,14 @@ class TestWork(DatabaseTest):
             eq_(pool.collection_id, match['collection_id'])
             eq_(pool.suppressed, match['suppressed'])
             eq_(pool.data_source_id, match['data_source_id'])
+            eq_(pool.superceded, match['superceded'])
+            eq_(pool.identifier.type, match['identifier_type'])
+            eq_(pool.identifier.identifier, match['identifier'])
 
             eq_(pool.licenses_available > 0, match['available'])
             eq_(pool.licenses_owned > 0, match['licensed'])
+            eq_(pool.best_open_access_link is not None,
+                match['open_access_link'])
 
             # The work quality is stored in the main document, but
             # it's also stored in the license pool subdocument so that
@@ -1211,6 +1220,57 @@ class TestWork(DatabaseTest):
         eq_(set([collection1.id, collection2.id]),
             set([x['collection_id'] for x in search_doc['licensepools']]))
 
+    def test_to_search_document_open_access_link(self):
+        # A LicensePool's 'open_access_link' says whether
+        # best_open_access_link would find a link, whether or not
+        # the link has been cached.
+        work = self._work(with_open_access_download=True)
+        [pool] = work.license_pools
+        pool.licenses_owned = 1
+
+        def open_access_link():
+            self._db.flush()
+            [match] = work.to_search_document()['licensepools']
+            return match['open_access_link']
+
+        # The link hasn't been cached yet, but it can be found.
+        pool._open_access_download_url = None
+        eq_(True, open_access_link())
+        assert pool.best_open_access_link is not None
+
+        # A cached link isn't used once the pool stops being
+        # open-access.
+        pool.open_access = False
+        eq_(None, pool.best_open_access_link)
+        eq_(False, open_access_link())
+
+        # A Resource whose Representation isn't in a supported
+        # media type won't be chosen.
+        pool.open_access = True
+        pool._open_access_download_url = None
+        [resource] = pool.open_access_links
+        resource.representation.media_type = Representation.TEXT_HTML_MEDIA_TYPE
+        eq_(False, open_access_link())
+        eq_(None, pool.best_open_access_link)
+
+    def test_to_availability_search_documents(self):
+        # A partial search document contains the availability
+        # information from the full search document, and nothing else.
+        work = self._work(with_license_pool=True)
+        self._work(with_license_pool=True, collection=self._collection())
+        work.last_update_time = datetime.datetime.utcnow()
+        self._db.flush()
+
+        full = work.to_search_document()
+        [partial] = Work.to_availability_search_documents([work])
+        eq_(set(['_id', 'licensepools', 'last_update_time']),
+            set(partial.keys()))
+        eq_(work.id, partial['_id'])
+        eq_(full['last_update_time'], partial['last_update_time'])
+        eq_(full['licensepools'], partial['licensepools'])
+
+        eq_([], Work.to_availability_search_documents([]))
+
     def test_target_age_string(self):
         work = self._work()
         work.target_age = NumericRange(7, 8, '[]')
@@ -1296,13 +1356,26 @@ class TestWork(DatabaseTest):
         eq_(registered, record.status)
 
         # If its last_update_time is changed, it needs to be
-        # reindexed. (This happens whenever
-        # LicensePool.update_availability is called, meaning that
-        # patron transactions always trigger a reindex).
+        # reindexed.
         record.status = success
         work.last_update_time = datetime.datetime.utcnow()
         eq_(registered, record.status)
 
+        # But when last_update_time changes because
+        # LicensePool.update_availability was called, only the
+        # availability information in the search document needs to
+        # be updated.
+        record.status = success
+        pool.update_availability(5, 4, 0, 0)
+        eq_(success, record.status)
+        [availability_record] = [
+            x for x in work.coverage_records
+            if x.operation==
+            WorkCoverageRecord.UPDATE_SEARCH_INDEX_AVAILABILITY_OPERATION
+        ]
+        eq_(registered, availability_record.status)
+        eq_(False, work._availability_update_in_progress)
+
         # If its collection changes (which shouldn't happen), it needs
         # to be reindexed.
         record.status = success
@@ -1363,7 +1436,9 @@ class TestWork(DatabaseTest):
             (work.needs_new_presentation_edition,
              WCR.CHOOSE_EDITION_OPERATION),
             (work.external_index_needs_updating,
-             WCR.UPDATE_SEARCH_INDEX_OPERATION)
+             WCR.UPDATE_SEARCH_INDEX_OPERATION),
+            (work.external_index_availability_needs_updating,
+             WCR.UPDATE_SEARCH_INDEX_AVAILABILITY_OPERATION),
         ):
             method()
             eq_(operation, work.coverage_reset_for)
@@ -589,3 +589,31 @@ class TestCompressibleAnnotator(object):
         response = ask_for_compression("gzip", "Accept-Transfer-Encoding")
         eq_(value, response.data)
         assert 'Content-Encoding' not in response.headers
+
+    def test_compressible_streamed_response(self):
+        # A streamed response is compressed as it's generated, rather
+        # than being read into memory all at once.
+        generated = []
+        def chunks():
+            for chunk in [u"<feed>", u"<entry/>" * 100, u"</feed>"]:
+                generated.append(chunk)
+                yield chunk
+
+        @compressible
+        def function():
+            return flask.Response(chunks())
+
+        headers = {'Accept-Encoding': 'gzip'}
+        with self.app.test_request_context(headers=headers):
+            response = function()
+            self.app.process_response(response)
+
+        # Nothing has been generated yet.
+        eq_([], generated)
+        eq_("gzip", response.headers['Content-Encoding'])
+        assert 'Content-Length' not in response.headers
+
+        compressed = b"".join(response.response)
+        eq_(3, len(generated))
+        uncompressed = gzip.GzipFile(fileobj=BytesIO(compressed)).read()
+        eq_(u"".join(generated), uncompressed.decode("utf8"))
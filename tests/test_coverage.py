@@ -1,4 +1,5 @@
 import datetime
+from sqlalchemy.orm.session import Session
 from nose.tools import (
     assert_raises,
     assert_raises_regexp,
@@ -59,6 +60,7 @@ from ..coverage import (
     CollectionCoverageProvider,
     CoverageFailure,
     CoverageProviderProgress,
+    CoverageProviderRangeJob,
     IdentifierCoverageProvider,
     OPDSEntryWorkCoverageProvider,
     MARCRecordWorkCoverageProvider,
@@ -488,6 +490,216 @@ class TestBaseCoverageProvider(CoverageProviderTest):
         # this run.
         eq_(4, progress.offset)
 
+    def test_run_once_keyset_pagination(self):
+        # With keyset pagination, each batch picks up after the
+        # last item of the previous batch, no matter how the items
+        # in that batch turned out.
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+
+        provider = NeverSuccessfulCoverageProvider(
+            self._db, batch_size=2, keyset_pagination=True
+        )
+        progress = CoverageProviderProgress()
+        provider.run_once(progress)
+        eq_([i1, i2], provider.attempts)
+        eq_(2, progress.persistent_failures)
+        eq_(i2.id, progress.counter)
+
+        # The offset isn't used.
+        eq_(0, progress.offset)
+
+        provider.run_once(progress)
+        eq_([i1, i2, i3], provider.attempts)
+        eq_(i3.id, progress.counter)
+        eq_(None, progress.finish)
+
+        # When there's nothing left, the run is over and the counter
+        # is cleared so the next run starts from the beginning.
+        provider.run_once(progress)
+        assert progress.finish is not None
+        eq_(Timestamp.CLEAR_VALUE, progress.counter)
+
+    def test_run_once_and_update_timestamp_keyset_pagination(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+
+        class Mock(AlwaysSuccessfulCoverageProvider):
+            # Stop partway through, as though the process had died.
+            def process_batch_and_handle_results(self, batch):
+                if i2 in batch:
+                    raise Exception("Killed")
+                return super(Mock, self).process_batch_and_handle_results(
+                    batch
+                )
+
+        provider = Mock(self._db, batch_size=1, keyset_pagination=True)
+        provider.run_once_and_update_timestamp()
+        eq_([i1], provider.attempts)
+
+        # The position of the last item covered was stored in the
+        # Timestamp.
+        eq_(i1.id, provider.timestamp.counter)
+
+        # The next run resumes from that position, and once the run
+        # is complete, the counter is cleared.
+        provider = AlwaysSuccessfulCoverageProvider(
+            self._db, batch_size=1, keyset_pagination=True
+        )
+        provider.run_once_and_update_timestamp()
+        eq_([i2, i3], provider.attempts)
+        eq_(None, provider.timestamp.counter)
+
+        # A provider that can't be walked in order can't use keyset
+        # pagination.
+        class NoColumn(AlwaysSuccessfulCoverageProvider):
+            KEYSET_COLUMN = None
+        assert_raises_regexp(
+            ValueError, "NoColumn must define KEYSET_COLUMN",
+            NoColumn, self._db, keyset_pagination=True
+        )
+
+    def test_claim(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+
+        lease = datetime.timedelta(hours=1)
+        provider = AlwaysSuccessfulCoverageProvider(
+            self._db, batch_size=2, lease_duration=lease
+        )
+        # Claiming items requires keyset pagination.
+        eq_(True, provider.keyset_pagination)
+
+        # Claiming items gives them 'in progress' coverage records
+        # that expire once the lease is up.
+        qu = provider.items_that_need_coverage().order_by(Identifier.id)
+        now = datetime.datetime.utcnow()
+        eq_([i1, i2], provider.claim(qu))
+        for identifier in (i1, i2):
+            [record] = identifier.coverage_records
+            eq_(CoverageRecord.IN_PROGRESS, record.status)
+            assert record.timestamp > now + lease - datetime.timedelta(minutes=1)
+
+        # Another process running the same provider can't see those
+        # items, so it claims and covers the item that's left.
+        other = AlwaysSuccessfulCoverageProvider(
+            self._db, batch_size=2, lease_duration=lease
+        )
+        eq_([i3], other.items_that_need_coverage().all())
+        progress = CoverageProviderProgress()
+        other.run_once(progress)
+        eq_([i3], other.attempts)
+        [record] = i3.coverage_records
+        eq_(CoverageRecord.SUCCESS, record.status)
+
+        # If a claim expires without the work being done, the item
+        # can be claimed again.
+        [record] = i1.coverage_records
+        record.timestamp = now - datetime.timedelta(seconds=1)
+        other.run_once(CoverageProviderProgress())
+        eq_([i3, i1], other.attempts)
+        eq_(CoverageRecord.SUCCESS, record.status)
+        [record] = i2.coverage_records
+        eq_(CoverageRecord.IN_PROGRESS, record.status)
+
+    def test_claim_skips_items_claimed_after_query(self):
+        # Two processes, each with its own database session, look for
+        # items to claim at the same time.
+        i1 = self._identifier()
+        i2 = self._identifier()
+        lease = datetime.timedelta(hours=1)
+        other_db = Session(self.connection)
+        other = AlwaysSuccessfulCoverageProvider(
+            other_db, batch_size=2, lease_duration=lease
+        )
+
+        class Racing(AlwaysSuccessfulCoverageProvider):
+            def lock_items(self, qu):
+                locked = super(Racing, self).lock_items(qu)
+                # Between this process's query and its locks, the
+                # other process claims i1 and commits.
+                other.add_claims_for(
+                    [other_db.merge(i1)],
+                    datetime.datetime.utcnow() + lease
+                )
+                other_db.commit()
+                return locked
+
+        provider = Racing(self._db, batch_size=2, lease_duration=lease)
+        qu = provider.items_that_need_coverage().order_by(Identifier.id)
+
+        # The item claimed by the other process was locked, but it's
+        # not claimed a second time.
+        eq_([i2], provider.claim(qu))
+        self._db.expire_all()
+        [record] = i1.coverage_records
+        eq_(CoverageRecord.IN_PROGRESS, record.status)
+        [record] = i2.coverage_records
+        eq_(CoverageRecord.IN_PROGRESS, record.status)
+        other_db.close()
+
+    def test_id_ranges(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+        provider = AlwaysSuccessfulCoverageProvider(self._db)
+
+        # The ids are divided into ranges of equal size.
+        eq_([(i1.id-1, i2.id), (i2.id, i3.id)], provider.id_ranges(2))
+
+        # There can't be more ranges than ids.
+        eq_(3, len(provider.id_ranges(10)))
+
+        # Only items that need coverage are considered.
+        self._coverage_record(i3, provider.data_source)
+        eq_([(i1.id-1, i1.id), (i1.id, i2.id)], provider.id_ranges(2))
+
+        self._coverage_record(i1, provider.data_source)
+        self._coverage_record(i2, provider.data_source)
+        eq_([], provider.id_ranges(2))
+
+    def test_run_on_id_range(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+        provider = AlwaysSuccessfulCoverageProvider(self._db, batch_size=1)
+
+        # Only items within the range are covered.
+        progress = provider.run_on_id_range(i1.id, i3.id)
+        eq_([i2, i3], provider.attempts)
+        eq_(2, progress.successes)
+        assert progress.is_complete
+
+        # If the stop event has been set, nothing is done.
+        class Stop(object):
+            def is_set(self):
+                return True
+        provider = AlwaysSuccessfulCoverageProvider(self._db)
+        progress = provider.run_on_id_range(i1.id-1, i3.id, stop=Stop())
+        eq_([], provider.attempts)
+        eq_(0, progress.successes)
+
+    def test_range_job(self):
+        identifier = self._identifier()
+        job = CoverageProviderRangeJob(
+            AlwaysSuccessfulCoverageProvider, None,
+            identifier.id-1, identifier.id
+        )
+        progress = job.run(self._db)
+        eq_(1, progress.successes)
+        eq_(None, progress.exception)
+
+        # An exception is recorded rather than raised.
+        class Broken(AlwaysSuccessfulCoverageProvider):
+            def run_on_id_range(self, *args, **kwargs):
+                raise Exception("Oops")
+        job.provider_class = Broken
+        progress = job.run(self._db)
+        assert "Oops" in progress.exception
+
     def test_run_once_records_successes_and_failures(self):
 
         class Mock(AlwaysSuccessfulCoverageProvider):
@@ -674,6 +886,15 @@ class TestBaseCoverageProvider(CoverageProviderTest):
         record.status = CoverageRecord.REGISTERED
         eq_(True, provider.should_update(record))
 
+        # If another process has claimed the item, we should update
+        # only once that claim has expired.
+        now = datetime.datetime.utcnow()
+        record.status = CoverageRecord.IN_PROGRESS
+        record.timestamp = now + datetime.timedelta(hours=1)
+        eq_(False, provider.should_update(record))
+        record.timestamp = now - datetime.timedelta(hours=1)
+        eq_(True, provider.should_update(record))
+
 
 class TestIdentifierCoverageProvider(CoverageProviderTest):
 
@@ -2025,6 +2246,19 @@ class TestWorkCoverageProvider(DatabaseTest):
         super(TestWorkCoverageProvider, self).setup()
         self.work = self._work()
 
+    def test_add_claims_for(self):
+        class MockProvider(AlwaysSuccessfulWorkCoverageProvider):
+            OPERATION = "the_operation"
+
+        provider = MockProvider(
+            self._db, lease_duration=datetime.timedelta(hours=1)
+        )
+        eq_([self.work], provider.claim(provider.items_that_need_coverage()))
+        [record] = [x for x in self.work.coverage_records
+                    if x.operation==provider.operation]
+        eq_(WorkCoverageRecord.IN_PROGRESS, record.status)
+        eq_([], provider.items_that_need_coverage().all())
+
     def test_success(self):
         class MockProvider(AlwaysSuccessfulWorkCoverageProvider):
             OPERATION = "the_operation"
@@ -9,7 +9,10 @@ from collections import defaultdict
 import datetime
 import json
 import logging
+import os
 import re
+import shutil
+import tempfile
 import time
 from psycopg2.extras import NumericRange
 
@@ -17,7 +20,11 @@ from . import (
     DatabaseTest,
 )
 
-from elasticsearch_dsl import Q
+from elasticsearch_dsl import (
+    Q,
+    Search,
+)
+from elasticsearch_dsl.response import Response
 from elasticsearch_dsl.function import (
     ScriptScore,
     RandomScore,
@@ -36,7 +43,10 @@ from elasticsearch_dsl.query import (
     Term,
     Terms,
 )
-from elasticsearch.exceptions import ElasticsearchException
+from elasticsearch.exceptions import (
+    ConnectionTimeout,
+    ElasticsearchException,
+)
 
 from ..config import (
     Configuration,
@@ -62,21 +72,28 @@ from ..model import (
     Edition,
     ExternalIntegration,
     Genre,
+    Identifier,
     Work,
     WorkCoverageRecord,
     get_one_or_create,
 )
 from ..external_search import (
+    BulkIndexReport,
     CurrentMapping,
     ExternalSearchIndex,
+    FileSearchResultStore,
     Filter,
+    HitBackedWork,
     Mapping,
     MockExternalSearchIndex,
     MockSearchResult,
     Query,
     QueryParser,
     SearchBase,
+    SearchIndexAvailabilityCoverageProvider,
     SearchIndexCoverageProvider,
+    SearchMetrics,
+    SearchResultCache,
     SortKeyPagination,
     WorkSearchResult,
     mock_search_index,
@@ -150,7 +167,7 @@ class TestExternalSearch(ExternalSearchTest):
         """
         if not self.search:
             return
-        eq_("test_index-v4", self.search.works_index_name(self._db))
+        eq_("test_index-v5", self.search.works_index_name(self._db))
 
     def test_setup_index_creates_new_index(self):
         if not self.search:
@@ -219,6 +236,69 @@ class TestExternalSearch(ExternalSearchTest):
         eq_('my-app-%s' % version, self.search.works_index)
         eq_('my-app-' + self.search.CURRENT_ALIAS_SUFFIX, self.search.works_alias)
 
+    def test_rebuild(self):
+        if not self.search:
+            return
+
+        original_index = self.search.works_index
+        original_settings = self.search.indices.get_settings(
+            index=original_index, flat_settings=True
+        )[original_index]['settings']
+        self.indexes.append(original_index)
+
+        # The index the alias points to can't be rebuilt alongside
+        # itself, since that would mean destroying it.
+        assert_raises_regexp(
+            ValueError, "is in use by alias",
+            self.search.start_rebuild, self._db, original_index
+        )
+        eq_([original_index],
+            self.search.indices.get_alias(name=self.search.works_alias).keys())
+
+        # start_rebuild() creates a new index with settings that make
+        # it fast to load, and sends documents to it.
+        new_index = 'test_index-v9999'
+        self.indexes.append(new_index)
+        restore_settings = self.search.start_rebuild(self._db, new_index)
+        eq_(new_index, self.search.works_index)
+
+        def settings(index):
+            return self.search.indices.get_settings(
+                index=index, flat_settings=True
+            )[index]['settings']
+        new_settings = settings(new_index)
+        eq_("-1", new_settings['index.refresh_interval'])
+        eq_("0", new_settings['index.number_of_replicas'])
+
+        # The settings to restore afterwards come from the index the
+        # alias points to. The refresh interval isn't set there, so
+        # it will be reset to the default.
+        eq_(dict(refresh_interval=None,
+                 number_of_replicas=original_settings[
+                     'index.number_of_replicas'
+                 ]),
+            restore_settings)
+
+        # Searches still go to the original index.
+        eq_([original_index],
+            self.search.indices.get_alias(name=self.search.works_alias).keys())
+
+        # The number of works indexed is tracked as the rebuild goes.
+        work = self._work(with_license_pool=True)
+        self.search.bulk_update([work])
+        eq_(1, self.search.rebuild_progress['indexed'])
+
+        # finish_rebuild() restores the settings and moves the alias.
+        progress = self.search.finish_rebuild(self._db, restore_settings)
+        eq_(1, progress['indexed'])
+        eq_(None, self.search.rebuild_progress)
+        new_settings = settings(new_index)
+        assert 'index.refresh_interval' not in new_settings
+        eq_(original_settings['index.number_of_replicas'],
+            new_settings['index.number_of_replicas'])
+        eq_([new_index],
+            self.search.indices.get_alias(name=self.search.works_alias).keys())
+
     def test_transfer_current_alias(self):
         if not self.search:
             return
@@ -1179,6 +1259,430 @@ class TestFacetFilters(EndToEndSearchTest):
                [self.becoming, self.moby])
 
 
+class TestCountWorksMulti(EndToEndSearchTest):
+
+    def populate_works(self):
+        self.book = self.default_work(title="A book")
+        self.audiobook = self.default_work(title="An audiobook")
+        self.audiobook.presentation_edition.medium = Edition.AUDIO_MEDIUM
+
+    def test_count_works_multi(self):
+        if not self.search:
+            logging.error(
+                "Search is not configured, skipping test_count_works_multi."
+            )
+            return
+
+        # Make sure the counts are split across several requests.
+        self.search.COUNT_WORKS_CHUNK_SIZE = 2
+
+        filters = [
+            Filter(),
+            Filter(media=Edition.BOOK_MEDIUM),
+            Filter(match_nothing=True),
+            Filter(media=Edition.AUDIO_MEDIUM),
+            Filter(media=Edition.VIDEO_MEDIUM),
+        ]
+        counts = self.search.count_works_multi(filters)
+        eq_([2, 1, 0, 1, 0], counts)
+
+        # The counts are the same as if count_works() had been called
+        # on each Filter.
+        eq_(counts, [self.search.count_works(f) for f in filters])
+
+        eq_([], self.search.count_works_multi([]))
+
+
+class TestScanWorks(EndToEndSearchTest):
+
+    def populate_works(self):
+        self.works = [
+            self.default_work(title="Work %d" % i) for i in range(5)
+        ]
+        for i, work in enumerate(self.works):
+            work.last_update_time = datetime.datetime(2019, 1, i+1)
+
+    def test_scan_works(self):
+        if not self.search:
+            logging.error(
+                "Search is not configured, skipping test_scan_works."
+            )
+            return
+
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, order=Facets.ORDER_LAST_UPDATE,
+            order_ascending=True
+        )
+        filter = Filter(facets=facets)
+        expect = [x.id for x in self.works]
+
+        # A scan with a single slice finds every work, even when each
+        # request only retrieves a couple of them.
+        hits = list(self.search.scan_works(filter, batch_size=2))
+        eq_(sorted(expect), sorted(x.work_id for x in hits))
+        for hit in hits:
+            eq_(unicode(hit.work_id), hit.meta.id)
+
+        # Only the requested fields are retrieved.
+        [hit] = list(self.search.scan_works(
+            Filter(identifiers=[self.works[0].presentation_edition.primary_identifier]),
+            fields=["work_id", "title"]
+        ))
+        eq_("Work 0", hit.title)
+
+        # So does a scan with several slices.
+        hits = self.search.scan_works(filter, slices=2, batch_size=2)
+        eq_(sorted(expect), sorted(x.work_id for x in hits))
+
+        # A Filter that matches nothing doesn't send any requests.
+        eq_([], list(self.search.scan_works(Filter(match_nothing=True))))
+
+
+class TestScanInParallel(object):
+
+    class MockSearchIndex(MockExternalSearchIndex):
+        def _scan(self, body, batch_size):
+            if body == "error":
+                raise ElasticsearchException("Oops")
+            self.started.append(body)
+            for i in range(3):
+                yield "%s-%d" % (body, i)
+
+    def test_scan_in_parallel(self):
+        search = self.MockSearchIndex()
+        search.started = []
+
+        # Every result from every scroll is yielded.
+        results = list(search._scan_in_parallel(["a", "b"], 1))
+        eq_(sorted(["a-0", "a-1", "a-2", "b-0", "b-1", "b-2"]),
+            sorted(results))
+
+        # Within a single scroll, results are in order.
+        eq_(["a-0", "a-1", "a-2"], [x for x in results if x[0] == "a"])
+
+        # An exception in one of the scrolls is raised in the caller.
+        assert_raises(
+            ElasticsearchException, list,
+            search._scan_in_parallel(["a", "error"], 1)
+        )
+
+        # If the caller stops listening, the threads stop.
+        results = search._scan_in_parallel(["a", "b", "c"], 1)
+        results.next()
+        results.close()
+
+
+class TestSearchResultCaching(EndToEndSearchTest):
+
+    def populate_works(self):
+        self.moby = self.default_work(title="Moby Dick")
+
+    def teardown(self):
+        ExternalSearchIndex.configure_result_cache(max_entries=None)
+        super(TestSearchResultCaching, self).teardown()
+
+    def test_query_works_multi(self):
+        if not self.search:
+            logging.error(
+                "Search is not configured, skipping test_query_works_multi."
+            )
+            return
+
+        ExternalSearchIndex.configure_result_cache()
+
+        def query(size=10):
+            pagination = Pagination(size=size)
+            results = self.search.query_works("moby", Filter(), pagination)
+            return [x.work_id for x in results], pagination
+
+        eq_([self.moby.id], query()[0])
+
+        # Take the work out of the search index.
+        self.search.remove_work(self.moby)
+        self.search.indices.refresh()
+
+        # The same query gets the same results, because they're
+        # cached. The Pagination is still told about the page.
+        ids, pagination = query()
+        eq_([self.moby.id], ids)
+        eq_(1, pagination.this_page_size)
+
+        # A query for a different page isn't cached.
+        eq_([], query(size=5)[0])
+
+        # Once the cache is invalidated, the work is gone.
+        ExternalSearchIndex.invalidate_result_cache()
+        eq_([], query()[0])
+
+
+class TestSearchResultCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_store(self):
+        now = [1000]
+        path = os.path.join(self.directory, "results")
+        store = FileSearchResultStore(path, ttl=30, clock=lambda: now[0])
+
+        # The directory was created.
+        assert os.path.isdir(path)
+
+        eq_(None, store.get("key"))
+        value = dict(hits=dict(hits=[dict(_id="1")]))
+        store.set("key", value)
+        eq_(value, store.get("key"))
+
+        # Another store using the same directory sees the same entry.
+        eq_(value, FileSearchResultStore(path, ttl=30).get("key"))
+
+        # The entry expires based on the modification time of its file,
+        # and the expired file is removed.
+        now[0] = os.path.getmtime(store._path("key")) + 30
+        eq_(None, store.get("key"))
+        eq_([], os.listdir(path))
+
+        store.set("key2", value)
+        store.clear()
+        eq_([], os.listdir(path))
+
+    def test_file_store_prune(self):
+        now = [time.time()]
+        store = FileSearchResultStore(
+            self.directory, ttl=30, clock=lambda: now[0], prune_interval=3
+        )
+        value = dict(hits=dict(hits=[]))
+        store.set("old", value)
+        os.utime(store._path("old"), (now[0] - 60, now[0] - 60))
+
+        # A temporary file left behind by a writer that died.
+        temp_path = os.path.join(self.directory, "abandoned.tmp")
+        open(temp_path, "w").close()
+        os.utime(temp_path, (0, 0))
+
+        # Every third write sweeps away the expired files.
+        store.set("new", value)
+        eq_(3, len(os.listdir(self.directory)))
+        store.set("newer", value)
+        eq_(
+            sorted(["new.json", "newer.json"]),
+            sorted(os.listdir(self.directory))
+        )
+
+        # The sweep can also be run directly.
+        now[0] += 60
+        eq_(2, store.prune())
+        eq_([], os.listdir(self.directory))
+
+        # Without a ttl, nothing ever expires.
+        store = FileSearchResultStore(self.directory, prune_interval=1)
+        store.set("key", value)
+        eq_(0, store.prune())
+        eq_(["key.json"], os.listdir(self.directory))
+
+    def test_two_tier_cache(self):
+        shared = FileSearchResultStore(self.directory)
+        cache = SearchResultCache(10, 30, shared=shared)
+        value = dict(hits=dict(hits=[]))
+
+        # A value is stored both in memory and in the shared store.
+        cache.set("key", value)
+        eq_(value, cache.local.get("key"))
+        eq_(value, shared.get("key"))
+
+        # A value found only in the shared store is copied into memory.
+        cache.local.clear()
+        eq_(value, cache.get("key"))
+        eq_(value, cache.local.get("key"))
+
+        # Clearing the cache clears both tiers.
+        cache.clear()
+        eq_(None, cache.get("key"))
+        eq_(None, shared.get("key"))
+
+        # The shared store is optional.
+        cache = SearchResultCache(10, 30)
+        cache.set("key", value)
+        eq_(value, cache.get("key"))
+
+    def test_configure_result_cache(self):
+        try:
+            ExternalSearchIndex.configure_result_cache(
+                max_entries=5, ttl=10, shared_directory=self.directory
+            )
+            cache = ExternalSearchIndex.result_cache
+            eq_(5, cache.local.max_entries)
+            eq_(10, cache.local.ttl)
+            eq_(self.directory, cache.shared.directory)
+
+            cache.set("key", dict())
+            ExternalSearchIndex.invalidate_result_cache()
+            eq_(None, cache.get("key"))
+
+            ExternalSearchIndex.configure_result_cache(shared_directory=None)
+            eq_(None, ExternalSearchIndex.result_cache.shared)
+        finally:
+            ExternalSearchIndex.configure_result_cache(max_entries=None)
+        eq_(None, ExternalSearchIndex.result_cache)
+
+    def test_result_cache_key(self):
+        search = MockExternalSearchIndex()
+        search.works_alias = "works-current"
+        search.works_index = "works-v4"
+
+        class MockSearch(object):
+            def __init__(self, body):
+                self.body = body
+            def to_dict(self):
+                return self.body
+
+        # The key doesn't depend on the order of keys in the request.
+        key = search._result_cache_key(MockSearch(dict(a=1, b=[2, 3])))
+        eq_(key, search._result_cache_key(MockSearch(dict(b=[2, 3], a=1))))
+
+        # But it does depend on their values...
+        assert key != search._result_cache_key(
+            MockSearch(dict(a=1, b=[3, 2]))
+        )
+
+        # ...and on the index being searched.
+        search.works_alias = "other-current"
+        assert key != search._result_cache_key(
+            MockSearch(dict(a=1, b=[2, 3]))
+        )
+
+        # When the alias is moved to a new index, results cached
+        # from the old index -- possibly by another process sharing
+        # a FileSearchResultStore -- are no longer used.
+        search.works_alias = "works-current"
+        search.works_index = "works-v5"
+        assert key != search._result_cache_key(
+            MockSearch(dict(a=1, b=[2, 3]))
+        )
+
+
+class TestSearchMetrics(object):
+
+    def test_snapshot(self):
+        metrics = SearchMetrics()
+        metrics.observe('took', 0.003)
+        metrics.observe('took', 0.2)
+        metrics.observe('took', 60)
+        metrics.increment('queries', 3)
+
+        snapshot = metrics.snapshot()
+        eq_(dict(queries=3), snapshot['counters'])
+        took = snapshot['histograms']['took']
+        eq_(3, took['count'])
+        eq_(60.203, round(took['sum'], 3))
+
+        # The buckets are cumulative.
+        buckets = dict(took['buckets'])
+        eq_(1, buckets[0.005])
+        eq_(1, buckets[0.1])
+        eq_(2, buckets[0.25])
+        eq_(2, buckets[10])
+        eq_(3, buckets['+Inf'])
+
+        eq_(0, snapshot['histograms']['hydrate']['count'])
+        assert "took=20.068s" in metrics.summary
+
+        metrics.reset()
+        eq_({}, metrics.snapshot()['counters'])
+
+
+class TestRecordSearch(object):
+
+    class MockLog(object):
+        def __init__(self):
+            self.messages = []
+        def warn(self, message, *args):
+            self.messages.append(message % args)
+
+    def setup(self):
+        self.metrics = ExternalSearchIndex.metrics
+        self.log = ExternalSearchIndex.slow_query_log
+        ExternalSearchIndex.metrics = SearchMetrics()
+        ExternalSearchIndex.slow_query_log = self.MockLog()
+
+    def teardown(self):
+        ExternalSearchIndex.metrics = self.metrics
+        ExternalSearchIndex.slow_query_log = self.log
+        ExternalSearchIndex.configure_slow_query_log(None)
+
+    def test_record_search(self):
+        response = dict(
+            took=20, timed_out=False, hits=dict(total=7),
+            _shards=dict(total=5, failed=1)
+        )
+        timings = dict(build=0.01, took=0.02, transport=0.5)
+        ExternalSearchIndex.record_search(
+            "Moby  Dick", None, timings, body=dict(query="body"),
+            response=response
+        )
+        counters = ExternalSearchIndex.metrics.snapshot()['counters']
+        eq_(dict(queries=1, hits=7, shards=5, shard_failures=1), counters)
+
+        # The response may also be an elasticsearch_dsl Response.
+        ExternalSearchIndex.record_search(
+            None, None, timings, response=Response(Search(), response)
+        )
+        counters = ExternalSearchIndex.metrics.snapshot()['counters']
+        eq_(dict(queries=2, hits=14, shards=10, shard_failures=2), counters)
+
+        # The slow query log is disabled by default.
+        log = ExternalSearchIndex.slow_query_log
+        eq_([], log.messages)
+
+        # Once it's enabled, a search slower than the threshold is
+        # logged along with the request that was sent.
+        ExternalSearchIndex.configure_slow_query_log(0.5)
+        ExternalSearchIndex.record_search(
+            "Moby  Dick", None, timings, body=dict(query="body")
+        )
+        [message] = log.messages
+        assert message.startswith("Slow search (0.530sec: build=0.010s transport=0.500s took=0.020s)")
+        assert '"moby dick"' in message
+        assert '{"query": "body"}' in message
+        eq_(1, ExternalSearchIndex.metrics.counters['slow_queries'])
+
+        # If no request is provided, the Filter is described instead.
+        ExternalSearchIndex.record_search(
+            None, Filter(languages=["eng"]), dict(took=1)
+        )
+        assert '"nested_filters"' in log.messages[-1]
+        assert '"eng"' in log.messages[-1]
+
+        # The request may be given as a function, which is only
+        # called if the search is logged.
+        ExternalSearchIndex.record_search(
+            None, None, dict(took=1), body=lambda: dict(query="lazy")
+        )
+        assert '{"query": "lazy"}' in log.messages[-1]
+
+        # A faster search isn't logged.
+        def fail():
+            raise Exception("The request shouldn't be needed.")
+        ExternalSearchIndex.record_search(
+            None, None, dict(took=0.1), body=fail
+        )
+        eq_(3, len(log.messages))
+
+    def test_record_hydration(self):
+        ExternalSearchIndex.configure_slow_query_log(1)
+        ExternalSearchIndex.record_hydration(0.5, 10)
+        ExternalSearchIndex.record_hydration(2, 20)
+        metrics = ExternalSearchIndex.metrics.snapshot()
+        eq_(30, metrics['counters']['hydrated_works'])
+        eq_(2, metrics['histograms']['hydrate']['count'])
+        eq_(["Slow hydration of search results (2.000sec) for 20 works"],
+            ExternalSearchIndex.slow_query_log.messages)
+
+
 class TestSearchOrder(EndToEndSearchTest):
 
     def populate_works(self):
@@ -3167,6 +3671,11 @@ class TestFilter(DatabaseTest):
         eq_(match_nothing, filter.match_nothing)
         eq_(min_score, filter.min_score)
 
+        # By default, the search results are only used to look up
+        # Works in the database.
+        eq_(False, filter.search_only)
+        eq_(True, Filter(search_only=True).search_only)
+
         # Test the `collections` argument.
 
         # If you pass in a library, you get all of its collections.
@@ -3441,6 +3950,98 @@ class TestFilter(DatabaseTest):
         filter = Filter.from_worklist(self._db, for_other_library, None)
         eq_(True, filter.allow_holds)
 
+    def test_from_worklist_cache(self):
+        # If the in-process cache is enabled, the restrictions a Lane
+        # places on its works are only calculated once.
+        lane = self._lane()
+        lane.fiction = True
+        self._db.flush()
+        Filter.configure_cache()
+        try:
+            filter = Filter.from_worklist(self._db, lane, None)
+            eq_(True, filter.fiction)
+            eq_([self._default_collection.id], filter.collection_ids)
+            eq_(1, len(Filter.worklist_cache))
+
+            # Modifying the Filter doesn't modify the cached values.
+            filter.collection_ids.append(-1)
+
+            # This change to the lane hasn't been written to the
+            # database yet, so the cached value is used.
+            lane.fiction = False
+            filter = Filter.from_worklist(self._db, lane, None)
+            eq_(True, filter.fiction)
+            eq_([self._default_collection.id], filter.collection_ids)
+
+            # Once the site configuration changes, the cached value is
+            # no longer used.
+            Configuration.site_configuration_last_update(
+                self._db, known_value=datetime.datetime.utcnow()
+            )
+            eq_(False, Filter.from_worklist(self._db, lane, None).fiction)
+
+            # Writing a change to a Lane to the database clears the
+            # cache.
+            eq_(True, len(Filter.worklist_cache) > 0)
+            lane.fiction = None
+            self._db.flush()
+            eq_(0, len(Filter.worklist_cache))
+            eq_(None, Filter.from_worklist(self._db, lane, None).fiction)
+
+            # A WorkList that's not a Lane may be built on the fly,
+            # so its restrictions are never cached.
+            worklist = WorkList()
+            worklist.initialize(self._default_library)
+            Filter.from_worklist(self._db, worklist, None)
+            eq_(1, len(Filter.worklist_cache))
+        finally:
+            Filter.configure_cache(max_entries=None)
+        eq_(None, Filter.worklist_cache)
+        eq_(None, Filter.build_cache)
+
+    def test_build_cache(self):
+        # If the in-process cache is enabled, the DSL for a Filter is
+        # only generated once.
+        Filter.configure_cache()
+        try:
+            def make_filter():
+                return Filter(
+                    media=Edition.BOOK_MEDIUM,
+                    collections=[self._default_collection]
+                )
+            built, nested = make_filter().build()
+
+            # An identical Filter gets the same DSL from the cache.
+            filter = make_filter()
+            built2, nested2 = filter.build()
+            assert built2 is built
+            eq_(nested, nested2)
+
+            # The nested filters can be modified without affecting the
+            # cache.
+            nested2['licensepools'].append(Term(field="value"))
+            nested2['genres'].append(Term(field="value"))
+            built3, nested3 = filter.build()
+            eq_(nested, nested3)
+
+            # Changing the Filter changes the DSL.
+            filter.media = Edition.AUDIO_MEDIUM
+            built4, nested4 = filter.build()
+            assert built4 != built
+            eq_(built4, Filter(
+                media=Edition.AUDIO_MEDIUM,
+                collections=[self._default_collection]
+            )._build()[0])
+
+            # Filters that match specific identifiers or authors
+            # aren't cached.
+            filter = Filter(identifiers=[self._identifier()])
+            eq_(None, filter._build_cache_key())
+            filter = Filter(author=ContributorData(sort_name="Author, A."))
+            eq_(None, filter._build_cache_key())
+        finally:
+            Filter.configure_cache(max_entries=None)
+
     def assert_filter_builds_to(self, expect, filter, _chain_filters=None):
         """Helper method for the most common case, where a
         Filter.build() returns a main filter and no nested filters.
@@ -4428,6 +5029,191 @@ class TestBulkUpdate(DatabaseTest):
         eq_(set([w1, w2, w3]), set(successes))
         eq_([], failures)
 
+    def test_report(self):
+        # bulk_update returns a BulkIndexReport describing what happened.
+        indexed = self._work()
+        failed = self._work()
+
+        # This work can't have a search document, because it has no
+        # presentation edition.
+        missing = self._work()
+        missing.presentation_edition = None
+        self._db.flush()
+
+        class Mock(MockExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                super(Mock, self).bulk(
+                    [x for x in docs if x['_id'] != failed.id]
+                )
+                # Like Elasticsearch, this reports the document ID
+                # as a string, and doesn't send back the document.
+                return len(docs) - 1, [
+                    dict(index=dict(
+                        _id=unicode(failed.id), status=400,
+                        error=dict(type="mapper_parsing_exception")
+                    ))
+                ]
+
+        for pipelined in (False, True):
+            index = Mock()
+            report = index.bulk_update(
+                [indexed, failed, missing], pipelined=pipelined
+            )
+            assert isinstance(report, BulkIndexReport)
+
+            # The report can be treated as a (successes, failures)
+            # 2-tuple.
+            successes, failures = report
+            eq_([indexed], successes)
+            eq_([(missing, "Work not indexed"),
+                 (failed, dict(type="mapper_parsing_exception"))],
+                failures)
+
+            eq_(1, report.missing)
+            eq_(2, report.documents)
+            assert report.bytes_sent > 0
+            eq_(set(['generate', 'upload', 'reconcile']),
+                set(report.timings.keys()))
+            eq_({"mapper_parsing_exception": 1}, report.error_counts)
+
+            summary = report.summary
+            assert summary.startswith(
+                "1 indexed, 2 failed (1 missing), 2 documents, "
+            )
+            assert summary.endswith("errors: mapper_parsing_exception=1")
+
+    def test_bulk_error_type(self):
+        m = ExternalSearchIndex._bulk_error_type
+        eq_("version_conflict_engine_exception", m(
+            dict(index=dict(error=dict(type="version_conflict_engine_exception")))
+        ))
+        eq_("ConnectionTimeout", m(
+            dict(index=dict(status='N/A', exception=ConnectionTimeout()))
+        ))
+        eq_("Exception", m(dict(error="Oops", exception="Exception")))
+        eq_("503", m(dict(update=dict(status=503, error="Unavailable"))))
+        eq_("unknown", m(dict()))
+
+    def test_bulk_error_id(self):
+        # Elasticsearch reports document IDs as strings. They're turned
+        # back into work IDs.
+        m = ExternalSearchIndex._bulk_error_id
+        eq_(123, m(dict(update=dict(_id="123", status=404))))
+        eq_(123, m(dict(data=dict(_id=123), error="Oops")))
+
+        # An ID that isn't a work ID is left alone.
+        eq_("abc", m(dict(index=dict(_id="abc"))))
+        eq_(None, m(dict()))
+
+
+class TestPipelinedBulkUpdate(DatabaseTest):
+
+    def test_bulk_update_pipelined(self):
+        # In a pipelined bulk update, documents are generated and
+        # uploaded in chunks.
+        class Mock(MockExternalSearchIndex):
+            BULK_UPDATE_CHUNK_SIZE = 2
+            def __init__(self):
+                super(Mock, self).__init__()
+                self.bulk_calls = []
+                self.pools = []
+            def bulk(self, docs, **kwargs):
+                self.bulk_calls.append(sorted(x['_id'] for x in docs))
+                return super(Mock, self).bulk(docs, **kwargs)
+            def _bulk_upload_thread_pool(self):
+                pool = super(Mock, self)._bulk_upload_thread_pool()
+                self.pools.append(pool)
+                return pool
+
+        works = [self._work() for i in range(3)]
+        for work in works:
+            work.set_presentation_ready()
+        index = Mock()
+        successes, failures = index.bulk_update(works, pipelined=True)
+        eq_(set(works), set(successes))
+        eq_([], failures)
+        eq_(3, len(index.docs))
+
+        # There was one bulk request per chunk.
+        eq_([sorted([works[0].id, works[1].id]), [works[2].id]],
+            sorted(index.bulk_calls))
+
+        # The uploads were done by a thread pool that was shut down
+        # once the update finished.
+        [pool] = index.pools
+        for thread in pool._pool:
+            eq_(False, thread.is_alive())
+
+        # Each update gets its own pool.
+        index.bulk_update(works, pipelined=True)
+        eq_(2, len(index.pools))
+        assert index.pools[0] is not index.pools[1]
+
+    def test_upload_documents(self):
+        # Documents that fail for transient reasons are retried on
+        # their own; documents that fail for other reasons are not.
+        class Mock(MockExternalSearchIndex):
+            BULK_UPLOAD_INITIAL_BACKOFF = 0
+            BULK_UPLOAD_MAX_RETRIES = 2
+            def __init__(self):
+                super(Mock, self).__init__()
+                self.attempts = []
+            def bulk(self, docs, **kwargs):
+                ids = [doc['_id'] for doc in docs]
+                self.attempts.append(ids)
+                errors = []
+                for id in ids:
+                    if id == 'busy' or (id == 'slow' and len(self.attempts) < 2):
+                        status = 429
+                    elif id == 'bad':
+                        status = 400
+                    else:
+                        continue
+                    errors.append(
+                        dict(index=dict(_id=id, status=status, error="oops"))
+                    )
+                return len(ids) - len(errors), errors
+
+        index = Mock()
+        docs = [dict(_id=x) for x in ('good', 'slow', 'bad', 'busy')]
+        success_count, errors, bytes_sent = index._upload_documents(docs)
+
+        # 'slow' worked on the second try. 'busy' never worked and
+        # was retried until we gave up. 'bad' was never retried.
+        eq_([['good', 'slow', 'bad', 'busy'], ['slow', 'busy'], ['busy']],
+            index.attempts)
+        eq_(2, success_count)
+        eq_(['bad', 'busy'], [x['index']['_id'] for x in errors])
+
+        # Every attempt counts towards the number of bytes sent.
+        eq_(sum(len(json.dumps(dict(_id=x))) for x in sum(index.attempts, [])),
+            bytes_sent)
+
+    def test_bulk_requests(self):
+        # Documents are grouped into bulk requests by size.
+        index = MockExternalSearchIndex()
+        docs = [dict(_id=i, text="x" * 40) for i in range(5)]
+        one_doc = len(json.dumps(docs[0]))
+
+        index.BULK_UPLOAD_MAX_BYTES = one_doc * 2
+        requests = list(index._bulk_requests(docs))
+        eq_([[0, 1], [2, 3], [4]],
+            [[x['_id'] for x in request] for request, size in requests])
+        eq_([one_doc*2, one_doc*2, one_doc], [size for request, size in requests])
+
+        # A document that's bigger than the limit still gets sent,
+        # in a request of its own.
+        index.BULK_UPLOAD_MAX_BYTES = 1
+        eq_(5, len(list(index._bulk_requests(docs))))
+
+    def test_is_transient_bulk_error(self):
+        m = ExternalSearchIndex._is_transient_bulk_error
+        eq_(True, m(dict(index=dict(status=429))))
+        eq_(True, m(dict(index=dict(status='N/A'))))
+        eq_(False, m(dict(index=dict(status=400))))
+        eq_(False, m(dict(error="Unknown")))
+
+
 class TestSearchErrors(ExternalSearchTest):
 
     def test_search_connection_timeout(self):
@@ -4507,6 +5293,102 @@ class TestWorkSearchResult(DatabaseTest):
         eq_(work.sort_title, result.sort_title)
 
 
+class TestHitBackedWork(DatabaseTest):
+
+    def hit(self, **kwargs):
+        """Create a dictionary that looks like a search result
+        retrieved in search-only mode.
+        """
+        pool = dict(
+            licensepool_id=1, collection_id=self._default_collection.id,
+            data_source_id=DataSource.lookup(self._db, DataSource.GUTENBERG).id,
+            open_access=True, suppressed=False, superceded=False,
+            licensed=True, available=True, open_access_link=True,
+            availability_time=0, identifier_type=Identifier.GUTENBERG_ID, identifier="100",
+        )
+        hit = dict(
+            work_id=22, opds_entry="<entry>a simple entry</entry>",
+            last_update_time=86400, title="A Title", medium=Edition.BOOK_MEDIUM,
+            licensepools=[pool],
+        )
+        hit.update(kwargs)
+        return hit
+
+    def test_from_hit(self):
+        hit = self.hit()
+        work = HitBackedWork.from_hit(self._db, hit)
+        eq_(22, work.id)
+        eq_(22, work.work_id)
+        eq_(hit['opds_entry'], work.simple_opds_entry)
+        eq_(None, work.verbose_opds_entry)
+        eq_(datetime.datetime(1970, 1, 2), work.last_update_time)
+        eq_("A Title", work.presentation_edition.title)
+        eq_(Edition.BOOK_MEDIUM, work.presentation_edition.medium)
+
+        [pool] = work.license_pools
+        eq_(work, pool.work)
+        eq_(1, pool.id)
+        eq_(DataSource.GUTENBERG, pool.data_source.name)
+        eq_(datetime.datetime(1970, 1, 1), pool.availability_time)
+        eq_(work.presentation_edition, pool.presentation_edition)
+
+        # The Identifier can generate a URN but was never added to
+        # the database session.
+        eq_(Identifier.GUTENBERG_URN_SCHEME_PREFIX + "100", pool.identifier.urn)
+        eq_(pool.identifier, work.presentation_edition.primary_identifier)
+        assert pool.identifier not in self._db
+
+        # A search result without a cached OPDS entry can't be
+        # turned into a HitBackedWork.
+        eq_(None, HitBackedWork.from_hit(self._db, self.hit(opds_entry=None)))
+
+    def test_collection_ids(self):
+        # LicensePools in other collections are ignored.
+        hit = self.hit()
+        work = HitBackedWork.from_hit(
+            self._db, hit, [self._default_collection.id]
+        )
+        eq_(1, len(work.license_pools))
+
+        work = HitBackedWork.from_hit(self._db, hit, [-1])
+        eq_([], work.license_pools)
+        eq_(None, work.active_license_pool())
+        eq_(None, work.presentation_edition.primary_identifier)
+
+    def test_active_license_pool(self):
+        hit = self.hit()
+        [base] = hit['licensepools']
+        licensed = dict(base, licensepool_id=2, open_access=False)
+        superceded = dict(base, licensepool_id=3, superceded=True)
+        suppressed = dict(base, licensepool_id=4, suppressed=True)
+        open_access = dict(base, licensepool_id=5)
+
+        def active(*pools):
+            work = HitBackedWork.from_hit(
+                self._db, self.hit(licensepools=list(pools))
+            )
+            pool = work.active_license_pool()
+            return pool and pool.id
+
+        # Superceded and suppressed pools are never chosen.
+        eq_(None, active(superceded, suppressed))
+
+        # An open-access pool is preferred to a licensed one.
+        eq_(2, active(superceded, licensed))
+        eq_(5, active(licensed, open_access))
+
+        # But not if it has no open-access link.
+        no_link = dict(open_access, open_access_link=False)
+        eq_(2, active(licensed, no_link))
+        eq_(None, active(no_link))
+
+        # A licensed pool isn't chosen if the work has no title.
+        work = HitBackedWork.from_hit(
+            self._db, self.hit(title=None, licensepools=[licensed])
+        )
+        eq_(None, work.active_license_pool())
+
+
 class TestSearchIndexCoverageProvider(DatabaseTest):
 
     def test_operation(self):
@@ -4556,3 +5438,81 @@ class TestSearchIndexCoverageProvider(DatabaseTest):
         eq_(work, record.obj)
         eq_(True, record.transient)
         eq_('There was an error!', record.exception)
+
+
+class TestSearchIndexAvailabilityCoverageProvider(DatabaseTest):
+
+    def test_operation(self):
+        index = MockExternalSearchIndex()
+        provider = SearchIndexAvailabilityCoverageProvider(
+            self._db, search_index_client=index
+        )
+        eq_(WorkCoverageRecord.UPDATE_SEARCH_INDEX_AVAILABILITY_OPERATION,
+            provider.operation)
+
+        # Only works that have been registered are processed.
+        eq_(True, provider.registered_only)
+
+    def test_process_batch(self):
+        indexed = self._work(with_license_pool=True)
+        not_indexed = self._work(with_license_pool=True)
+        for work in (indexed, not_indexed):
+            work.set_presentation_ready()
+
+        index = MockExternalSearchIndex()
+        index.bulk_update([indexed])
+        [(key, original)] = index.docs.items()
+
+        # The availability of one of the work's LicensePools changes.
+        [pool] = indexed.license_pools
+        pool.update_availability(10, 0, 0, 5)
+        self._db.flush()
+
+        provider = SearchIndexAvailabilityCoverageProvider(
+            self._db, search_index_client=index
+        )
+        def full_reindex_record(work):
+            [record] = [
+                x for x in work.coverage_records
+                if x.operation==
+                WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+            ]
+            return record
+        full_reindex_record(not_indexed).status = WorkCoverageRecord.SUCCESS
+
+        results = provider.process_batch([indexed, not_indexed])
+        eq_(set([indexed, not_indexed]), set(results))
+
+        # The indexed work's search document has new availability
+        # information, and everything else is the same.
+        updated = index.docs[key]
+        [pool_doc] = updated['licensepools']
+        eq_(False, pool_doc['available'])
+        assert updated['last_update_time'] > original['last_update_time']
+        eq_(original['title'], updated['title'])
+
+        # The other work had no search document to update, so it
+        # was registered for a full reindex instead.
+        eq_(WorkCoverageRecord.REGISTERED,
+            full_reindex_record(not_indexed).status)
+        eq_(1, len(index.docs))
+
+    def test_failure(self):
+        class DoomedExternalSearchIndex(MockExternalSearchIndex):
+            """All updates sent to this index will fail."""
+            def bulk(self, docs, **kwargs):
+                return 0, [
+                    dict(update=dict(_id=unicode(doc['_id']), status=400,
+                                     error="There was an error!"))
+                    for doc in docs
+                ]
+
+        work = self._work(with_license_pool=True)
+        work.set_presentation_ready()
+        provider = SearchIndexAvailabilityCoverageProvider(
+            self._db, search_index_client=DoomedExternalSearchIndex()
+        )
+        [record] = provider.process_batch([work])
+        eq_(work, record.obj)
+        eq_(True, record.transient)
+        eq_('There was an error!', record.exception)
@@ -1,6 +1,7 @@
 import datetime
 import json
 import random
+import threading
 from nose.tools import (
     eq_,
     set_trace,
@@ -15,11 +16,15 @@ from . import (
 from sqlalchemy.sql.elements import Case
 from sqlalchemy import (
     and_,
+    event,
     func,
     text,
 )
 
-from elasticsearch.exceptions import ElasticsearchException
+from elasticsearch.exceptions import (
+    ConnectionTimeout,
+    ElasticsearchException,
+)
 
 from ..classifier import Classifier
 
@@ -1993,6 +1998,52 @@ class TestWorkList(DatabaseTest):
         # the return value of works(), the method we're testing.
         eq_(wl.fake_work_list, result)
 
+    def test_iter_all_works(self):
+        # Test the method that makes a single pass through the search
+        # index to find every work in a WorkList.
+
+        class MockSearchClient(object):
+            fake_work_ids = [1, 10, 100, 1000, 10000]
+            def scan_works(self, filter, slices, batch_size):
+                self.called_with = (filter, slices, batch_size)
+                for work_id in self.fake_work_ids:
+                    yield work_id
+
+        class MockWorkList(WorkList):
+            def works_for_hits(self, _db, work_ids, facets=None):
+                self.batches.append((list(work_ids), facets))
+                return ["work %d" % x for x in work_ids]
+
+        wl = MockWorkList()
+        wl.batches = []
+        wl.initialize(self._default_library, languages=["eng"])
+        facets = Facets(
+            self._default_library, None, None, order=Facets.ORDER_TITLE
+        )
+        search_client = MockSearchClient()
+
+        works = wl.iter_all_works(
+            self._db, facets, search_client, batch_size=2, slices=3
+        )
+
+        # Nothing happens until the works are needed.
+        eq_([], wl.batches)
+        works = list(works)
+        eq_(["work 1", "work 10", "work 100", "work 1000", "work 10000"],
+            works)
+
+        # The search results were turned into Works two at a time.
+        eq_([([1, 10], facets), ([100, 1000], facets), ([10000], facets)],
+            wl.batches)
+
+        # The scan used the WorkList's Filter and the given slices and
+        # batch size.
+        filter, slices, batch_size = search_client.called_with
+        eq_(Filter.from_worklist(self._db, wl, facets).build(),
+            filter.build())
+        eq_(3, slices)
+        eq_(2, batch_size)
+
     def test_works_for_hits(self):
         # Verify that WorkList.works_for_hits() just calls
         # works_for_resultsets().
@@ -2083,6 +2134,103 @@ class TestWorkList(DatabaseTest):
             self._db.delete(lpdm)
             eq_([[]], m(self._db, [[hit2]]))
 
+    def test_works_for_resultsets_query_count(self):
+        # Turning search results into an OPDS feed takes the same
+        # number of database queries no matter how many works there are.
+        from ..opds import (
+            AcquisitionFeed,
+            Annotator,
+        )
+        wl = WorkList()
+        wl.initialize(self._default_library)
+
+        class MockHit(object):
+            def __init__(self, work):
+                self.work_id = work.id
+            def __contains__(self, k):
+                return False
+
+        def make_works(how_many):
+            works = []
+            for i in range(how_many):
+                work = self._work(
+                    with_license_pool=True,
+                    with_open_access_download=(i % 2 == 0)
+                )
+                work.calculate_opds_entries(verbose=False)
+                works.append(work)
+            return works
+
+        def count_queries(works):
+            hits = [MockHit(work) for work in works]
+            # Make sure nothing is loaded yet.
+            self._db.flush()
+            self._db.expunge_all()
+
+            queries = []
+            def count(*args, **kwargs):
+                queries.append(args[2])
+            event.listen(self.connection, "before_cursor_execute", count)
+            try:
+                [results] = wl.works_for_resultsets(self._db, [hits])
+                feed = AcquisitionFeed(
+                    self._db, "title", "url", results, Annotator
+                )
+            finally:
+                event.remove(
+                    self.connection, "before_cursor_execute", count
+                )
+            eq_(len(works), len(results))
+            entries = [x for x in feed.feed if x.tag.endswith('entry')]
+            eq_(len(works), len(entries))
+            return len(queries)
+
+        # The first time through, some things are loaded that will be
+        # cached afterwards.
+        count_queries(make_works(1))
+
+        small = count_queries(make_works(2))
+        large = count_queries(make_works(10))
+        eq_(small, large)
+
+    def test_works_for_resultsets_search_only(self):
+        # In search-only mode, a Hit that includes a cached OPDS
+        # entry is turned into a HitBackedWork without going to
+        # the database.
+        from ..external_search import HitBackedWork
+        wl = WorkList()
+        wl.initialize(self._default_library)
+
+        in_database = self._work(with_license_pool=True)
+
+        class MockHit(dict):
+            @property
+            def work_id(self):
+                return self['work_id']
+
+        from_database = MockHit(work_id=in_database.id)
+        from_search = MockHit(
+            work_id=-1, opds_entry="<entry/>", licensepools=[]
+        )
+
+        [[result1, result2]] = wl.works_for_resultsets(
+            self._db, [[from_search, from_database]], search_only=True
+        )
+        assert isinstance(result1, HitBackedWork)
+        eq_(-1, result1.id)
+        eq_("<entry/>", result1.simple_opds_entry)
+
+        # The Hit without a cached OPDS entry was looked up in the
+        # database as usual.
+        eq_(in_database, result2)
+
+        # Outside of search-only mode, the cached OPDS entry is
+        # ignored, and a Work that's not in the database can't be
+        # found.
+        eq_([[in_database]], wl.works_for_resultsets(
+            self._db, [[from_search, from_database]]
+        ))
+
     def test_search_target(self):
         # A WorkList can be searched - it is its own search target.
         wl = WorkList()
@@ -3044,6 +3192,9 @@ class TestLane(DatabaseTest):
                 else:
                     medium = None
                 return values_by_medium[medium]
+
+            def count_works_multi(self, filters):
+                return [self.count_works(filter) for filter in filters]
         search_engine = Mock()
 
         # Enable the 'ebooks' and 'audiobooks' entry points.
@@ -3069,6 +3220,38 @@ class TestLane(DatabaseTest):
         )
         eq_(102, fiction.size)
 
+    def test_update_sizes(self):
+        # update_sizes() updates the sizes of a number of lanes with a
+        # single call to count_works_multi().
+        class Mock(object):
+            def __init__(self):
+                self.calls = []
+
+            def count_works_multi(self, filters):
+                self.calls.append(filters)
+                return [
+                    (1000 if filter.fiction else 0) + len(filter.media or [])
+                    for filter in filters
+                ]
+        search_engine = Mock()
+
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        nonfiction = self._lane(display_name="Nonfiction", fiction=False)
+        Lane.update_sizes(self._db, [fiction, nonfiction], search_engine)
+
+        [filters] = search_engine.calls
+        eq_(2 * len(EntryPoint.ENTRY_POINTS), len(filters))
+
+        # The entry points that restrict the medium get a different
+        # count than EverythingEntryPoint.
+        eq_(1000, fiction.size)
+        eq_(0, nonfiction.size)
+        for lane, base in ((fiction, 1000), (nonfiction, 0)):
+            eq_(set(x.URI for x in EntryPoint.ENTRY_POINTS),
+                set(lane.size_by_entrypoint.keys()))
+            eq_(base, lane.size_by_entrypoint[EverythingEntryPoint.URI])
+            eq_(base + 1, lane.size_by_entrypoint[EbooksEntryPoint.URI])
+
     def test_visibility(self):
         parent = self._lane()
         visible_child = self._lane(parent=parent)
@@ -4032,7 +4215,7 @@ class TestWorkListGroups(DatabaseTest):
             def __init__(self):
                 self.called_with = None
 
-            def query_works_multi(self, queries):
+            def query_works_multi(self, queries, timeout=None):
                 # Pretend to run a multi-query and return three lists of
                 # mocked results.
                 self.called_with = queries
@@ -4133,6 +4316,133 @@ class TestWorkListGroups(DatabaseTest):
         # And that's how we got a sequence of 2-tuples mapping out a
         # grouped OPDS feed.
 
+    def test_featured_works_with_lanes_concurrency(self):
+        # The search requests made by _featured_works_with_lanes are
+        # sent on a thread pool as soon as it's called. A request
+        # that takes too long is abandoned, and the feed is built
+        # with what's available.
+        class MockWorkList(WorkList):
+            def works_for_resultsets(self, _db, resultsets, facets=None):
+                self.works_for_resultsets_called_with = resultsets
+                return resultsets
+
+        shared_pagination = Pagination(size=2)
+        release = threading.Event()
+
+        class MockSearchEngine(object):
+            def __init__(self):
+                self.threads = []
+                self.timeouts = []
+
+            def query_works_multi(self, queries, timeout=None):
+                self.threads.append(threading.current_thread())
+                self.timeouts.append(timeout)
+                [(query_string, filter, pagination)] = queries
+                if pagination is shared_pagination:
+                    return [["fast"]]
+                # This is a separate request for a single lane. It
+                # won't finish until the test is done with it.
+                release.wait(5)
+                return [["slow"]]
+
+        parent = MockWorkList()
+        parent.GROUPS_LANE_TIMEOUT = 0.1
+        child1 = WorkList()
+        child2 = WorkList()
+        for wl in (parent, child1, child2):
+            wl.initialize(library=self._default_library)
+
+        search = MockSearchEngine()
+        try:
+            results = parent._featured_works_with_lanes(
+                self._db, [child1], FeaturedFacets(0), shared_pagination,
+                search_engine=search, separate_lanes=[child2]
+            )
+            results = list(results)
+        finally:
+            release.set()
+
+        # Both search requests were sent on other threads.
+        eq_(2, len(search.threads))
+        assert threading.current_thread() not in search.threads
+
+        # The separate request for child2 timed out, so child2 got
+        # no works.
+        eq_([["fast"], []], parent.works_for_resultsets_called_with)
+        eq_([("fast", child1)], results)
+
+        # The search requests themselves were given the same timeout,
+        # so an abandoned request doesn't hold on to its thread.
+        eq_([0.1, 0.1], search.timeouts)
+
+        # If the search request times out before the lane does, the
+        # outcome is the same.
+        class TimesOut(MockSearchEngine):
+            def query_works_multi(self, queries, timeout=None):
+                [(query_string, filter, pagination)] = queries
+                if pagination is shared_pagination:
+                    return [["fast"]]
+                raise ConnectionTimeout("TIMEOUT", "Timed out", None)
+        parent.GROUPS_LANE_TIMEOUT = 5
+        results = parent._featured_works_with_lanes(
+            self._db, [child1], FeaturedFacets(0), shared_pagination,
+            search_engine=TimesOut(), separate_lanes=[child2]
+        )
+        eq_([("fast", child1)], list(results))
+
+        # If the thread pool is disabled, the requests are sent one
+        # at a time, on the current thread, before the method returns.
+        class Sequential(MockWorkList):
+            GROUPS_THREAD_POOL_SIZE = 0
+        parent = Sequential()
+        parent.initialize(library=self._default_library)
+        search = MockSearchEngine()
+        results = parent._featured_works_with_lanes(
+            self._db, [child1], FeaturedFacets(0), shared_pagination,
+            search_engine=search, separate_lanes=[child2]
+        )
+        eq_([threading.current_thread()] * 2, search.threads)
+        eq_([None, None], search.timeouts)
+        eq_([("fast", child1), ("slow", child2)], list(results))
+
+    def test_groups_for_lanes_separate_lanes(self):
+        # A Lane that isn't queryable along with its siblings gets its
+        # own search request, and its works are deduplicated
+        # separately from the others.
+        library = self._default_library
+        library.setting(library.FEATURED_LANE_SIZE).value = "2"
+        parent = self._lane()
+        child1 = self._lane(parent=parent)
+        child2 = self._lane(parent=parent, inherit_parent_restrictions=False)
+        w1 = self._work()
+        w2 = self._work()
+        w3 = self._work()
+
+        class MockParent(WorkList):
+            def _featured_works_with_lanes(
+                self, _db, lanes, facets, pagination, search_engine,
+                debug=False, separate_lanes=None
+            ):
+                self.called_with = (lanes, separate_lanes)
+                return iter([
+                    (w1, child1), (w2, child1), (w1, child2), (w3, child2)
+                ])
+
+        wl = MockParent()
+        wl.initialize(library=library)
+        groups = list(
+            wl._groups_for_lanes(
+                self._db, [child1, child2], [child1], FeaturedFacets(0),
+                search_engine=object()
+            )
+        )
+        eq_(([child1], [child2]), wl.called_with)
+
+        # If child2 had been deduplicated along with child1, w1 would
+        # have been moved to the end of child2.
+        eq_([(w1, child1), (w2, child1), (w1, child2), (w3, child2)],
+            groups)
+
     def test__size_for_facets(self):
 
         lane = self._lane()
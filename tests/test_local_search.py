@@ -0,0 +1,201 @@
+# encoding: utf-8
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+import os
+from psycopg2.extras import NumericRange
+import shutil
+import tempfile
+
+from . import (
+    DatabaseTest,
+)
+
+from ..config import CannotLoadConfiguration
+from ..external_search import (
+    ExternalSearchIndex,
+    Filter,
+    SortKeyPagination,
+)
+from ..lane import (
+    Facets,
+    FeaturedFacets,
+    Pagination,
+)
+from ..local_search import LocalSearchIndex
+from ..model import (
+    ExternalIntegration,
+    Genre,
+)
+
+
+class TestLocalSearchIndex(DatabaseTest):
+
+    def setup(self):
+        super(TestLocalSearchIndex, self).setup()
+        self.search = LocalSearchIndex(self._db, path=":memory:")
+
+        self.moby = self.default_work(
+            title="Moby Dick", authors="Herman Melville"
+        )
+        self.whale = self.default_work(
+            title="The Whale Road", authors="Jane Author", language="spa"
+        )
+        self.fantasy = self.default_work(
+            title="Alice's Dragon", authors="Jane Author", genre="Fantasy"
+        )
+        self.other_collection = self._collection()
+        self.elsewhere = self._work(
+            title="Whales Elsewhere", with_license_pool=True,
+            collection=self.other_collection
+        )
+        self.elsewhere.set_presentation_ready()
+        self.works = [self.moby, self.whale, self.fantasy, self.elsewhere]
+        self.search.bulk_update(self.works)
+
+    def default_work(self, *args, **kwargs):
+        work = self._work(
+            *args, with_license_pool=True,
+            collection=self._default_collection, **kwargs
+        )
+        work.set_presentation_ready()
+        return work
+
+    def query(self, query_string, filter=None, pagination=None):
+        return [
+            int(x.work_id) for x in
+            self.search.query_works(query_string, filter, pagination)
+        ]
+
+    def test_constructor(self):
+        # With no path and no integration, there's nothing to load.
+        assert_raises(CannotLoadConfiguration, LocalSearchIndex, self._db)
+
+        # ExternalSearchIndex.load() finds a local search integration
+        # if there's no Elasticsearch integration.
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "search.sqlite")
+            self._external_integration(
+                ExternalIntegration.LOCAL_SEARCH,
+                goal=ExternalIntegration.SEARCH_GOAL,
+                settings={LocalSearchIndex.DATABASE_PATH_KEY: path}
+            )
+            index = ExternalSearchIndex.load(self._db)
+            assert isinstance(index, LocalSearchIndex)
+            eq_(path, index.path)
+            assert os.path.exists(path)
+
+            # The index is opened once per process, not once per load().
+            eq_(index, ExternalSearchIndex.load(self._db))
+
+            # Opening an existing index doesn't empty it.
+            index.bulk_update([self.moby])
+            eq_(1, LocalSearchIndex(self._db, path=path).count_works(None))
+        finally:
+            LocalSearchIndex._instances.pop(path, None)
+            shutil.rmtree(directory)
+
+    def test_query_works(self):
+        eq_([self.moby.id], self.query("moby"))
+        eq_([self.moby.id], self.query("melville"))
+
+        # Words are stemmed.
+        eq_([self.whale.id, self.elsewhere.id], sorted(self.query("whale")))
+
+        # Every word must match, unless nothing matches every word.
+        eq_([self.whale.id], self.query("whale road"))
+        eq_([self.moby.id, self.fantasy.id],
+            sorted(self.query("moby dragon")))
+
+        # A Filter restricts the results.
+        eq_([self.elsewhere.id],
+            self.query("whale", Filter(collections=[self.other_collection])))
+        eq_([], self.query("whale", Filter(match_nothing=True)))
+
+    def test_filter(self):
+        def expect(works, filter):
+            eq_(sorted(x.id for x in works), sorted(self.query(None, filter)))
+
+        expect(self.works, None)
+        expect([self.whale], Filter(languages=["spa"]))
+        expect([self.moby, self.whale, self.fantasy],
+               Filter(collections=[self._default_collection]))
+
+        fantasy, ignore = Genre.lookup(self._db, "Fantasy")
+        expect([self.fantasy], Filter(genre_restriction_sets=[[fantasy]]))
+
+        customlist, ignore = self._customlist(num_entries=0)
+        customlist.add_entry(self.moby)
+        self.search.bulk_update([self.moby])
+        expect([self.moby],
+               Filter(customlist_restriction_sets=[[customlist]]))
+
+        [melville] = self.moby.presentation_edition.author_contributors
+        expect([self.moby], Filter(author=melville))
+
+        self.fantasy.target_age = NumericRange(8, 12, '[]')
+        self.search.bulk_update([self.fantasy])
+        expect([self.moby, self.whale, self.elsewhere],
+               Filter(target_age=(3, 5)))
+        expect(self.works, Filter(target_age=(9, 20)))
+
+        # A work is not found through a suppressed LicensePool.
+        self.moby.license_pools[0].suppressed = True
+        self.search.update_availability([self.moby])
+        expect([self.whale, self.fantasy, self.elsewhere], None)
+
+        eq_(3, self.search.count_works(None))
+        eq_([1, 0], self.search.count_works_multi(
+            [Filter(languages=["spa"]), Filter(match_nothing=True)]
+        ))
+
+    def test_sort_and_pagination(self):
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, order=Facets.ORDER_TITLE
+        )
+        filter = Filter(facets=facets)
+        in_order = [self.fantasy, self.moby, self.whale, self.elsewhere]
+
+        pagination = SortKeyPagination(size=2)
+        eq_([x.id for x in in_order[:2]],
+            self.query(None, filter, pagination))
+        eq_([x.id for x in in_order[2:]],
+            self.query(None, filter, pagination.next_page))
+
+        pagination = Pagination(offset=1, size=2)
+        eq_([x.id for x in in_order[1:3]],
+            self.query(None, filter, pagination))
+
+        # A scan finds every work, in order.
+        eq_([x.id for x in in_order],
+            [int(x.work_id) for x in self.search.scan_works(filter)])
+        eq_([x.title for x in in_order],
+            [x.title for x in self.search.scan_works(
+                filter, fields=['title'], batch_size=3
+            )])
+
+        # Featurability scoring puts higher-quality works first.
+        self.whale.quality = 1
+        self.search.bulk_update([self.whale])
+        featured = FeaturedFacets(1, random_seed=Filter.DETERMINISTIC)
+        filter = Filter(facets=featured)
+        eq_(self.whale.id, self.query(None, filter)[0])
+
+    def test_remove_work(self):
+        self.search.remove_work(self.moby)
+        eq_([], self.query("moby"))
+        eq_(3, self.search.count_works(None))
+
+    def test_rebuild(self):
+        # Works that aren't reindexed during a rebuild are removed
+        # once it's done.
+        restore = self.search.start_rebuild(self._db)
+        self.search.bulk_update([self.moby, self.whale])
+        progress = self.search.finish_rebuild(self._db, restore)
+        eq_(2, progress['indexed'])
+        eq_(sorted([self.moby.id, self.whale.id]),
+            sorted(self.query(None)))
@@ -27,6 +27,7 @@ from ..model import (
     CollectionMissing,
     Credential,
     DataSource,
+    DRMDeviceIdentifier,
     Edition,
     ExternalIntegration,
     Genre,
@@ -39,6 +40,7 @@ from ..model import (
 )
 
 from ..monitor import (
+    CachedFeedPrewarmMonitor,
     CachedFeedReaper,
     CirculationEventLocationScrubber,
     CollectionMonitor,
@@ -912,6 +914,156 @@ class TestCustomListEntryWorkUpdateMonitor(DatabaseTest):
         eq_(old_work, entry.work)
 
 
+class MockCachedFeedPrewarmMonitor(CachedFeedPrewarmMonitor):
+
+    def __init__(self, *args, **kwargs):
+        super(MockCachedFeedPrewarmMonitor, self).__init__(*args, **kwargs)
+        self.refreshed = []
+        self.frequencies = {}
+        self.fail = False
+
+    def refresh(self, candidate):
+        if self.fail:
+            raise Exception("Kaboom")
+        self.refreshed.append(
+            (candidate.worklist, candidate.pagination is None)
+        )
+
+    def request_frequency(self, candidate):
+        return self.frequencies.get(candidate.worklist, 0)
+
+
+class TestCachedFeedPrewarmMonitor(DatabaseTest):
+
+    def setup(self):
+        super(TestCachedFeedPrewarmMonitor, self).setup()
+        self.parent = self._lane(u"Parent")
+        self.child = self._lane(u"Child", parent=self.parent)
+
+    def test_candidates(self):
+        monitor = CachedFeedPrewarmMonitor(self._db)
+        candidates = list(monitor.candidates(self._default_library))
+
+        # The parent lane has a visible sublane, so its groups feed is
+        # a candidate, as well as its first page. The child lane has no
+        # sublanes, so only its first page is a candidate.
+        eq_(
+            [(self.parent, True, 0), (self.parent, False, 0),
+             (self.child, False, 1)],
+            [(x.worklist, x.pagination is None, x.depth)
+             for x in candidates]
+        )
+
+        # None of the feeds has ever been generated, so all of them
+        # are overdue.
+        for x in candidates:
+            eq_(datetime.datetime.min, x.expires)
+
+        # Once a feed has been generated, its expiration time is
+        # based on its maximum cache age.
+        groups, page, child_page = candidates
+        feed = CachedFeed.fetch(
+            self._db, self.child, child_page.facets, child_page.pagination,
+            lambda: u"a feed", max_age=0, raw=True
+        )
+        [ignore, ignore, child_page] = monitor.candidates(
+            self._default_library
+        )
+        eq_(
+            feed.timestamp + datetime.timedelta(
+                seconds=self.child.MAX_CACHE_AGE
+            ),
+            child_page.expires
+        )
+
+        # A groups feed for a Lane is cached forever, but the monitor
+        # refreshes it once it gets old enough.
+        feed = CachedFeed.fetch(
+            self._db, self.parent, groups.facets, None,
+            lambda: u"a feed", max_age=0, raw=True
+        )
+        [groups, ignore, ignore] = monitor.candidates(self._default_library)
+        eq_(
+            feed.timestamp + monitor.CACHE_FOREVER_REFRESH_AGE,
+            groups.expires
+        )
+
+    def test_run_once(self):
+        monitor = MockCachedFeedPrewarmMonitor(self._db)
+        eq_(datetime.timedelta(minutes=5), monitor.refresh_window)
+        result = monitor.run_once()
+
+        # Every feed was refreshed, in priority order.
+        eq_(
+            [(self.parent, True), (self.parent, False), (self.child, False)],
+            monitor.refreshed
+        )
+        assert result.achievements.startswith(
+            "Feeds refreshed: 3. Failures: 0. Not due for refresh: 0."
+        )
+
+        # If a feed is requested more often, it's refreshed first.
+        monitor = MockCachedFeedPrewarmMonitor(self._db, max_feeds=1)
+        monitor.frequencies[self.child] = 100
+        monitor.run_once()
+        eq_([(self.child, False)], monitor.refreshed)
+
+        # A feed that won't go stale within the refresh window is
+        # left alone.
+        candidates = list(monitor.candidates(self._default_library))
+        child_page = candidates[-1]
+        CachedFeed.fetch(
+            self._db, self.child, child_page.facets, child_page.pagination,
+            lambda: u"a feed", max_age=0, raw=True
+        )
+        monitor = MockCachedFeedPrewarmMonitor(self._db, refresh_window=60)
+        result = monitor.run_once()
+        eq_(
+            [(self.parent, True), (self.parent, False)],
+            monitor.refreshed
+        )
+        assert result.achievements.startswith(
+            "Feeds refreshed: 2. Failures: 0. Not due for refresh: 1."
+        )
+
+        # Unless the refresh window is longer than the feed's
+        # remaining lifetime.
+        monitor = MockCachedFeedPrewarmMonitor(
+            self._db, refresh_window=datetime.timedelta(days=1)
+        )
+        monitor.run_once()
+        eq_(3, len(monitor.refreshed))
+
+        # Only the requested libraries are considered.
+        other_library = self._library()
+        monitor = MockCachedFeedPrewarmMonitor(
+            self._db, libraries=[other_library]
+        )
+        monitor.run_once()
+        assert self.parent not in [x for x, ignore in monitor.refreshed]
+
+    def test_priority(self):
+        monitor = MockCachedFeedPrewarmMonitor(self._db)
+        now = datetime.datetime.utcnow()
+        earlier = now - datetime.timedelta(hours=1)
+        C = CachedFeedPrewarmMonitor.PrewarmCandidate
+        shallow = C(self.parent, None, object(), 0, now)
+        deep = C(self.child, None, object(), 1, earlier)
+        groups = C(self.parent, None, None, 0, now)
+        stale = C(self.parent, None, object(), 0, earlier)
+
+        eq_(
+            [groups, stale, shallow, deep],
+            sorted([deep, shallow, stale, groups], key=monitor.priority)
+        )
+
+        monitor.frequencies[self.child] = 1
+        eq_(
+            [deep, groups, stale, shallow],
+            sorted([deep, shallow, stale, groups], key=monitor.priority)
+        )
+
+
 class MockReaperMonitor(ReaperMonitor):
     MODEL_CLASS = Timestamp
     TIMESTAMP_FIELD = 'timestamp'
@@ -982,6 +1134,37 @@ class TestReaperMonitor(DatabaseTest):
         remaining = set(self._db.query(Credential).all())
         eq_(set([active, eternal]), remaining)
 
+    def test_bulk_delete(self):
+        # Most reapers delete rows in bulk.
+        eq_(True, CachedFeedReaper(self._db).bulk_delete)
+        eq_(True, CredentialReaper(self._db).bulk_delete)
+
+        # But a Patron has relationships that cascade deletes, so
+        # patrons must be deleted through the ORM.
+        eq_(False, PatronRecordReaper(self._db).bulk_delete)
+
+        # These reapers need to do more than delete a row.
+        eq_(False, CollectionReaper(self._db).bulk_delete)
+        eq_(False, WorkReaper.BULK_DELETE)
+
+    def test_run_once_in_bulk_clears_references(self):
+        expired = self._credential()
+        expired.expires = datetime.datetime.utcnow() - datetime.timedelta(
+            days=CredentialReaper.MAX_AGE + 1
+        )
+        device, ignore = expired.register_drm_device_identifier("device")
+        self._db.commit()
+
+        result = CredentialReaper(self._db).run_once()
+        eq_("Items deleted: 1", result.achievements)
+        eq_([], self._db.query(Credential).all())
+
+        # As it would have been if the Credential had been deleted
+        # through the ORM, the DRMDeviceIdentifier is still around
+        # but no longer points to the Credential.
+        eq_([device], self._db.query(DRMDeviceIdentifier).all())
+        eq_(None, device.credential_id)
+
     def test_reap_patrons(self):
         m = PatronRecordReaper(self._db)
         expired = self._patron()
@@ -1195,6 +1378,60 @@ class TestScrubberMonitor(DatabaseTest):
         for untouched in (new, recent):
             eq_("loc", untouched.location)
 
+    def test_run_once_in_ranges(self):
+        class Mock(CirculationEventLocationScrubber):
+            def throttle(self, rows, elapsed):
+                self.throttled.append(rows)
+
+        m = Mock(self._db)
+        m.throttled = []
+        m.BATCH_SIZE = 2
+        long_ago = m.cutoff - datetime.timedelta(days=1)
+        events = [
+            create(
+                self._db, CirculationEvent, start=long_ago, location="loc"
+            )[0] for i in range(3)
+        ]
+        recent, ignore = create(
+            self._db, CirculationEvent, start=datetime.datetime.utcnow(),
+            location="loc"
+        )
+
+        # The rows were scrubbed in two ranges of ids.
+        timestamp = m.run_once()
+        eq_("Items scrubbed: 3", timestamp.achievements)
+        eq_([2, 1], m.throttled)
+        eq_([None, None, None], [x.location for x in events])
+        eq_("loc", recent.location)
+
+        # If there's nothing to scrub, nothing happens.
+        m.throttled = []
+        timestamp = m.run_once()
+        eq_("Items scrubbed: 0", timestamp.achievements)
+        eq_([], m.throttled)
+
+    def test_throttle(self):
+        class Mock(CirculationEventLocationScrubber):
+            def sleep(self, seconds):
+                self.slept.append(seconds)
+
+        # By default, there's no throttle.
+        m = Mock(self._db)
+        m.slept = []
+        m.throttle(100, 0)
+        eq_([], m.slept)
+
+        # With a throttle, the scrubber sleeps long enough to bring
+        # the rate down to max_rows_per_second.
+        m = Mock(self._db, max_rows_per_second=50)
+        m.slept = []
+        m.throttle(100, 0.5)
+        eq_([1.5], m.slept)
+
+        # If the rate was already slow enough, it doesn't sleep.
+        m.throttle(100, 3)
+        eq_([1.5], m.slept)
+
     def test_specific_scrubbers(self):
         # Check that all specific ScrubberMonitors are set up
         # correctly.
@@ -1602,6 +1602,34 @@ class TestAcquisitionFeed(DatabaseTest):
         expected = str(work.presentation_edition.issued.date())
         assert expected in entry.data
 
+    def test_single_entry_validators(self):
+        # An OPDS entry has an ETag based on its content.
+        work = self._work(with_open_access_download=True)
+        work.last_update_time = datetime.datetime(2019, 1, 2, 3, 4, 5)
+        entry = AcquisitionFeed.single_entry(self._db, work, TestAnnotator)
+        eq_('"%s"' % OPDSEntryResponse.calculate_etag(entry.data),
+            entry.headers['ETag'])
+
+        # Since the entry is private by default, it might contain
+        # information about the client that changes independently
+        # of the Work, so there's no Last-Modified header.
+        assert 'Last-Modified' not in entry.headers
+
+        # A public entry only changes when the Work does.
+        entry = AcquisitionFeed.single_entry(
+            self._db, work, TestAnnotator, max_age=100, private=False
+        )
+        eq_("Wed, 02 Jan 2019 03:04:05 GMT", entry.headers['Last-Modified'])
+
+        # If the client already has the entry, it gets a 304 response.
+        from flask import Flask
+        app = Flask(__name__)
+        headers = {"If-None-Match": entry.headers['ETag']}
+        with app.test_request_context(headers=headers):
+            entry = AcquisitionFeed.single_entry(self._db, work, TestAnnotator)
+            eq_(304, entry.status_code)
+            eq_("", entry.data)
+
     def test_single_entry_is_opds_message(self):
         # When single_entry has to deal with an 'OPDS entry' that
         # turns out to be an error message, caching rules are
@@ -1745,6 +1773,120 @@ class TestAcquisitionFeed(DatabaseTest):
         )
         eq_(entry_string, etree.tounicode(full_entry))
 
+    def test_create_entry_as_string(self):
+        work = self._work(with_open_access_download=True)
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, [], annotator=Annotator
+        )
+        expect = etree.tounicode(feed.create_entry(work, force_create=True))
+        cached = work.simple_opds_entry
+
+        # When the entry is cached, the annotations are spliced into
+        # the cached entry rather than parsing it.
+        spliced = feed.create_entry(work, as_string=True)
+        assert isinstance(spliced, unicode)
+        assert spliced.startswith(cached[:-len("</entry>")])
+        eq_(expect, etree.tounicode(etree.fromstring(spliced)))
+
+        # If the cached entry doesn't declare the namespaces used by
+        # the annotations, it's parsed and annotated as usual.
+        work.simple_opds_entry = "<entry><foo>bar</foo></entry>"
+        expect = etree.tounicode(feed.create_entry(work))
+        eq_(expect, feed.create_entry(work, as_string=True))
+
+        # An entry can be created from scratch as a string, too.
+        entry = feed.create_entry(work, use_cache=False, as_string=True)
+        assert isinstance(entry, unicode)
+        assert "<foo>" not in entry
+        eq_("<entry><foo>bar</foo></entry>", work.simple_opds_entry)
+
+    def test_entry_templates(self):
+        # A cached entry is only parsed once. After that, it's copied
+        # from a template.
+        work = self._work(with_open_access_download=True)
+        work.simple_opds_entry = "<entry><foo>bar</foo></entry>"
+        field = Annotator.opds_cache_field
+        AcquisitionFeed.configure_entry_templates(max_entries=10)
+        try:
+            entry = AcquisitionFeed._parse_cached_entry(
+                work, field, work.simple_opds_entry
+            )
+            eq_(1, len(AcquisitionFeed.entry_templates))
+            key = (work.id, field, work.last_update_time)
+            xml, template = AcquisitionFeed.entry_templates.get(key)
+            eq_(work.simple_opds_entry, xml)
+
+            # Modifying the entry doesn't affect the template.
+            assert entry is not template
+            entry.append(etree.Element("baz"))
+            eq_("<entry><foo>bar</foo></entry>", etree.tounicode(template))
+
+            entry2 = AcquisitionFeed._parse_cached_entry(
+                work, field, work.simple_opds_entry
+            )
+            eq_("<entry><foo>bar</foo></entry>", etree.tounicode(entry2))
+            eq_(1, len(AcquisitionFeed.entry_templates))
+
+            # If the cached entry changes, the template is replaced.
+            work.simple_opds_entry = "<entry><foo>new</foo></entry>"
+            entry3 = AcquisitionFeed._parse_cached_entry(
+                work, field, work.simple_opds_entry
+            )
+            eq_("<entry><foo>new</foo></entry>", etree.tounicode(entry3))
+            eq_(1, len(AcquisitionFeed.entry_templates))
+
+            # The template is used when a feed creates an entry.
+            feed = AcquisitionFeed(
+                self._db, self._str, self._url, [], annotator=Annotator
+            )
+            entry = feed.create_entry(work)
+            eq_("new", entry.find("foo").text)
+            eq_("<entry><foo>new</foo></entry>", etree.tounicode(
+                AcquisitionFeed.entry_templates.get(key)[1]
+            ))
+
+            # If the cache is disabled, the entry is parsed every time.
+            AcquisitionFeed.configure_entry_templates(max_entries=0)
+            eq_(None, AcquisitionFeed.entry_templates)
+            entry = AcquisitionFeed._parse_cached_entry(
+                work, field, work.simple_opds_entry
+            )
+            eq_("<entry><foo>new</foo></entry>", etree.tounicode(entry))
+        finally:
+            AcquisitionFeed.configure_entry_templates()
+
+    def test_streaming(self):
+        # A streaming feed creates its entries while it's being
+        # serialized.
+        work1 = self._work(with_open_access_download=True)
+        work2 = self._work(with_open_access_download=True)
+        message = OPDSMessage("urn", 404, "no such work")
+        args = (self._db, "title", "http://url/", [work1, work2])
+        kwargs = dict(annotator=Annotator, precomposed_entries=[message])
+
+        streaming = AcquisitionFeed(*args, streaming=True, **kwargs)
+        eq_(0, len(streaming.feed.findall("{%s}entry" % AtomFeed.ATOM_NS)))
+        chunks = list(streaming.stream())
+
+        # The feed header, one chunk for each entry, and the footer.
+        eq_(5, len(chunks))
+
+        # The result is equivalent to a normal feed.
+        normal = AcquisitionFeed(*args, **kwargs)
+        parsed_streaming = feedparser.parse(u"".join(chunks))
+        parsed_normal = feedparser.parse(unicode(normal))
+        eq_([x['id'] for x in parsed_normal['entries']],
+            [x['id'] for x in parsed_streaming['entries']])
+        eq_(parsed_normal['feed']['title'], parsed_streaming['feed']['title'])
+        assert "no such work" in unicode(streaming)
+
+        # Converting a streaming feed into a Response doesn't generate
+        # the feed right away.
+        streaming = AcquisitionFeed(*args, streaming=True, **kwargs)
+        response = streaming.as_response()
+        eq_(False, response.is_sequence)
+        eq_(unicode(normal).count("<entry"), response.data.count("<entry"))
+
     def test_exception_during_entry_creation_is_not_reraised(self):
         # This feed will raise an exception whenever it's asked
         # to create an entry.
@@ -61,6 +61,7 @@ from ..metadata_layer import (
 
 from ..scripts import (
     AddClassificationScript,
+    CachedFeedPrewarmScript,
     CheckContributorNamesInDB,
     CollectionInputScript,
     ConfigureCollectionScript,
@@ -83,6 +84,7 @@ from ..scripts import (
     RebuildSearchIndexScript,
     ReclassifyWorksForUncheckedSubjectsScript,
     RunCollectionMonitorScript,
+    RunCoverageProviderProcessesScript,
     RunCoverageProviderScript,
     RunMonitorScript,
     RunMultipleMonitorsScript,
@@ -97,6 +99,7 @@ from ..scripts import (
     ShowLibrariesScript,
     TimestampScript,
     UpdateCustomListSizeScript,
+    UpdateSearchIndexAvailabilityScript,
     UpdateLaneSizeScript,
     WhereAreMyBooksScript,
     WorkClassificationScript,
@@ -754,6 +757,79 @@ class TestRunThreadedCollectionCoverageProviderScript(DatabaseTest):
         assert new_timestamp > original_timestamp
 
 
+class TestRunCoverageProviderProcessesScript(DatabaseTest):
+
+    class MockResults(object):
+        def __init__(self, results):
+            self.results = iter(results)
+
+        def next(self, timeout=None):
+            return self.results.next()
+
+    class MockPool(object):
+        """Runs jobs in this process, with the test database session."""
+        def __init__(self, _db):
+            self._db = _db
+            self.jobs = []
+
+        def imap_unordered(self, func, jobs):
+            self.jobs.extend(jobs)
+            return TestRunCoverageProviderProcessesScript.MockResults(
+                [job.run(self._db) for job in jobs]
+            )
+
+    def test_run_provider(self):
+        works = [self._work() for i in range(3)]
+        provider_class = AlwaysSuccessfulWorkCoverageProvider
+        script = RunCoverageProviderProcessesScript(
+            provider_class, process_count=2, _db=self._db
+        )
+        script.RANGES_PER_PROCESS = 1
+        pool = self.MockPool(self._db)
+        [progress] = script.do_run(pool=pool)
+
+        # The works were divided between two jobs. Once they were
+        # covered, there were no transient failures left to try again.
+        eq_(2, len(pool.jobs))
+        eq_(works[0].id - 1, pool.jobs[0].start_after)
+        eq_(works[-1].id, pool.jobs[-1].end)
+        eq_(3, progress.successes)
+
+        provider = provider_class(self._db)
+        eq_([], provider.items_that_need_coverage().all())
+
+        # The results from every job were combined into one timestamp.
+        eq_(progress.achievements, provider.timestamp.achievements)
+
+    def test_handle_signal(self):
+        self._work()
+        script = RunCoverageProviderProcessesScript(
+            AlwaysSuccessfulWorkCoverageProvider, _db=self._db
+        )
+
+        # Once the script has been told to stop, no new jobs are
+        # started.
+        script.handle_signal()
+        pool = self.MockPool(self._db)
+        eq_([], script.do_run(pool=pool))
+        eq_([], pool.jobs)
+
+        [provider] = script.providers()
+        progress = script.run_provider(provider, pool=pool)
+        eq_([], pool.jobs)
+        eq_(0, progress.successes)
+
+    def test_provider_without_keyset_column(self):
+        class Mock(AlwaysSuccessfulWorkCoverageProvider):
+            KEYSET_COLUMN = None
+        script = RunCoverageProviderProcessesScript(Mock, _db=self._db)
+        [provider] = script.providers()
+        assert_raises_regexp(
+            ValueError, "can't be divided into id ranges",
+            script.run_provider, provider
+        )
+
+
 class TestRunWorkCoverageProviderScript(DatabaseTest):
 
     def test_constructor(self):
@@ -2818,6 +2894,35 @@ class TestMirrorResourcesScript(DatabaseTest):
         eq_(thumb_link.resource.url, attempt['link'].href)
 
 
+class TestUpdateSearchIndexAvailabilityScript(DatabaseTest):
+
+    def test_run(self):
+        class MockSearchIndex(object):
+            def update_availability(self, works):
+                self.updated = works
+                return works, []
+
+        index = MockSearchIndex()
+        work = self._work(with_license_pool=True)
+        other = self._work(with_license_pool=True)
+
+        # Only the work whose availability changed is registered.
+        work.external_index_availability_needs_updating()
+        script = UpdateSearchIndexAvailabilityScript(
+            self._db, search_index_client=index
+        )
+        [provider] = script.providers
+        eq_(index, provider.search_index_client)
+        script.do_run()
+        eq_([work], index.updated)
+
+        [record] = [
+            x for x in work.coverage_records
+            if x.operation==provider.operation
+        ]
+        eq_(WorkCoverageRecord.SUCCESS, record.status)
+
+
 class TestRebuildSearchIndexScript(DatabaseTest):
 
     def test_do_run(self):
@@ -2826,7 +2931,7 @@ class TestRebuildSearchIndexScript(DatabaseTest):
                 # This is where the search index is deleted and recreated.
                 self.setup_index_called = True
 
-            def bulk_update(self, works):
+            def bulk_update(self, works, **kwargs):
                 self.bulk_update_called_with = works
                 return works, []
 
@@ -2871,6 +2976,61 @@ class TestRebuildSearchIndexScript(DatabaseTest):
         eq_(2, len(new_coverage))
         assert set(new_coverage) != set(original_coverage)
 
+    def test_do_run_fast(self):
+        class MockSearchIndex(object):
+            def __init__(self):
+                self.calls = []
+
+            def start_rebuild(self, _db):
+                self.calls.append("start_rebuild")
+                return dict(number_of_replicas="2")
+
+            def bulk_update(self, works, **kwargs):
+                self.calls.append("bulk_update")
+                return works, []
+
+            def finish_rebuild(self, _db, restore_settings):
+                self.calls.append(("finish_rebuild", restore_settings))
+
+        index = MockSearchIndex()
+        work = self._work(with_license_pool=True)
+
+        # In fast mode, the index is rebuilt alongside the current
+        # one, and only put into use once every work has been
+        # indexed.
+        script = RebuildSearchIndexScript(
+            self._db, search_index_client=index, fast=True
+        )
+        [progress] = script.do_run()
+        eq_(
+            ["start_rebuild", "bulk_update",
+             ("finish_rebuild", dict(number_of_replicas="2"))],
+            index.calls
+        )
+
+        # If the coverage provider crashes, the rebuilt index is not
+        # put into use.
+        def crash(works, **kwargs):
+            raise Exception("Oops")
+        index.bulk_update = crash
+        index.calls = []
+        script = RebuildSearchIndexScript(
+            self._db, search_index_client=index, fast=True
+        )
+        [progress] = script.do_run()
+        assert "Oops" in progress.exception
+        eq_(["start_rebuild"], index.calls)
+
+        # Fast mode can also be turned on from the command line.
+        script = RebuildSearchIndexScript(
+            self._db, search_index_client=index, cmd_args=["--fast"]
+        )
+        eq_(True, script.fast)
+        script = RebuildSearchIndexScript(
+            self._db, search_index_client=index, cmd_args=[]
+        )
+        eq_(False, script.fast)
+
 
 class TestSearchIndexCoverageRemover(DatabaseTest):
 
@@ -2910,6 +3070,31 @@ class TestUpdateLaneSizeScript(DatabaseTest):
         UpdateLaneSizeScript(self._db).do_run(cmd_args=[])
         eq_(0, lane.size)
 
+    def test_do_run_batch(self):
+        lane = self._lane()
+        lane.size = 100
+        other_library = self._library()
+        other_lane = self._lane(library=other_library)
+        other_lane.size = 100
+
+        class Mock(object):
+            def __init__(self):
+                self.calls = []
+            def count_works_multi(self, filters):
+                self.calls.append(filters)
+                return [5] * len(filters)
+        search_engine = Mock()
+
+        # In batch mode, every lane in the given libraries is sized
+        # with a single call to count_works_multi.
+        UpdateLaneSizeScript(self._db).do_run(
+            cmd_args=["--batch", self._default_library.short_name],
+            search_engine=search_engine
+        )
+        eq_(5, lane.size)
+        eq_(100, other_lane.size)
+        eq_(1, len(search_engine.calls))
+
     def test_should_process_lane(self):
         """Only Lane objects can have their size updated."""
         lane = self._lane()
@@ -2920,6 +3105,35 @@ class TestUpdateLaneSizeScript(DatabaseTest):
         eq_(False, script.should_process_lane(worklist))
 
 
+class TestCachedFeedPrewarmScript(DatabaseTest):
+
+    def test_do_run(self):
+        class MockMonitor(object):
+            def __init__(self, _db, **kwargs):
+                self.kwargs = kwargs
+                self.ran = False
+
+            def run(self):
+                self.ran = True
+
+        annotator = object()
+        search = object()
+        script = CachedFeedPrewarmScript(
+            self._db, annotator=annotator, monitor_class=MockMonitor,
+            search_engine=search
+        )
+        monitor = script.do_run(
+            cmd_args=[self._default_library.short_name, "--max-feeds=10",
+                      "--refresh-window=30"]
+        )
+        eq_(True, monitor.ran)
+        eq_(
+            dict(annotator=annotator, libraries=[self._default_library],
+                 search_engine=search, refresh_window=30, max_feeds=10),
+            monitor.kwargs
+        )
+
+
 class TestUpdateCustomListSizeScript(DatabaseTest):
 
     def test_do_run(self):
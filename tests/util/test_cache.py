@@ -0,0 +1,93 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from ...util.cache import LRUCache
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(object):
+
+    def test_get_and_set(self):
+        cache = LRUCache(max_entries=2)
+        eq_(None, cache.get("a"))
+        eq_("default", cache.get("a", "default"))
+
+        cache.set("a", "value a")
+        eq_("value a", cache.get("a"))
+        assert "a" in cache
+        eq_(1, len(cache))
+
+        cache.delete("a")
+        eq_(None, cache.get("a"))
+        eq_(0, len(cache))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+
+        # Looking up 'a' makes 'b' the least recently used entry.
+        eq_("1", cache.get("a"))
+        cache.set("c", "3")
+        eq_(None, cache.get("b"))
+        eq_("1", cache.get("a"))
+        eq_("3", cache.get("c"))
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=10)
+        cache.set("a", "12345")
+        cache.set("b", "12345")
+        eq_(10, cache.total_bytes)
+
+        # Adding another entry pushes the oldest one out.
+        cache.set("c", "123")
+        eq_(None, cache.get("a"))
+        eq_(8, cache.total_bytes)
+
+        # An entry that could never fit is not cached, and doesn't
+        # push anything else out.
+        eq_(False, cache.set("d", "12345678901"))
+        eq_(None, cache.get("d"))
+        eq_(8, cache.total_bytes)
+
+        # Replacing an entry doesn't count its old value against
+        # the limit.
+        cache.set("c", "1")
+        eq_(6, cache.total_bytes)
+
+    def test_ttl(self):
+        clock = MockClock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.set("a", "value")
+        eq_(1000, cache.inserted_at("a"))
+
+        clock.now += 9
+        eq_("value", cache.get("a"))
+
+        # Once the TTL passes, the entry is treated as missing and
+        # removed.
+        clock.now += 1
+        eq_(None, cache.get("a"))
+        eq_(0, len(cache))
+        eq_(0, cache.total_bytes)
+
+    def test_delete_where(self):
+        cache = LRUCache()
+        for i in range(5):
+            cache.set(i, "x")
+        eq_(3, cache.delete_where(lambda key: key % 2 == 0))
+        eq_([1, 3], sorted(cache._entries.keys()))
+
+        cache.clear()
+        eq_(0, len(cache))
+        eq_(0, cache.total_bytes)
@@ -9,6 +9,9 @@ import datetime
 import time
 from flask import Response as FlaskResponse
 from wsgiref.handlers import format_date_time
+import flask
+from flask import Flask
+from ...util.compression import gzip_compress
 from ...util.flask_util import (
     OPDSEntryResponse,
     OPDSFeedResponse,
@@ -81,6 +84,157 @@ class TestResponse(object):
         assert 'private' in cache_control
         assert 'max-age=30' in cache_control
 
+    def test_gzipped(self):
+        # A Response can be created from a representation that was
+        # gzip-compressed ahead of time.
+        compressed = gzip_compress("content")
+        app = Flask(__name__)
+
+        # If the client accepts gzip, the compressed representation is
+        # sent as-is.
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            eq_(True, Response.client_accepts_gzip())
+            response = Response(compressed, gzipped=True, etag="abc")
+            eq_(compressed, response.data)
+            eq_("gzip", response.headers['Content-Encoding'])
+            eq_("Accept-Encoding", response.headers['Vary'])
+
+            # The compressed representation has its own ETag.
+            eq_('"abc-gzip"', response.headers['ETag'])
+
+        # Otherwise, it's decompressed.
+        with app.test_request_context(headers={"Accept-Encoding": "br"}):
+            eq_(False, Response.client_accepts_gzip())
+            response = Response(compressed, gzipped=True, etag="abc")
+            eq_("content", response.data)
+            assert 'Content-Encoding' not in response.headers
+            eq_('"abc"', response.headers['ETag'])
+
+            # Caches still need to know that a client that accepts
+            # gzip would get something different.
+            eq_("Accept-Encoding", response.headers['Vary'])
+
+        # A quality value of zero means gzip is not acceptable.
+        headers = {"Accept-Encoding": "gzip;q=0, br"}
+        with app.test_request_context(headers=headers):
+            eq_(False, Response.client_accepts_gzip())
+
+        # Outside of a request, there's no client to accept gzip.
+        eq_(False, Response.client_accepts_gzip())
+        response = OPDSFeedResponse(compressed, gzipped=True)
+        eq_("content", response.data)
+
+    def test_validators(self):
+        # A Response can carry validators that let a client make
+        # conditional requests.
+        last_modified = datetime.datetime(2019, 1, 2, 3, 4, 5, 600)
+        response = Response("content", etag="abc", last_modified=last_modified)
+        eq_('"abc"', response.headers['ETag'])
+        eq_("Wed, 02 Jan 2019 03:04:05 GMT", response.headers['Last-Modified'])
+        eq_(200, response.status_code)
+
+        # Outside of a request, nothing is ever not modified.
+        eq_(False, Response.is_conditional_request())
+        eq_(False, Response.not_modified("abc", last_modified))
+
+    def test_conditional_get(self):
+        app = Flask(__name__)
+        last_modified = datetime.datetime(2019, 1, 2, 3, 4, 5, 600)
+
+        def make_response(headers, method='GET', **kwargs):
+            kwargs.setdefault('etag', 'abc')
+            kwargs.setdefault('last_modified', last_modified)
+            body = "content"
+            if kwargs.get('gzipped'):
+                body = gzip_compress(body)
+            with app.test_request_context(headers=headers, method=method):
+                return Response(body, max_age=10, **kwargs)
+
+        # If the client already has the representation, a 304
+        # response with no body is sent.
+        for if_none_match in ('"abc"', 'W/"abc"', '"xyz", "abc"', '*'):
+            response = make_response({"If-None-Match": if_none_match})
+            eq_(304, response.status_code)
+            eq_("", response.data)
+            # The response still has its validators and caching
+            # headers.
+            eq_('"abc"', response.headers['ETag'])
+            assert 'max-age=10' in response.headers['Cache-Control']
+
+        # Otherwise, the full representation is sent.
+        response = make_response({"If-None-Match": '"xyz"'})
+        eq_(200, response.status_code)
+        eq_("content", response.data)
+
+        # A representation without an ETag never matches If-None-Match.
+        response = make_response({"If-None-Match": '"abc"'}, etag=None)
+        eq_(200, response.status_code)
+
+        # Conditional headers are only used for GET and HEAD requests.
+        response = make_response({"If-None-Match": '"abc"'}, method='POST')
+        eq_(200, response.status_code)
+        response = make_response({"If-None-Match": '"abc"'}, method='HEAD')
+        eq_(304, response.status_code)
+
+        # Only a 200 response is replaced with a 304.
+        for status in (201, 404, 500):
+            response = make_response(
+                {"If-None-Match": '"abc"'}, status=status
+            )
+            eq_(status, response.status_code)
+            eq_("content", response.data)
+
+        # If-Modified-Since is compared with the modification time,
+        # to the nearest second.
+        since = {"If-Modified-Since": "Wed, 02 Jan 2019 03:04:05 GMT"}
+        eq_(304, make_response(since).status_code)
+        later = last_modified + datetime.timedelta(seconds=1)
+        eq_(200, make_response(since, last_modified=later).status_code)
+        eq_(200, make_response(since, last_modified=None).status_code)
+        eq_(200, make_response(
+            {"If-Modified-Since": "not a date"}).status_code
+        )
+
+        # The compressed and uncompressed versions of a gzipped
+        # representation have different ETags, and a 304 response
+        # still varies on Accept-Encoding.
+        accepts_gzip = {"Accept-Encoding": "gzip"}
+        response = make_response(
+            dict(accepts_gzip, **{"If-None-Match": '"abc-gzip"'}), gzipped=True
+        )
+        eq_(304, response.status_code)
+        eq_("Accept-Encoding", response.headers['Vary'])
+        eq_(200, make_response(
+            dict(accepts_gzip, **{"If-None-Match": '"abc"'}), gzipped=True
+        ).status_code)
+        eq_(200, make_response(
+            {"If-None-Match": '"abc-gzip"'}, gzipped=True
+        ).status_code)
+
+        # If-Modified-Since is ignored if If-None-Match is present.
+        headers = dict(since)
+        headers['If-None-Match'] = '"xyz"'
+        eq_(200, make_response(headers).status_code)
+
+    def test_generator(self):
+        # A Response can be created from a generator, which will be
+        # run as the response is sent.
+        def body():
+            yield u"some "
+            yield u"data"
+        response = Response(body())
+        eq_(False, response.is_sequence)
+        eq_("some data", response.data)
+
+        # Inside a request, the generator keeps the request context
+        # alive while it runs.
+        app = Flask(__name__)
+        def needs_request():
+            yield flask.request.path
+        with app.test_request_context("/a/path"):
+            response = Response(needs_request())
+        eq_("/a/path", response.data)
+
     def test_unicode(self):
         # You can easily convert a Response object to Unicode
         # for use in a test.
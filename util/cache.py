@@ -0,0 +1,142 @@
+# encoding: utf-8
+"""In-process caches that keep recently used values in memory."""
+from nose.tools import set_trace
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe, least-recently-used cache.
+
+    The cache can be bounded by the number of entries, by the total
+    size of the entries, and by the age of each entry. When a new
+    entry would push the cache over either size bound, the least
+    recently used entries are evicted to make room.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None,
+                 size_function=None, clock=time.time):
+        """Constructor.
+
+        :param max_entries: The maximum number of entries to keep
+            in the cache.
+        :param max_bytes: The maximum total size of all entries,
+            as measured by `size_function`. If this is None, the total
+            size of the cache is not limited.
+        :param ttl: An entry will be treated as missing once it has
+            been in the cache for this number of seconds. If this is
+            None, entries never expire on their own.
+        :param size_function: A function that takes a value and
+            returns its size. By default, len() is used.
+        :param clock: A function that returns the current time as a
+            number of seconds. Only overridden in tests.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_function = size_function or len
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self.lock:
+            # Each value is a 3-tuple (value, size, inserted_at)
+            self._entries = OrderedDict()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """Look up a value in the cache.
+
+        :return: The cached value, or `default` if there is no
+            cached value or the cached value has expired.
+        """
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, size, inserted_at = entry
+            if self._expired(inserted_at):
+                self.total_bytes -= size
+                return default
+
+            # Re-insert the entry so it becomes the most recently used.
+            self._entries[key] = entry
+            return value
+
+    def inserted_at(self, key):
+        """When was the value for `key` put into the cache?
+
+        :return: A number of seconds as returned by the clock, or None
+            if the key is not in the cache.
+        """
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry[2]
+
+    def set(self, key, value):
+        """Put a value in the cache, evicting older values if necessary.
+
+        :return: True if the value was cached; False if it was too
+            large to fit in the cache at all.
+        """
+        size = self.size_function(value)
+        with self.lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size, self.clock())
+            self.total_bytes += size
+            self._evict()
+        return True
+
+    def delete(self, key):
+        """Remove the value for `key`, if any."""
+        with self.lock:
+            self._remove(key)
+
+    def delete_where(self, predicate):
+        """Remove every entry whose key matches `predicate`.
+
+        :param predicate: A function that takes a key and returns
+            True if its entry should be removed.
+        :return: The number of entries removed.
+        """
+        with self.lock:
+            doomed = [key for key in self._entries if predicate(key)]
+            for key in doomed:
+                self._remove(key)
+        return len(doomed)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def _expired(self, inserted_at):
+        return (
+            self.ttl is not None and self.clock() - inserted_at >= self.ttl
+        )
+
+    def _evict(self):
+        """Evict least recently used entries until the cache fits within
+        its bounds.
+        """
+        while self._entries and (
+            (self.max_entries is not None
+             and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None
+                and self.total_bytes > self.max_bytes)
+        ):
+            key, (value, size, inserted_at) = self._entries.popitem(last=False)
+            self.total_bytes -= size
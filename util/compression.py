@@ -0,0 +1,23 @@
+"""Helper functions for gzip-compressing representations."""
+import zlib
+
+# Passing this as `wbits` tells zlib to read and write gzip headers
+# rather than zlib headers.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def gzip_compress(data, level=6):
+    """Compress a bytestring into gzip format.
+
+    This produces the same format as the gzip module, but without the
+    overhead of a file-like object.
+
+    :param data: A bytestring. Unicode strings will be UTF-8 encoded.
+    """
+    if isinstance(data, unicode):
+        data = data.encode("utf8")
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data):
+    """Decompress a gzipped bytestring."""
+    return zlib.decompress(data, GZIP_WBITS)
@@ -1,15 +1,20 @@
 """Utilities for Flask applications."""
+import calendar
 import datetime
 import flask
+import hashlib
+import types
 from lxml import etree
 from nose.tools import set_trace
 from flask import Response as FlaskResponse
+from werkzeug.http import parse_date
 from wsgiref.handlers import format_date_time
 import time
 
 from . import (
     problem_detail,
 )
+from compression import gzip_decompress
 from opds_writer import OPDSFeed
 
 def problem_raw(type, status, title, detail=None, instance=None, headers={}):
@@ -33,22 +38,41 @@ class Response(FlaskResponse):
        * It's easy to calculate header values such as Cache-Control.
        * A response can be easily converted into a string for use in
          tests.
+       * A representation that was gzip-compressed ahead of time can
+         be sent as-is to clients that accept gzip.
+       * If the representation has validators (an ETag or a
+         modification time) that match a conditional request, a 304
+         response is sent instead.
+       * A representation can be generated piece by piece, while it's
+         being sent.
     """
 
     def __init__(self, response=None, status=None, headers=None, mimetype=None,
                  content_type=None, direct_passthrough=False, max_age=0,
-                 private=None):
+                 private=None, gzipped=False, etag=None, last_modified=None):
         """Constructor.
 
         All parameters are the same as for the Flask/Werkzeug Response class,
         with these additions:
 
+        :param response: In addition to the usual types, this may be
+            an lxml Element, an object that can be converted to Unicode,
+            or a generator that yields Unicode strings.
+
         :param max_age: The number of seconds for which clients should
             cache this response. Used to set a value for the
             Cache-Control header.
         :param private: If this is True, then the response contains
             information from an authenticated client and should not be stored
             in intermediate caches.
+        :param gzipped: If this is True, then `response` is a
+            gzip-compressed bytestring. It will be sent as-is if the
+            client accepts gzip, and decompressed otherwise.
+        :param etag: A string that uniquely identifies this
+            representation. Used to set the ETag header.
+        :param last_modified: A datetime (in UTC) reflecting when this
+            representation last changed. Used to set the Last-Modified
+            header.
         """
         max_age = max_age or 0
         try:
@@ -65,21 +89,140 @@ class Response(FlaskResponse):
                 private = False
         self.private = private
 
+        headers = dict(headers or {})
+        if etag is not None:
+            headers['ETag'] = '"%s"' % self.representation_etag(
+                etag, gzipped
+            )
+        if last_modified is not None:
+            headers['Last-Modified'] = format_date_time(
+                calendar.timegm(last_modified.timetuple())
+            )
+        if gzipped:
+            # Which representation is sent depends on Accept-Encoding,
+            # even when this particular client gets the uncompressed
+            # one, or none at all.
+            headers['Vary'] = 'Accept-Encoding'
+
         body = response
-        if isinstance(body, etree._Element):
+        if (status in (None, 200)
+            and self.not_modified(etag, last_modified, gzipped)):
+            # The client already has this representation. There's no
+            # need to send it again. Only a successful response can
+            # be replaced this way; an error must always be sent.
+            status = 304
+            body = None
+        elif gzipped:
+            if self.client_accepts_gzip():
+                headers['Content-Encoding'] = 'gzip'
+            else:
+                body = gzip_decompress(body)
+        elif isinstance(body, etree._Element):
             body = etree.tostring(body)
+        elif isinstance(body, types.GeneratorType):
+            if flask.has_request_context():
+                # The generator may need the database session, which
+                # goes away with the request context.
+                body = flask.stream_with_context(body)
         elif not isinstance(body, (bytes, unicode)):
             body = unicode(body)
 
         super(Response, self).__init__(
             response=body,
             status=status,
-            headers=self._headers(headers or {}),
+            headers=self._headers(headers),
             mimetype=mimetype,
             content_type=content_type,
             direct_passthrough=direct_passthrough
         )
 
+    @classmethod
+    def client_accepts_gzip(cls):
+        """Has the client making the current request said it
+        accepts gzip-compressed representations?
+        """
+        if not flask.has_request_context():
+            return False
+        # This takes quality values into account, so "gzip;q=0" means
+        # gzip is not acceptable.
+        return flask.request.accept_encodings['gzip'] > 0
+
+    @classmethod
+    def representation_etag(cls, etag, gzipped=False):
+        """Find the ETag of the representation that will actually be
+        sent to the client making the current request.
+
+        The gzip-compressed and uncompressed versions of a
+        representation aren't byte-for-byte identical, so they can't
+        share a strong ETag.
+
+        :param etag: The ETag of the uncompressed representation.
+        :param gzipped: Whether the representation is available
+            gzip-compressed.
+        """
+        if etag is None or not gzipped or not cls.client_accepts_gzip():
+            return etag
+        return etag + "-gzip"
+
+    @classmethod
+    def calculate_etag(cls, content):
+        """Calculate a strong ETag for a representation.
+
+        :param content: A bytestring or Unicode string.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        return hashlib.md5(content).hexdigest()
+
+    @classmethod
+    def is_conditional_request(cls):
+        """Is the current request a conditional GET?"""
+        if not flask.has_request_context():
+            return False
+        if flask.request.method not in ('GET', 'HEAD'):
+            return False
+        headers = flask.request.headers
+        return bool(
+            headers.get('If-None-Match') or headers.get('If-Modified-Since')
+        )
+
+    @classmethod
+    def not_modified(cls, etag=None, last_modified=None, gzipped=False):
+        """Does the client making the current request already have a
+        representation with these validators?
+
+        As per RFC 7232, If-Modified-Since is only considered if
+        If-None-Match is not present.
+
+        :param etag: The ETag of the current representation.
+        :param last_modified: A datetime (in UTC) reflecting when the
+            current representation last changed.
+        :param gzipped: Whether the representation is available
+            gzip-compressed. See representation_etag().
+        :return: True if a 304 response should be sent.
+        """
+        if not cls.is_conditional_request():
+            return False
+        headers = flask.request.headers
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            if etag is None:
+                return False
+            etag = cls.representation_etag(etag, gzipped)
+            tags = [x.strip() for x in if_none_match.split(',')]
+            quoted = '"%s"' % etag
+            return '*' in tags or quoted in tags or ('W/' + quoted) in tags
+
+        if last_modified is None:
+            return False
+        since = parse_date(headers.get('If-Modified-Since'))
+        if since is None:
+            return False
+        if since.tzinfo is not None:
+            since = since.replace(tzinfo=None) - since.utcoffset()
+        # HTTP dates are only precise to the second.
+        return last_modified.replace(microsecond=0) <= since
+
     def __unicode__(self):
         """This object can be treated as a string, e.g. in tests.
 
@@ -125,7 +268,7 @@ class OPDSFeedResponse(Response):
     """A convenience specialization of Response for typical OPDS feeds."""
     def __init__(self, response=None, status=None, headers=None, mimetype=None,
                  content_type=None, direct_passthrough=False, max_age=None,
-                 private=None):
+                 private=None, gzipped=False, etag=None, last_modified=None):
 
         mimetype = mimetype or OPDSFeed.ACQUISITION_FEED_TYPE
         status = status or 200
@@ -135,7 +278,8 @@ class OPDSFeedResponse(Response):
             response=response, status=status, headers=headers,
             mimetype=mimetype, content_type=content_type,
             direct_passthrough=direct_passthrough, max_age=max_age,
-            private=private
+            private=private, gzipped=gzipped, etag=etag,
+            last_modified=last_modified
         )
 
 
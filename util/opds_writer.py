@@ -169,6 +169,23 @@ class AtomFeed(object):
 
         return etree.tounicode(self.feed, pretty_print=True)
 
+    def iter_serialize(self, entries=()):
+        """Serialize this feed one piece at a time.
+
+        :param entries: An iterable of serialized <entry> tags (Unicode
+            strings) to include after anything already in the feed.
+        :yield: Unicode strings which, put together, make up the feed
+            document.
+        """
+        document = etree.tounicode(self.feed, pretty_print=True)
+
+        # Split off the closing tag so the entries can go in front of it.
+        head, tail = document.rsplit(u"</", 1)
+        yield head
+        for entry in entries:
+            yield entry
+        yield u"</" + tail
+
 
 class OPDSFeed(AtomFeed):
 